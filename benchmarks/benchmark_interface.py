@@ -0,0 +1,472 @@
+"""Benchmarks for the code paths of the interface that Snakemake runs for every
+job. All plugins are synthetic and defined (or generated) here, hence no network
+access or installed plugins are needed.
+
+Run with
+
+    python benchmarks/benchmark_interface.py --output results.json
+
+and compare the per_op_s values of two runs in order to spot regressions.
+"""
+
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import argparse
+from copy import copy
+from dataclasses import asdict, dataclass
+import hashlib
+import importlib
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import sys
+import tempfile
+import textwrap
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from snakemake_interface_software_deployment_plugins import (
+    DeployableEnvBase,
+    EnvSpecBase,
+    EnvSpecSourceFile,
+    ShellExecutable,
+)
+from snakemake_interface_software_deployment_plugins.registry import (
+    SoftwareDeploymentPluginRegistry,
+)
+from snakemake_interface_software_deployment_plugins.registry.descriptor import (
+    default_descriptor_cache_path,
+)
+from snakemake_interface_software_deployment_plugins.settings import CommonSettings
+
+# This module acts as a synthetic software deployment plugin.
+common_settings = CommonSettings(provides="benchmark")
+
+
+class EnvSpec(EnvSpecBase):
+    def __init__(self, name: str, envfile: Optional[EnvSpecSourceFile] = None):
+        super().__init__()
+        self.name = name
+        self.envfile = envfile
+
+    @classmethod
+    def identity_attributes(cls) -> Iterable[str]:
+        yield "name"
+        yield "envfile"
+
+    @classmethod
+    def source_path_attributes(cls) -> Iterable[str]:
+        yield "envfile"
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class Env(DeployableEnvBase):
+    spec: EnvSpec
+
+    def decorate_shellcmd(self, cmd: str) -> str:
+        return f"activate {self.spec.name} && {cmd}"
+
+    def contains_executable(self, executable: str) -> bool:
+        return False
+
+    def record_hash(self, hash_object) -> None:
+        hash_object.update(self.spec.name.encode())
+        if self.spec.envfile is not None:
+            with open(self.spec.envfile.path_or_uri, "rb") as f:
+                hash_object.update(f.read())
+
+    def report_software(self):
+        return ()
+
+    def is_hash_indexable(self) -> bool:
+        # measure the actual hashing, not the persistent index
+        return False
+
+    def is_deployment_path_portable(self) -> bool:
+        return False
+
+    async def deploy(self) -> None:
+        pass
+
+    def remove(self) -> None:
+        pass
+
+
+_PLUGIN_TEMPLATE = textwrap.dedent(
+    """
+    from snakemake_interface_software_deployment_plugins import EnvBase, EnvSpecBase
+    from snakemake_interface_software_deployment_plugins.settings import (
+        CommonSettings,
+    )
+
+    common_settings = CommonSettings(provides="{kind}")
+
+
+    class EnvSpec(EnvSpecBase):
+        @classmethod
+        def identity_attributes(cls):
+            return ()
+
+        @classmethod
+        def source_path_attributes(cls):
+            return ()
+
+        def __str__(self):
+            return "{kind}"
+
+
+    class Env(EnvBase):
+        def decorate_shellcmd(self, cmd):
+            return cmd
+
+        def contains_executable(self, executable):
+            return False
+
+        def record_hash(self, hash_object):
+            pass
+
+        def report_software(self):
+            return ()
+    """
+)
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    params: Dict[str, Any]
+    # number of operations per repetition
+    ops: int
+    repeat: int
+    min_s: float
+    median_s: float
+    per_op_s: float
+
+
+def measure(
+    name: str,
+    params: Dict[str, Any],
+    ops: int,
+    run: Callable[[], None],
+    repeat: int,
+    setup: Optional[Callable[[], None]] = None,
+) -> BenchmarkResult:
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return BenchmarkResult(
+        name=name,
+        params=params,
+        ops=ops,
+        repeat=repeat,
+        min_s=best,
+        median_s=statistics.median(timings),
+        per_op_s=best / ops,
+    )
+
+
+def make_spec(
+    name: str, depth: int = 0, envfile: Optional[EnvSpecSourceFile] = None
+) -> EnvSpec:
+    """Return a spec with within and fallback chains of the given depth."""
+    spec = EnvSpec(name, envfile=envfile)
+    spec.technical_init()
+    if depth > 0:
+        spec.within = make_spec(f"{name}-within", depth - 1, envfile=envfile)
+        spec.fallback = make_spec(f"{name}-fallback", depth - 1, envfile=envfile)
+    return spec
+
+
+def make_env(spec: EnvSpec, tmpdir: Path, within: Optional[Env] = None) -> Env:
+    return Env(
+        spec=spec,
+        within=within,
+        settings=None,
+        shell_executable=ShellExecutable("bash", command_arg="-c"),
+        mountpoints=[],
+        tempdir=tmpdir / "temp",
+        cache_prefix=tmpdir / "cache",
+        deployment_prefix=tmpdir / "deployments",
+        pinfile_prefix=tmpdir / "pinfiles",
+    )
+
+
+def bench_spec_hash(specs: int, depth: int, repeat: int) -> List[BenchmarkResult]:
+    params = {"specs": specs, "depth": depth}
+    items = [make_spec(f"spec{i}", depth) for i in range(specs)]
+    fresh: List[EnvSpec] = []
+
+    def copy_specs():
+        fresh[:] = [copy(spec) for spec in items]
+
+    def hash_all(specs):
+        for spec in specs:
+            hash(spec)
+
+    return [
+        measure(
+            "spec_hash_first",
+            params,
+            specs,
+            lambda: hash_all(fresh),
+            repeat,
+            setup=copy_specs,
+        ),
+        measure("spec_hash_repeated", params, specs, lambda: hash_all(items), repeat),
+    ]
+
+
+def bench_spec_eq(specs: int, depth: int, repeat: int) -> List[BenchmarkResult]:
+    params = {"specs": specs, "depth": depth}
+    left = [make_spec(f"spec{i}", depth) for i in range(specs)]
+    right = [make_spec(f"spec{i}", depth) for i in range(specs)]
+    different = [make_spec(f"other{i}", depth) for i in range(specs)]
+
+    def compare(others):
+        for a, b in zip(left, others):
+            a == b  # noqa: B015
+
+    return [
+        measure("spec_eq_equal", params, specs, lambda: compare(right), repeat),
+        measure("spec_eq_different", params, specs, lambda: compare(different), repeat),
+    ]
+
+
+def bench_modify_source_paths(
+    specs: int, depth: int, repeat: int
+) -> List[BenchmarkResult]:
+    params = {"specs": specs, "depth": depth}
+    items = [
+        make_spec(f"spec{i}", depth, envfile=EnvSpecSourceFile(f"envs/{i}.yaml"))
+        for i in range(specs)
+    ]
+
+    def modify():
+        for spec in items:
+            spec.modify_source_paths(
+                lambda source_file: EnvSpecSourceFile(
+                    os.path.join("workflow", str(source_file.path_or_uri))
+                )
+            )
+
+    return [measure("modify_source_paths", params, specs, modify, repeat)]
+
+
+def bench_env_hash(
+    specs: int, source_size: int, tmpdir: Path, repeat: int
+) -> List[BenchmarkResult]:
+    params = {"specs": specs, "source_size": source_size}
+    envfile = tmpdir / f"env-{source_size}.yaml"
+    envfile.write_bytes(os.urandom(source_size))
+    envs = [
+        make_env(make_spec(f"spec{i}", envfile=EnvSpecSourceFile(envfile)), tmpdir)
+        for i in range(specs)
+    ]
+
+    def clear():
+        for env in envs:
+            env.clear_hashes()
+
+    def hash_all():
+        for env in envs:
+            env.hash()
+
+    def deployment_hash_all():
+        for env in envs:
+            env.deployment_hash()
+
+    return [
+        measure("env_hash", params, specs, hash_all, repeat, setup=clear),
+        measure(
+            "env_deployment_hash",
+            params,
+            specs,
+            deployment_hash_all,
+            repeat,
+            setup=clear,
+        ),
+    ]
+
+
+def bench_decorate_shellcmd(
+    specs: int, depth: int, tmpdir: Path, repeat: int
+) -> List[BenchmarkResult]:
+    params = {"specs": specs, "depth": depth}
+    envs = []
+    for i in range(specs):
+        env = None
+        for level in range(depth + 1):
+            env = make_env(make_spec(f"spec{i}-{level}"), tmpdir, within=env)
+        assert env is not None
+        envs.append(env)
+
+    def decorate():
+        for env in envs:
+            env.managed_decorate_shellcmd("echo hello")
+
+    def decorate_compiled():
+        for env in envs:
+            env.compile_shellcmd().render("echo hello")
+
+    cmds = [f"echo job{i}" for i in range(specs)]
+
+    def decorate_batch():
+        envs[0].managed_decorate_shellcmds(cmds)
+
+    return [
+        measure("decorate_shellcmd", params, specs, decorate, repeat),
+        measure("decorate_shellcmd_compiled", params, specs, decorate_compiled, repeat),
+        measure("decorate_shellcmds_batch", params, specs, decorate_batch, repeat),
+    ]
+
+
+def bench_source_file_hash(
+    specs: int, source_size: int, tmpdir: Path, repeat: int
+) -> List[BenchmarkResult]:
+    params = {"specs": specs, "source_size": source_size}
+    path = tmpdir / f"source-{source_size}.yaml"
+    path.write_bytes(os.urandom(source_size))
+    source_files = [EnvSpecSourceFile(path) for _ in range(specs)]
+
+    def hash_objects():
+        for source_file in source_files:
+            hash(source_file)
+
+    def hash_content():
+        for source_file in source_files:
+            local_path = source_file.local_path()
+            assert local_path is not None
+            with open(local_path, "rb") as f:
+                hashlib.md5(f.read(), usedforsecurity=False).hexdigest()
+
+    return [
+        measure("source_file_hash", params, specs, hash_objects, repeat),
+        measure("source_file_content_hash", params, specs, hash_content, repeat),
+    ]
+
+
+def bench_registry(plugins: int, tmpdir: Path, repeat: int) -> List[BenchmarkResult]:
+    params = {"plugins": plugins}
+    plugin_dir = tmpdir / f"plugins-{plugins}"
+    names = [
+        f"snakemake_software_deployment_plugin_benchmark{i}" for i in range(plugins)
+    ]
+    for i, name in enumerate(names):
+        package = plugin_dir / name
+        package.mkdir(parents=True)
+        (package / "__init__.py").write_text(
+            _PLUGIN_TEMPLATE.format(kind=f"benchmark{i}")
+        )
+    sys.path.insert(0, str(plugin_dir))
+    # use a private plugin descriptor cache
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = str(tmpdir / f"cache-home-{plugins}")
+
+    def reset():
+        # force a fresh discovery of all plugins
+        for name in names:
+            sys.modules.pop(name, None)
+        importlib.invalidate_caches()
+        SoftwareDeploymentPluginRegistry._instance = None
+
+    def reset_uncached():
+        reset()
+        default_descriptor_cache_path().unlink(missing_ok=True)
+
+    def load():
+        SoftwareDeploymentPluginRegistry()
+
+    try:
+        return [
+            measure(
+                "registry_load_uncached",
+                params,
+                plugins,
+                load,
+                repeat,
+                setup=reset_uncached,
+            ),
+            measure("registry_load_cached", params, plugins, load, repeat, setup=reset),
+        ]
+    finally:
+        sys.path.remove(str(plugin_dir))
+        if cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+        reset()
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--specs", type=_int_list, default=[10, 100, 1000])
+    parser.add_argument("--depths", type=_int_list, default=[0, 2, 4, 8])
+    parser.add_argument(
+        "--source-sizes", type=_int_list, default=[1024, 64 * 1024, 1024 * 1024]
+    )
+    parser.add_argument("--plugins", type=_int_list, default=[1, 10, 50])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--output", type=Path, help="Write results as JSON to this file."
+    )
+    args = parser.parse_args(argv)
+
+    results: List[BenchmarkResult] = []
+    with tempfile.TemporaryDirectory(prefix="snakemake-benchmark-") as tmp:
+        tmpdir = Path(tmp)
+        for specs in args.specs:
+            for depth in args.depths:
+                # chains grow exponentially with depth, keep it bounded
+                if specs * 2**depth > 2**20:
+                    continue
+                results.extend(bench_spec_hash(specs, depth, args.repeat))
+                results.extend(bench_spec_eq(specs, depth, args.repeat))
+                results.extend(bench_modify_source_paths(specs, depth, args.repeat))
+                results.extend(
+                    bench_decorate_shellcmd(specs, depth, tmpdir, args.repeat)
+                )
+            for source_size in args.source_sizes:
+                results.extend(bench_env_hash(specs, source_size, tmpdir, args.repeat))
+                results.extend(
+                    bench_source_file_hash(specs, source_size, tmpdir, args.repeat)
+                )
+        for plugins in args.plugins:
+            results.extend(bench_registry(plugins, tmpdir, args.repeat))
+
+    for result in results:
+        params = " ".join(f"{key}={value}" for key, value in result.params.items())
+        print(
+            f"{result.name:<28} {params:<32} {result.per_op_s * 1e6:12.3f} us/op",
+            file=sys.stderr,
+        )
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "results": [asdict(result) for result in results],
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,12 @@
+import asyncio
+import json
 import tempfile
 import os
+import signal
+import threading
+import time
+import uuid
+import weakref
 
 __author__ = "Johannes Köster"
 __copyright__ = "Copyright 2024, Johannes Köster"
@@ -10,28 +17,64 @@ from abc import ABC, abstractmethod
 from copy import copy
 from inspect import getmodule
 from dataclasses import dataclass, field
+from enum import Enum
 import hashlib
 from pathlib import Path
+import shlex
 import shutil
 from types import ModuleType
 from typing import (
     Any,
-    ClassVar,
     Dict,
+    FrozenSet,
     Iterable,
     List,
     Optional,
     Self,
-    Tuple,
     Type,
     Union,
     Callable,
+    Concatenate,
+    overload,
 )
 import subprocess as sp
 
 from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_common.software import SoftwareReport
 
+from snakemake_interface_software_deployment_plugins import instrumentation
+from snakemake_interface_software_deployment_plugins._cas import (
+    ContentAddressedStore,
+    link_or_copy,
+)
+from snakemake_interface_software_deployment_plugins._common import (
+    deployment_staging_infix,
+    distribution_version,
+)
+from snakemake_interface_software_deployment_plugins._hash_index import HashIndex
+from snakemake_interface_software_deployment_plugins._integrity import (
+    AssetManifest,
+    DeploymentManifest,
+    digest,
+    stat_summary,
+)
+from snakemake_interface_software_deployment_plugins._locking import FileLock
+from snakemake_interface_software_deployment_plugins._memoize import (
+    P,
+    R,
+    T,
+    Memoized,
+    default_key,
+)
+from snakemake_interface_software_deployment_plugins._shell_pool import (
+    ShellWorkerPool,
+)
+from snakemake_interface_software_deployment_plugins.garbage_collection import (
+    Lease,
+    record_usage,
+)
+from snakemake_interface_software_deployment_plugins.layout import LayoutMarker
+
 
 @dataclass
 class SuffixReplacement:
@@ -53,6 +96,46 @@ class EnvSpecSourceFile:
     def __hash__(self) -> int:
         return hash(self.path_or_uri)
 
+    def local_path(self) -> Optional[Path]:
+        """Return the local path of the source file, or None if it is not
+        (yet) available locally.
+        """
+        if self.cached is not None:
+            return self.cached
+        if self.suffix_replacement is not None or "://" in str(self.path_or_uri):
+            return None
+        return Path(self.path_or_uri)
+
+    def replaced_path_or_uri(self) -> str:
+        """Return the path or URI with the suffix replacement applied (if
+        any).
+        """
+        path_or_uri = str(self.path_or_uri)
+        if self.suffix_replacement is None:
+            return path_or_uri
+        for suffix in self.suffix_replacement.old_suffixes:
+            if path_or_uri.endswith(suffix):
+                return path_or_uri[: -len(suffix)] + self.suffix_replacement.new_suffix
+        raise ValueError(
+            f"Path {path_or_uri} does not end with any of the suffixes "
+            f"{self.suffix_replacement.old_suffixes}"
+        )
+
+    def interned(self) -> "EnvSpecSourceFile":
+        """Return the canonical instance of all source files with the same path
+        or URI, suffix replacement and cached path (see EnvSpecBase.interned).
+        """
+        return _intern(_interned_source_files, self._intern_key(), self)
+
+    def _intern_key(self) -> Any:
+        replacement = self.suffix_replacement
+        return (
+            self.path_or_uri,
+            tuple(replacement.old_suffixes) if replacement is not None else None,
+            replacement.new_suffix if replacement is not None else None,
+            self.cached,
+        )
+
     def replace_suffix(
         self, suffixes: List[str], new_suffix: str
     ) -> "EnvSpecSourceFile":
@@ -66,6 +149,35 @@ class EnvSpecSourceFile:
         )
 
 
+_CHAINED_SPEC_ATTRIBUTES = frozenset(("within", "fallback"))
+_SPEC_BOOKKEEPING_ATTRIBUTES = frozenset(
+    ("_obj_hash", "_chain_hash", "_interned", "_chaining_specs")
+)
+
+
+_interned_specs: "weakref.WeakValueDictionary[Any, EnvSpecBase]" = (
+    weakref.WeakValueDictionary()
+)
+_interned_source_files: "weakref.WeakValueDictionary[Any, EnvSpecSourceFile]" = (
+    weakref.WeakValueDictionary()
+)
+_interning_lock = threading.Lock()
+
+
+def _intern(pool: weakref.WeakValueDictionary, key: Any, obj: Any) -> Any:
+    with _interning_lock:
+        canonical = pool.get(key)
+        # the canonical instance might have been modified in the meantime
+        if (
+            canonical is not None
+            and canonical._intern_key() == key
+            and canonical == obj
+        ):
+            return canonical
+        pool[key] = obj
+        return obj
+
+
 class EnvSpecBase(ABC):
     @classmethod
     def module(cls) -> ModuleType:
@@ -79,6 +191,7 @@ class EnvSpecBase(ABC):
         self.fallback: Optional["EnvSpecBase"] = None
         self.kind: str = self.module().common_settings.provides
         self._obj_hash: Optional[int] = None
+        self._intern_source_files()
 
     @classmethod
     def env_cls(cls) -> Type["EnvBase"]:
@@ -120,8 +233,45 @@ class EnvSpecBase(ABC):
         return False
 
     def modify_source_paths(self, modify_func: Callable) -> Self:
+        """Return a copy of the spec with modify_func applied to all source
+        paths (including those of within and fallback specs). The copy is
+        private to the caller, use interned() on it in order to share it with
+        identical specs.
+        """
         return self._modify_attributes("source_path_attributes", modify_func)
 
+    def interned(self) -> Self:
+        """Return the canonical instance of all specs that are equal to this
+        one (including within and fallback), such that identical specs (e.g.
+        of different rules) are represented by the same object. Canonical
+        instances are held via weak references and must not be modified
+        anymore.
+        """
+        if self.__dict__.get("_interned"):
+            return self
+        self._intern_source_files()
+        for attr in _CHAINED_SPEC_ATTRIBUTES:
+            value = getattr(self, attr, None)
+            if value is not None:
+                canonical = value.interned()
+                if canonical is not value:
+                    setattr(self, attr, canonical)
+        canonical = _intern(_interned_specs, self._intern_key(), self)
+        if canonical is self:
+            object.__setattr__(self, "_interned", True)
+        return canonical
+
+    def _intern_key(self) -> Any:
+        return (self.__class__, hash(self))
+
+    def _intern_source_files(self) -> None:
+        for attr in self.source_path_attributes():
+            value = getattr(self, attr, None)
+            if isinstance(value, EnvSpecSourceFile):
+                canonical = value.interned()
+                if canonical is not value:
+                    setattr(self, attr, canonical)
+
     def modify_identity_attributes(self, modify_func: Callable) -> Self:
         return self._modify_attributes("identity_attributes", modify_func)
 
@@ -151,8 +301,9 @@ class EnvSpecBase(ABC):
 
     def __or__(self, other: "EnvSpecBase") -> "EnvSpecBase":
         copied = copy(self)
-        copied.fallback = other
-        copied._obj_hash = None
+        # append to the end of the chain, such that a | b | c falls back from a
+        # to b and from b to c
+        copied.fallback = other if self.fallback is None else self.fallback | other
         return copied
 
     @classmethod
@@ -162,13 +313,111 @@ class EnvSpecBase(ABC):
         yield "within"
         yield "fallback"
 
-    def __hash__(self) -> int:
-        return hash(
-            tuple(getattr(self, attr) for attr in self.managed_identity_attributes())
+    def __setattr__(self, name: str, value: Any) -> None:
+        # Any assignment (also by _modify_attributes or __or__ on a copy)
+        # invalidates the cached hashes and the canonical status. In-place modifications of attribute
+        # values are not detected, hence attribute values should be immutable.
+        object.__setattr__(self, name, value)
+        if name not in _SPEC_BOOKKEEPING_ATTRIBUTES:
+            object.__setattr__(self, "_obj_hash", None)
+            object.__setattr__(self, "_interned", False)
+            if name in _CHAINED_SPEC_ATTRIBUTES and isinstance(value, EnvSpecBase):
+                value._register_chaining_spec(self)
+            self._invalidate_chain_hash()
+
+    def _register_chaining_spec(self, spec: "EnvSpecBase") -> None:
+        # Weakly remember the given spec that has this one as within or fallback
+        # spec, such that its cached hash can be invalidated along with ours.
+        chaining_specs: Dict[int, weakref.ref] = self.__dict__.setdefault(
+            "_chaining_specs", {}
         )
+        key = id(spec)
+
+        def forget(ref: weakref.ref) -> None:
+            if chaining_specs.get(key) is ref:
+                del chaining_specs[key]
+
+        chaining_specs[key] = weakref.ref(spec, forget)
+
+    def _invalidate_chain_hash(self) -> None:
+        """Drop the cached hash of this spec and of all specs that (indirectly)
+        chain to it.
+        """
+        pending = [self]
+        seen = set()
+        while pending:
+            spec = pending.pop()
+            if id(spec) in seen:
+                continue
+            seen.add(id(spec))
+            spec.__dict__.pop("_chain_hash", None)
+            chaining_specs = spec.__dict__.get("_chaining_specs", {})
+            for key, ref in list(chaining_specs.items()):
+                chaining = ref()
+                if chaining is None or not any(
+                    chaining.__dict__.get(attr) is spec
+                    for attr in _CHAINED_SPEC_ATTRIBUTES
+                ):
+                    # gone or chaining to another spec meanwhile
+                    chaining_specs.pop(key, None)
+                else:
+                    pending.append(chaining)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Cached hashes, the canonical status and the back-references of
+        # chained specs are only valid within this process, hence they are not
+        # pickled (or copied).
+        return {
+            name: value
+            for name, value in self.__dict__.items()
+            if name not in _SPEC_BOOKKEEPING_ATTRIBUTES
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        for attr in _CHAINED_SPEC_ATTRIBUTES:
+            value = state.get(attr)
+            if isinstance(value, EnvSpecBase):
+                value._register_chaining_spec(self)
+
+    def _own_hash(self) -> int:
+        """Return the (cached) hash of the identity attributes of this spec,
+        without the within and fallback specs.
+        """
+        own_hash = self.__dict__.get("_obj_hash")
+        if own_hash is None:
+            # the class is identified by its name, since hashes of class objects
+            # are based on their memory address
+            own_hash = hash(
+                (self.__class__.__module__, self.__class__.__qualname__)
+                + tuple(
+                    getattr(self, attr)
+                    for attr in self.managed_identity_attributes()
+                    if attr not in _CHAINED_SPEC_ATTRIBUTES
+                )
+            )
+            object.__setattr__(self, "_obj_hash", own_hash)
+        return own_hash
+
+    def __hash__(self) -> int:
+        chain_hash = self.__dict__.get("_chain_hash")
+        if chain_hash is None:
+            chain_hash = hash(
+                (
+                    self._own_hash(),
+                    getattr(self, "within", None),
+                    getattr(self, "fallback", None),
+                )
+            )
+            object.__setattr__(self, "_chain_hash", chain_hash)
+        return chain_hash
 
     def __eq__(self, other) -> bool:
-        return self.__class__ == other.__class__ and all(
+        if self is other:
+            return True
+        if self.__class__ != other.__class__ or hash(self) != hash(other):
+            return False
+        return all(
             getattr(self, attr) == getattr(other, attr)
             for attr in self.managed_identity_attributes()
         )
@@ -179,11 +428,19 @@ class EnvSpecBase(ABC):
         ...
 
 
+_shell_pool_lock = threading.Lock()
+
+
 @dataclass
 class ShellExecutable:
     executable: str
     command_arg: str
     args: List[str] = field(default_factory=list)
+    # maximum number of long-lived shell processes used by run_pooled()
+    pool_size: int = field(default=4, compare=False, repr=False)
+    _pool: Optional[ShellWorkerPool] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @property
     def name(self) -> str:
@@ -192,10 +449,273 @@ class ShellExecutable:
     def run(self, cmd: str, **kwargs) -> sp.CompletedProcess:
         return sp.run([self.executable] + self.args + [self.command_arg, cmd], **kwargs)
 
+    def run_pooled(
+        self,
+        cmd: str,
+        text: bool = False,
+        check: bool = False,
+        timeout: Optional[float] = None,
+    ) -> sp.CompletedProcess:
+        """Run given command in one of a pool of long-lived shell processes,
+        thereby avoiding the startup costs (e.g. login scripts) of a new
+        shell per command. Each command runs in its own subshell, hence the
+        environment is reset between commands. Stdout and stderr are always
+        captured. This requires a POSIX compatible shell.
+        """
+        pool = self._pool
+        if pool is None:
+            with _shell_pool_lock:
+                pool = self._pool
+                if pool is None:
+                    pool = ShellWorkerPool(
+                        [self.executable] + self.args, size=self.pool_size
+                    )
+                    # terminate the shells once the executable is gone
+                    weakref.finalize(self, pool.close)
+                    self._pool = pool
+        returncode, stdout, stderr = pool.run(cmd, timeout=timeout)
+        res: sp.CompletedProcess[Any]
+        if text:
+            res = sp.CompletedProcess(cmd, returncode, stdout.decode(), stderr.decode())
+        else:
+            res = sp.CompletedProcess(cmd, returncode, stdout, stderr)
+        if check:
+            res.check_returncode()
+        return res
+
+    async def run_async(
+        self,
+        cmd: str,
+        timeout: Optional[float] = None,
+        stdout_callback: Optional[Callable[[bytes], None]] = None,
+        stderr_callback: Optional[Callable[[bytes], None]] = None,
+        check: bool = False,
+    ) -> sp.CompletedProcess:
+        """Run given command as an asyncio subprocess, without blocking the
+        event loop.
+
+        Stdout and stderr are captured and in addition passed chunk-wise to the
+        given callbacks while the command runs. If the timeout (in seconds) is
+        exceeded or the calling task is cancelled, the whole process tree
+        spawned by the command is killed.
+        """
+        process = await asyncio.create_subprocess_exec(
+            self.executable,
+            *self.args,
+            self.command_arg,
+            cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        stdout: List[bytes] = []
+        stderr: List[bytes] = []
+
+        async def collect(stream, chunks, callback) -> None:
+            while chunk := await stream.read(65536):
+                chunks.append(chunk)
+                if callback is not None:
+                    callback(chunk)
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    collect(process.stdout, stdout, stdout_callback),
+                    collect(process.stderr, stderr, stderr_callback),
+                    process.wait(),
+                ),
+                timeout,
+            )
+        except TimeoutError:
+            # only raised by wait_for if a timeout is given
+            assert timeout is not None
+            _kill_process_group(process.pid)
+            await process.wait()
+            raise sp.TimeoutExpired(
+                cmd, timeout, output=b"".join(stdout), stderr=b"".join(stderr)
+            )
+        except asyncio.CancelledError:
+            _kill_process_group(process.pid)
+            # reap the killed process before propagating the cancellation, so
+            # that neither a zombie nor a dangling transport is left behind
+            await asyncio.shield(process.wait())
+            raise
+        assert process.returncode is not None
+        res = sp.CompletedProcess(
+            cmd, process.returncode, b"".join(stdout), b"".join(stderr)
+        )
+        if check:
+            res.check_returncode()
+        return res
+
+
+# Variables that are maintained by the shell itself or are not exportable.
+_ACTIVATION_IGNORED_VARIABLES = {"_", "SHLVL", "PWD", "OLDPWD"}
+# Variables holding lists of paths (besides those ending with PATH). Changes of
+# these are replayed relative to their value at the time of use.
+_ACTIVATION_PATH_LIST_VARIABLES = {"XDG_DATA_DIRS", "XDG_CONFIG_DIRS", "PERL5LIB"}
+
+
+def _parse_env_output(output: bytes) -> Dict[str, str]:
+    variables = {}
+    for entry in output.decode(errors="surrogateescape").split("\0"):
+        name, sep, value = entry.partition("=")
+        if not sep or not name.isidentifier() or name in _ACTIVATION_IGNORED_VARIABLES:
+            # also skips exported shell functions (BASH_FUNC_name%%)
+            continue
+        variables[name] = value
+    return variables
+
+
+def _is_path_list_variable(name: str) -> bool:
+    return name.endswith("PATH") or name in _ACTIVATION_PATH_LIST_VARIABLES
+
+
+def _path_list_delta(before: str, after: str) -> Optional[Dict[str, List[str]]]:
+    """Return the entries that have been prepended and appended to the path
+    list before in order to obtain after, or None if after is not an extension
+    of before.
+    """
+    before_entries = before.split(os.pathsep) if before else []
+    after_entries = after.split(os.pathsep) if after else []
+    n = len(before_entries)
+    for i in range(len(after_entries) - n + 1):
+        if after_entries[i : i + n] == before_entries:
+            return {"prepend": after_entries[:i], "append": after_entries[i + n :]}
+    return None
+
+
+def _path_list_export(name: str, delta: Dict[str, List[str]]) -> str:
+    prepend = shlex.quote(os.pathsep.join(delta["prepend"]))
+    append = shlex.quote(os.pathsep.join(delta["append"]))
+    if delta["prepend"] and delta["append"]:
+        value = f'{prepend}"${{{name}:+{os.pathsep}${name}}}"{os.pathsep}{append}'
+    elif delta["prepend"]:
+        value = f'{prepend}"${{{name}:+{os.pathsep}${name}}}"'
+    elif delta["append"]:
+        value = f'"${{{name}:+${name}{os.pathsep}}}"{append}'
+    else:
+        return ""
+    return f"export {name}={value}; "
+
+
+def _write_atomically(path: Path, content: str) -> None:
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{path.name}.", suffix=".part", dir=path.parent
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def _remove_path(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _kill_process_group(pid: int) -> None:
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
 
-class EnvBase(ABC):
-    _cache: ClassVar[Dict[Tuple[Type["EnvBase"], Optional["EnvBase"]], Any]] = {}
 
+class ShellCmdTemplate:
+    """Decoration of shell commands by an environment (including its within
+    chain), compiled once into a fixed prefix and suffix around the command.
+
+    The command is inserted either verbatim or within single quotes as done by
+    shlex.quote (possibly nested, e.g. for bash -c within a container), in
+    which case quoting is the number of nested quotes and the quote characters
+    themselves are part of prefix and suffix. Commands that shlex.quote would
+    leave as they are are quoted nevertheless, which is equivalent for the
+    shell. If the decoration cannot be expressed like this, the template falls
+    back to calling the given decorate function.
+    """
+
+    def __init__(
+        self,
+        prefix: str = "",
+        suffix: str = "",
+        quoting: int = 0,
+        fallback: Optional[Callable[[str], str]] = None,
+    ) -> None:
+        self.prefix = prefix
+        self.suffix = suffix
+        self.quoting = quoting
+        self.fallback = fallback
+
+    @property
+    def is_compiled(self) -> bool:
+        return self.fallback is None
+
+    @classmethod
+    def compile(
+        cls, decorate: Callable[[str], str], max_quoting: int = 1
+    ) -> "ShellCmdTemplate":
+        """Compile the given decorate function by decorating a sentinel command.
+
+        The sentinel contains single quotes, such that its representation in
+        the decorated command reveals how often it has been quoted. The result is verified with a second, different
+        sentinel. In case of any ambiguity, a fallback template is returned.
+        """
+        fallback = cls(fallback=decorate)
+        token = uuid.uuid4().hex
+        sentinels = [
+            f"snakemake-cmd-{token} 'a' \"b\"",
+            f"snakemake-cmd-{token[::-1]} $c; `d` \\e",
+        ]
+        decorated = decorate(sentinels[0])
+        matches = []
+        representation = sentinels[0]
+        for quoting in range(max_quoting + 1):
+            if decorated.count(representation) == 1:
+                matches.append((quoting, representation))
+            representation = _escape_single_quotes(representation)
+        if len(matches) != 1:
+            return fallback
+        quoting, representation = matches[0]
+        prefix, suffix = decorated.split(representation)
+        template = cls(prefix, suffix, quoting)
+        if template.render(sentinels[1]) != decorate(sentinels[1]):
+            # the decoration depends on the command in some other way
+            return fallback
+        return template
+
+    def render(self, cmd: str) -> str:
+        if self.fallback is not None:
+            return self.fallback(cmd)
+        for _ in range(self.quoting):
+            cmd = _escape_single_quotes(cmd)
+        return f"{self.prefix}{cmd}{self.suffix}"
+
+    def render_all(self, cmds: Iterable[str]) -> List[str]:
+        if self.fallback is not None:
+            return [self.fallback(cmd) for cmd in cmds]
+        prefix, suffix, quoting = self.prefix, self.suffix, self.quoting
+        if quoting == 0:
+            return [f"{prefix}{cmd}{suffix}" for cmd in cmds]
+        if quoting == 1:
+            escape = _escape_single_quotes
+            return [f"{prefix}{escape(cmd)}{suffix}" for cmd in cmds]
+        return [self.render(cmd) for cmd in cmds]
+
+
+# how shlex.quote represents a single quote within single quotes
+_ESCAPED_SINGLE_QUOTE = "'\"'\"'"
+
+
+def _escape_single_quotes(cmd: str) -> str:
+    return cmd.replace("'", _ESCAPED_SINGLE_QUOTE)
+
+
+class EnvBase(ABC):
     def __init__(
         self,
         spec,
@@ -220,6 +740,7 @@ class EnvBase(ABC):
         self._pinfile_prefix: Path = pinfile_prefix
         self._managed_hash_store: Optional[str] = None
         self._managed_deployment_hash_store: Optional[str] = None
+        self._shellcmd_template_store: Optional[ShellCmdTemplate] = None
         self._obj_hash: Optional[int] = None
         self.__post_init__()
 
@@ -228,20 +749,63 @@ class EnvBase(ABC):
         pass
 
     @staticmethod
-    def once(func):
+    def once(func: Callable[Concatenate[T, P], R]) -> Memoized[T, P, R]:
         """Decorator to cache the result of a method call that shall be only
         executed once per combination of plugin and "within" environment.
+        Works for both sync and async methods.
         """
+        return Memoized(
+            func,
+            maxsize=None,
+            key=lambda self, *args, **kwargs: (self.__class__, self.within),
+        )
 
-        def wrapper(self, *args, **kwargs):
-            key = (self.__class__, self.within)
-            if key in self._cache:
-                return self._cache[key]
-            value = func(self, *args, **kwargs)
-            self._cache[key] = value
-            return value
+    @overload
+    @staticmethod
+    def memoize(func: Callable[Concatenate[T, P], R]) -> Memoized[T, P, R]: ...
+
+    @overload
+    @staticmethod
+    def memoize(
+        func: None = None,
+        *,
+        maxsize: Optional[int] = 128,
+        ttl: Optional[float] = None,
+        key: Optional[Callable[..., Any]] = None,
+    ) -> Callable[[Callable[Concatenate[T, P], R]], Memoized[T, P, R]]: ...
 
-        return wrapper
+    @staticmethod
+    def memoize(
+        func: Any = None,
+        *,
+        maxsize: Optional[int] = 128,
+        ttl: Optional[float] = None,
+        key: Optional[Callable[..., Any]] = None,
+    ) -> Any:
+        """Decorator to cache the result of a (sync or async) method call per
+        environment and combination of arguments.
+
+        Concurrent calls with the same key share one computation. At most maxsize
+        results are kept (least recently used ones are evicted first), and results
+        expire after ttl seconds if given. The key can be customized by passing a
+        callable that takes the same arguments as the method (including self).
+        Entries can be dropped via the invalidate(*args, **kwargs) and
+        cache_clear() methods of the decorated method.
+
+        Can be used as @EnvBase.memoize or e.g. @EnvBase.memoize(ttl=60).
+        """
+
+        def decorator(func: Callable[Concatenate[T, P], R]) -> Memoized[T, P, R]:
+            return Memoized(
+                func,
+                maxsize=maxsize,
+                ttl=ttl,
+                key=key if key is not None else default_key,
+            )
+
+        if func is not None:
+            return decorator(func)
+        return decorator
 
     @abstractmethod
     def decorate_shellcmd(self, cmd: str) -> str:
@@ -253,6 +817,12 @@ class EnvBase(ABC):
     @abstractmethod
     def contains_executable(self, executable: str) -> bool: ...
 
+    def managed_contains_executable(self, executable: str) -> bool:
+        """Return whether the environment contains the given executable, using
+        an index of the executables if the environment provides one.
+        """
+        return self.contains_executable(executable)
+
     def is_deployable(self) -> bool:
         """Overwrite this in case the deployability of the environment depends on
         the spec or settings."""
@@ -268,6 +838,15 @@ class EnvBase(ABC):
         the spec or settings."""
         return isinstance(self, CacheableEnvBase)
 
+    def is_available(self) -> bool:
+        """Overwrite this in case the environment can only be used if something
+        is present on the current node, e.g. a container runtime or an env
+        module system. This is used to choose between the alternatives of a
+        fallback chain (see fallback.FallbackResolver) and may be called from a
+        worker thread.
+        """
+        return True
+
     @abstractmethod
     def record_hash(self, hash_object) -> None:
         """Update given hash object (using hash_object.update()) such that it changes
@@ -288,16 +867,54 @@ class EnvBase(ABC):
         """
         ...
 
-    def run_cmd(self, cmd: str, **kwargs) -> sp.CompletedProcess:
+    def run_cmd(self, cmd: str, pooled: bool = False, **kwargs) -> sp.CompletedProcess:
         """Run a command while potentially respecting the self.within environment,
         returning the result of subprocess.run.
 
         kwargs is passed to subprocess.run, shell=True is always set.
+        If pooled is True, the command is instead run via
+        ShellExecutable.run_pooled, which is much faster for short commands
+        (e.g. version checks) but only accepts the kwargs text, check and timeout.
         """
         assert "shell" not in kwargs, "shell argument has to be set to False"
         if self.within is not None:
             cmd = self.within.managed_decorate_shellcmd(cmd)
-        return self.shell_executable.run(cmd, **kwargs)
+        with self._span("run_cmd", cmd=cmd, pooled=pooled) as span:
+            if pooled:
+                res = self.shell_executable.run_pooled(cmd, **kwargs)
+            else:
+                res = self.shell_executable.run(cmd, **kwargs)
+            span.update(
+                outcome="success" if res.returncode == 0 else "failed",
+                returncode=res.returncode,
+            )
+        return res
+
+    async def run_cmd_async(self, cmd: str, **kwargs) -> sp.CompletedProcess:
+        """Run a command while potentially respecting the self.within environment,
+        without blocking the event loop. Use this in async methods like deploy(),
+        pin() or cache_asset() in order to allow for concurrent operations.
+
+        kwargs is passed to ShellExecutable.run_async (timeout, stdout_callback,
+        stderr_callback, check).
+        """
+        if self.within is not None:
+            cmd = self.within.managed_decorate_shellcmd(cmd)
+        with self._span("run_cmd", cmd=cmd, pooled=False) as span:
+            res = await self.shell_executable.run_async(cmd, **kwargs)
+            span.update(
+                outcome="success" if res.returncode == 0 else "failed",
+                returncode=res.returncode,
+            )
+        return res
+
+    def _span(self, operation: str, **attributes):
+        """Return a context manager that measures the given operation on this
+        environment (see instrumentation.span).
+        """
+        return instrumentation.span(
+            operation, getattr(self.spec, "kind", None), self.spec, **attributes
+        )
 
     def managed_decorate_shellcmd(self, cmd: str) -> str:
         cmd = self.decorate_shellcmd(cmd)
@@ -305,6 +922,46 @@ class EnvBase(ABC):
             cmd = self.within.managed_decorate_shellcmd(cmd)
         return cmd
 
+    def supports_shellcmd_template(self) -> bool:
+        """Return whether decorate_shellcmd only inserts the given command into
+        a string that does not depend on the command, either verbatim or quoted
+        via shlex.quote. Then, the decoration (including
+        the within chain) is compiled once (see compile_shellcmd) instead of
+        being rebuilt for every command. Compilation is verified and falls back
+        to decorating every command if the decoration is not of this kind.
+        Overwrite this and return False if decorate_shellcmd e.g. inspects the
+        command or has side effects.
+        """
+        return True
+
+    def compile_shellcmd(self) -> ShellCmdTemplate:
+        """Return a template that decorates commands like
+        managed_decorate_shellcmd, compiled once per environment.
+        """
+        if self._shellcmd_template_store is None:
+            env: Optional[EnvBase] = self
+            depth = 0
+            supported = True
+            while env is not None:
+                supported = supported and env.supports_shellcmd_template()
+                depth += 1
+                env = env.within
+            if supported:
+                template = ShellCmdTemplate.compile(
+                    self.managed_decorate_shellcmd, max_quoting=depth
+                )
+            else:
+                template = ShellCmdTemplate(fallback=self.managed_decorate_shellcmd)
+            self._shellcmd_template_store = template
+        return self._shellcmd_template_store
+
+    def managed_decorate_shellcmds(self, cmds: Iterable[str]) -> List[str]:
+        """Decorate all given commands (e.g. those of all jobs using the
+        environment) in one go, using the compiled template (see
+        compile_shellcmd).
+        """
+        return self.compile_shellcmd().render_all(cmds)
+
     def hash_include_within(self) -> bool:
         """Return whether the hash of the environment should also reflect the "within"
         environment. Usually, this should be the case, unless you have a particular
@@ -320,21 +977,94 @@ class EnvBase(ABC):
         self._managed_hash_store = None
         self._managed_deployment_hash_store = None
 
+    def is_hash_indexable(self) -> bool:
+        """Return whether the hashes of this environment may be persistently
+        indexed by the given source files (by their size, mtime, and inode),
+        the identity attributes of the spec, the settings, the within environment
+        and the deployment prefix. Overwrite this and return True if
+        record_hash and record_deployment_hash depend on nothing else (e.g. not
+        on files referenced from within the source files, pinfiles, or
+        environment variables).
+        """
+        return False
+
     def _managed_generic_hash(self, kind: str) -> str:
         store_attr = f"_managed_{kind}_store"
         store = getattr(self, store_attr)
         if store is None:
-            record_hash = f"record_{kind}"
-            hash_object = hashlib.md5(usedforsecurity=False)
-            if self.within is not None and self.hash_include_within():
-                # For within, we always take the normal hash,
-                # since the deployment just runs within that.
-                self.within.record_hash(hash_object)
-            getattr(self, record_hash)(hash_object)
-            store = hash_object.hexdigest()
+            with self._span(kind) as span:
+                index = HashIndex(self._cache_prefix / ".hash-index")
+                index_key = self._hash_index_key(kind)
+                if index_key is not None:
+                    store = index.get(index_key)
+                if store is None:
+                    record_hash = f"record_{kind}"
+                    hash_object = hashlib.md5(usedforsecurity=False)
+                    if self.within is not None and self.hash_include_within():
+                        # For within, we always take the normal hash,
+                        # since the deployment just runs within that.
+                        self.within.record_hash(hash_object)
+                    getattr(self, record_hash)(hash_object)
+                    store = hash_object.hexdigest()
+                    if index_key is not None:
+                        index.put(index_key, store)
+                    span.update(hash=store, indexed=False)
+                else:
+                    span.update(hash=store, indexed=True)
             setattr(self, store_attr, store)
         return store
 
+    def _hash_index_key(self, kind: str) -> Optional[str]:
+        """Return key of the persistent hash index, or None if the hash shall
+        not be indexed.
+
+        Indexing only pays off if source files have to be read for hashing.
+        """
+        if not self.is_hash_indexable():
+            return None
+        source_files = [
+            getattr(self.spec, attr) for attr in self.spec.source_path_attributes()
+        ]
+        source_files = [
+            source_file for source_file in source_files if source_file is not None
+        ]
+        if not source_files:
+            return None
+        module = self.__class__.__module__
+        parts = [
+            kind,
+            f"{module}.{self.__class__.__qualname__}",
+            # record_hash may change with the plugin version
+            str(distribution_version(module.split(".")[0])),
+            repr(self.settings),
+            str(self._deployment_prefix),
+        ]
+        layout = LayoutMarker.load(self._deployment_prefix).layout
+        if layout.is_sharded:
+            parts.append(layout.describe())
+        parts.extend(
+            repr(getattr(self.spec, attr)) for attr in self.spec.identity_attributes()
+        )
+        if self.within is not None and self.hash_include_within():
+            parts.append(self.within.hash())
+        now = time.time()
+        for source_file in source_files:
+            path = source_file.local_path()
+            if path is None:
+                return None
+            try:
+                stat = path.stat()
+            except OSError:
+                return None
+            if now - stat.st_mtime < 2:
+                # Modifications within the timestamp granularity of the file
+                # system might go unnoticed, hence do not index (yet).
+                return None
+            parts.append(
+                f"{path.absolute()}:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+            )
+        return HashIndex.key(parts)
+
     def __hash__(self) -> int:
         # take the hash of all fields by settings, _managed_hash_store and _managed_deployment_hash_store
         if self._obj_hash is None:
@@ -346,6 +1076,8 @@ class EnvBase(ABC):
 
 
 class PinnableEnvBase(EnvBase, ABC):
+    _pinfile_override: Optional[Path] = None
+
     @classmethod
     @abstractmethod
     def pinfile_extension(cls) -> str: ...
@@ -360,13 +1092,79 @@ class PinnableEnvBase(EnvBase, ABC):
 
     @property
     def pinfile(self) -> Path:
+        if self._pinfile_override is not None:
+            # currently pinning (see managed_pin)
+            return self._pinfile_override
+        return self._final_pinfile()
+
+    def _final_pinfile(self) -> Path:
         ext = self.pinfile_extension()
         if not ext.startswith("."):
             raise ValueError("pinfile_extension must start with a dot.")
-        return (self._pinfile_prefix / self.hash()).with_suffix(
-            self.pinfile_extension()
+        name = f"{self.hash()}{ext}"
+        return (
+            LayoutMarker.load(self._pinfile_prefix).entry_dir(
+                self._pinfile_prefix, name
+            )
+            / name
         )
 
+    def _pinfile_lock(self) -> Path:
+        # Always lock in the current layout, such that the lock is the same
+        # while the pinfile is migrated from a previous layout.
+        name = f"{self.hash()}{self.pinfile_extension()}"
+        layout = LayoutMarker.load(self._pinfile_prefix).layout
+        return layout.entry_dir(self._pinfile_prefix, name) / f"{name}.lock"
+
+    def has_pinfile(self) -> bool:
+        """Return whether a (complete) pinfile exists for the environment."""
+        try:
+            return self._final_pinfile().stat().st_size > 0
+        except OSError:
+            return False
+
+    async def managed_pin(self, force: bool = False) -> None:
+        """Pin the environment unless a pinfile already exists (or force is
+        True). The pinfile is written atomically, and concurrent pinning of the
+        same environment (also from other processes sharing the pinfile prefix)
+        is serialized, such that only the first one actually pins.
+        """
+        with self._span("pin", hash=self.hash()) as span:
+            # pick up migrations of the prefix by other processes right away
+            LayoutMarker.load(self._pinfile_prefix, refresh=True)
+            pinfile = self._final_pinfile()
+            if not force and self.has_pinfile():
+                record_usage(self._pinfile_prefix, pinfile.name)
+                span.update(outcome="skipped")
+                return
+            async with FileLock(self._pinfile_lock()):
+                # resolve again, the pinfile might have been migrated meanwhile
+                pinfile = self._final_pinfile()
+                pinfile.parent.mkdir(parents=True, exist_ok=True)
+                if not force and self.has_pinfile():
+                    span.update(outcome="skipped")
+                else:
+                    # let pin() write to a temporary file that is moved into place
+                    # afterwards, such that nobody observes an incomplete pinfile
+                    tmp_path = pinfile.with_name(
+                        f".{pinfile.name}.{uuid.uuid4().hex}.part"
+                    )
+                    self._pinfile_override = tmp_path
+                    try:
+                        await self.pin()
+                        if not tmp_path.exists():
+                            raise WorkflowError("No pinfile has been written.")
+                        span.update(bytes=tmp_path.stat().st_size)
+                        os.replace(tmp_path, pinfile)
+                    except Exception as e:
+                        raise WorkflowError(
+                            f"Pinning of {self.spec} failed: {e}"
+                        ) from e
+                    finally:
+                        self._pinfile_override = None
+                        tmp_path.unlink(missing_ok=True)
+            record_usage(self._pinfile_prefix, pinfile.name)
+
     def remove_pinfile(self) -> None:
         """Remove the pinfile."""
         if self.pinfile.exists():
@@ -378,6 +1176,26 @@ class PinnableEnvBase(EnvBase, ABC):
                 ) from e
 
 
+class CacheAssetStatus(Enum):
+    # asset was already present
+    SKIPPED = "skipped"
+    STARTED = "started"
+    # continuing a partially written asset
+    RESUMED = "resumed"
+    DONE = "done"
+    # linked from the content addressed store, without retrieval
+    LINKED = "linked"
+    FAILED = "failed"
+
+
+@dataclass
+class CacheAssetProgress:
+    asset: str
+    status: CacheAssetStatus
+    # number of bytes present so far (for RESUMED and DONE)
+    size: Optional[int] = None
+
+
 class CacheableEnvBase(EnvBase, ABC):
     async def get_cache_assets(self) -> Iterable[str]: ...
 
@@ -386,49 +1204,271 @@ class CacheableEnvBase(EnvBase, ABC):
         """Retrieve/create and store given asset to self.cache_path."""
         ...
 
-    async def managed_cache_asset(self, asset: str) -> None:
-        # The naming scheme used here follows the same pattern as rsync.
-        # This way, we benefit from rsync specific optimizations in network
-        # filtesystems like GlusterFS (see
-        # https://developers.redhat.com/blog/2018/08/14/improving-rsync-performance-with-glusterfs)
-        fd, tmp_cache_path = tempfile.mkstemp(
-            prefix=asset, suffix=".part", dir=self.cache_path
+    def is_cache_content_addressable(self) -> bool:
+        """Return whether cached assets shall be deduplicated across environments
+        by storing them only once per content (in a store below the cache prefix)
+        and exposing them via hardlinks, reflinks, or copies. Overwrite this to
+        return True if the assets are regular files that are never modified after
+        being cached.
+        """
+        return False
+
+    async def cache_asset_digest(self, asset: str) -> Optional[str]:
+        """Return the sha256 hexdigest of the given asset if it is known before
+        retrieving it (e.g. from a lockfile or a registry). With a content
+        addressable cache, this allows to skip retrieval of assets that are
+        already present in the store. Retrieved assets are checked against it.
+        """
+        return None
+
+    def supports_cache_asset_resume(self) -> bool:
+        """Return whether cache_asset is able to continue a partially written
+        file at to_path (e.g. via HTTP range requests), instead of writing it
+        from scratch. If so, a to_path that is left over from an interrupted
+        attempt is kept and passed to cache_asset again on the next attempt.
+        """
+        return False
+
+    async def managed_cache_assets(
+        self,
+        max_jobs: int = 4,
+        progress: Optional[Callable[[CacheAssetProgress], None]] = None,
+        thorough: bool = False,
+    ) -> None:
+        """Cache all assets of the environment, with at most max_jobs of them
+        being retrieved concurrently. Assets that are already present and pass
+        verification (see verify_cache_asset) are skipped. If given, progress
+        is called whenever an asset changes its status.
+        """
+        semaphore = asyncio.Semaphore(max_jobs)
+
+        async def cache(asset: str) -> None:
+            async with semaphore:
+                await self.managed_cache_asset(
+                    asset, progress=progress, thorough=thorough
+                )
+
+        results = await asyncio.gather(
+            *(cache(asset) for asset in await self.get_cache_assets()),
+            return_exceptions=True,
         )
-        os.close(fd)
-        tmp_cache_path = Path(tmp_cache_path)
-        cache_path = self.cache_path / asset
-        try:
-            await self.cache_asset(asset, tmp_cache_path)
-            os.replace(tmp_cache_path, cache_path)
-        except Exception as e:
-            if tmp_cache_path.exists():
+        errors = [res for res in results if isinstance(res, BaseException)]
+        if errors:
+            raise WorkflowError(
+                f"Caching of {len(errors)} assets of {self.spec} failed.", *errors
+            )
+
+    async def managed_cache_asset(
+        self,
+        asset: str,
+        progress: Optional[Callable[[CacheAssetProgress], None]] = None,
+        thorough: bool = False,
+    ) -> None:
+        """Cache given asset. If other processes are caching the same asset
+        at the same time, wait for them and reuse their result.
+
+        An already present asset is only reused if it passes verification
+        (see verify_cache_asset). Otherwise, it is retrieved again.
+        """
+
+        resumed_from = 0
+
+        def report(status: CacheAssetStatus, path: Optional[Path] = None) -> None:
+            nonlocal resumed_from
+            size = path.stat().st_size if path is not None else None
+            if status == CacheAssetStatus.RESUMED:
+                assert size is not None
+                resumed_from = size
+            elif status == CacheAssetStatus.DONE:
+                assert size is not None
+                span.update(bytes=size - resumed_from)
+            elif status in (CacheAssetStatus.SKIPPED, CacheAssetStatus.LINKED):
+                span.update(outcome=status.value)
+            if progress is not None:
+                progress(CacheAssetProgress(asset=asset, status=status, size=size))
+
+        with self._span("cache_asset", hash=self.hash(), asset=asset) as span:
+            cache_path = self.cache_path / asset
+            record_usage(self.cache_path, asset)
+            async with FileLock(self.cache_path / f"{asset}.lock"):
+                if cache_path.exists():
+                    # Assets are moved into place atomically, hence an existing
+                    # one is complete, unless it has been corrupted afterwards.
+                    store = self._content_addressed_store()
+                    if await asyncio.to_thread(
+                        self.verify_cache_asset, asset, thorough
+                    ):
+                        manifest = AssetManifest.load(self._cache_asset_manifest(asset))
+                        if store is not None and manifest is not None:
+                            # the asset might have been cached for another environment
+                            async with store.lock(manifest.sha256):
+                                store.add_ref(manifest.sha256, cache_path, self.hash())
+                        report(CacheAssetStatus.SKIPPED)
+                        return
+                    await self._remove_cache_asset(asset, corrupted=True)
+
+                store = self._content_addressed_store()
+                known_digest = await self.cache_asset_digest(asset)
+                if store is not None and known_digest is not None:
+                    async with store.lock(known_digest):
+                        if store.has(known_digest):
+                            self._store_cache_asset(asset, known_digest, store)
+                            report(CacheAssetStatus.LINKED, cache_path)
+                            return
+
+                resumable = self.supports_cache_asset_resume()
+                if resumable:
+                    # Use a deterministic name, such that a later attempt can
+                    # continue. We hold the lock, so nobody else writes to it.
+                    tmp_cache_path = self.cache_path / f"{asset}.part"
+                    if tmp_cache_path.exists() and tmp_cache_path.stat().st_size > 0:
+                        report(CacheAssetStatus.RESUMED, tmp_cache_path)
+                    else:
+                        tmp_cache_path.touch()
+                        report(CacheAssetStatus.STARTED)
+                else:
+                    # The naming scheme used here follows the same pattern as rsync.
+                    # This way, we benefit from rsync specific optimizations in network
+                    # filtesystems like GlusterFS (see
+                    # https://developers.redhat.com/blog/2018/08/14/improving-rsync-performance-with-glusterfs)
+                    fd, tmp_cache_path = tempfile.mkstemp(
+                        prefix=asset, suffix=".part", dir=self.cache_path
+                    )
+                    os.close(fd)
+                    tmp_cache_path = Path(tmp_cache_path)
+                    report(CacheAssetStatus.STARTED)
                 try:
-                    tmp_cache_path.unlink()
-                except Exception:
-                    pass
-            raise WorkflowError(f"Caching of {self.spec} failed: {e}") from e
+                    await self.cache_asset(asset, tmp_cache_path)
+                    # Hash right after writing, while the content is likely still
+                    # in the page cache.
+                    sha256 = await asyncio.to_thread(digest, tmp_cache_path)
+                    if known_digest is not None and sha256 != known_digest:
+                        if resumable:
+                            # do not resume from corrupted content
+                            tmp_cache_path.unlink()
+                        raise WorkflowError(
+                            f"Checksum mismatch for asset {asset}: expected "
+                            f"{known_digest}, got {sha256}."
+                        )
+                    if store is not None and tmp_cache_path.is_file():
+                        async with store.lock(sha256):
+                            store.add(tmp_cache_path, sha256)
+                            self._store_cache_asset(asset, sha256, store)
+                    else:
+                        os.replace(tmp_cache_path, cache_path)
+                        self._write_cache_asset_manifest(asset, sha256)
+                except Exception as e:
+                    if not resumable and tmp_cache_path.exists():
+                        try:
+                            tmp_cache_path.unlink()
+                        except Exception:
+                            pass
+                    report(CacheAssetStatus.FAILED)
+                    raise WorkflowError(f"Caching of {self.spec} failed: {e}") from e
+                report(CacheAssetStatus.DONE, cache_path)
 
     @property
     def cache_path(self) -> Path:
         return self._cache_prefix
 
+    def verify_cache_asset(self, asset: str, thorough: bool = False) -> bool:
+        """Return whether given asset is present and intact.
+
+        By default, only size and mtime are compared with the manifest that has
+        been recorded when the asset was cached. If thorough is True, the content
+        is rehashed and compared as well. Assets without a manifest are assumed
+        to be intact.
+        """
+        asset_path = self.cache_path / asset
+        if not asset_path.exists():
+            return False
+        manifest = AssetManifest.load(self._cache_asset_manifest(asset))
+        if manifest is None:
+            return True
+        return manifest.matches(asset_path, thorough=thorough)
+
     async def remove_cache(self) -> None:
-        """Remove the cached environment assets."""
+        """Remove the cached environment assets. With a content addressable
+        cache, assets are only deleted once no environment refers to them anymore.
+        """
         for asset in await self.get_cache_assets():
-            asset_path = self.cache_path / asset
-            if asset_path.exists():
-                try:
-                    if asset_path.is_dir():
-                        shutil.rmtree(asset_path)
-                    else:
-                        asset_path.unlink()
-                except Exception as e:
-                    raise WorkflowError(
-                        f"Removal of cache asset {asset_path} for {self.spec} failed: {e}"
-                    ) from e
+            try:
+                await self._remove_cache_asset(asset)
+            except Exception as e:
+                raise WorkflowError(
+                    f"Removal of cache asset {self.cache_path / asset} for "
+                    f"{self.spec} failed: {e}"
+                ) from e
+
+    async def _remove_cache_asset(self, asset: str, corrupted: bool = False) -> None:
+        asset_path = self.cache_path / asset
+        manifest_path = self._cache_asset_manifest(asset)
+        store = self._content_addressed_store()
+        manifest = AssetManifest.load(manifest_path)
+        if store is not None and manifest is not None:
+            async with store.lock(manifest.sha256):
+                object_path = store.object_path(manifest.sha256)
+                if (
+                    corrupted
+                    and object_path.exists()
+                    and asset_path.exists()
+                    and os.path.samefile(object_path, asset_path)
+                ):
+                    # hardlinked, hence the stored object is corrupted as well
+                    object_path.unlink()
+                if store.remove_ref(manifest.sha256, asset_path, self.hash()):
+                    # still used by other environments
+                    return
+        manifest_path.unlink(missing_ok=True)
+        if asset_path.is_dir():
+            shutil.rmtree(asset_path)
+        else:
+            asset_path.unlink(missing_ok=True)
+
+    def _cache_asset_manifest(self, asset: str) -> Path:
+        return self.cache_path / f"{asset}.manifest.json"
+
+    def _write_cache_asset_manifest(self, asset: str, sha256: str) -> None:
+        size, mtime_ns = stat_summary(self.cache_path / asset)
+        _write_atomically(
+            self._cache_asset_manifest(asset),
+            AssetManifest(size=size, mtime_ns=mtime_ns, sha256=sha256).dumps(),
+        )
+
+    def _content_addressed_store(self) -> Optional[ContentAddressedStore]:
+        if not self.is_cache_content_addressable():
+            return None
+        return ContentAddressedStore(self._cache_prefix / ".cas")
+
+    def _store_cache_asset(
+        self, asset: str, sha256: str, store: ContentAddressedStore
+    ) -> None:
+        """Expose the stored object as the given asset and register this
+        environment as one of its users. Has to be called while holding the
+        lock of the digest.
+        """
+        asset_path = self.cache_path / asset
+        link_or_copy(store.object_path(sha256), asset_path)
+        store.add_ref(sha256, asset_path, self.hash())
+        self._write_cache_asset_manifest(asset, sha256)
+
+
+class DeploymentState(Enum):
+    VALID = "valid"
+    # nothing deployed yet
+    MISSING = "missing"
+    # incomplete or modified deployment
+    INVALID = "invalid"
+    # deployed, but without a manifest to check against (e.g. by a previous
+    # version of the interface)
+    UNKNOWN = "unknown"
 
 
 class DeployableEnvBase(EnvBase, ABC):
+    _activation_exports_store: Optional[str] = None
+    _executable_index_store: Optional[FrozenSet[str]] = None
+    _staging_path: Optional[Path] = None
+
     @abstractmethod
     def is_deployment_path_portable(self) -> bool:
         """Return whether the deployment path matters for the environment, i.e.
@@ -444,8 +1484,9 @@ class DeployableEnvBase(EnvBase, ABC):
         """Deploy the environment to self.deployment_path.
 
         When issuing shell commands, the environment should use
-        self.run_cmd(cmd: str) in order to ensure that it runs within eventual
-        parent environments (e.g. a container or an env module).
+        self.run_cmd_async(cmd: str) (or self.run_cmd(cmd: str)) in order to ensure
+        that it runs within eventual parent environments (e.g. a container or an
+        env module). The former does not block other concurrent deployments.
         """
         ...
 
@@ -459,29 +1500,385 @@ class DeployableEnvBase(EnvBase, ABC):
         self.record_hash(hash_object)
         if not self.is_deployment_path_portable():
             hash_object.update(str(self._deployment_prefix).encode())
+            layout = LayoutMarker.load(self._deployment_prefix).layout
+            if layout.is_sharded:
+                # the deployment path depends on the layout as well
+                hash_object.update(layout.describe().encode())
 
     @abstractmethod
     def remove(self) -> None:
         """Remove the deployed environment."""
         ...
 
+    def supports_staged_deployment(self) -> bool:
+        """Return whether deploy() can be run with self.deployment_path pointing
+        to a temporary staging path in the deployment prefix, which is renamed
+        into place once deploy() has succeeded. This way, nobody ever observes a
+        partially deployed environment, and interrupted deployments do not leave
+        anything behind at the deployment path.
+
+        By default, this is the case for portable environments (see
+        is_deployment_path_portable). Overwrite this to return True if the
+        environment is not portable but deploy() does not hardcode
+        self.deployment_path into the deployed files, or to return False if
+        deploy() has to write to the final deployment path.
+        """
+        return self.is_deployment_path_portable()
+
+    def is_activation_snapshottable(self) -> bool:
+        """Return whether activating the deployed environment (as done by
+        decorate_shellcmd) does nothing else than modifying environment
+        variables. If so, the resulting changes are captured once after
+        deployment and later on applied directly to decorated commands instead
+        of running the activation again. This is e.g. the case for conda
+        environments, but not for containers.
+        """
+        return False
+
+    def executable_dirs(self) -> Optional[Iterable[Path]]:
+        """Return the directories of the deployed environment that contain its
+        executables (e.g. self.deployment_path / "bin"). If this returns not None,
+        the directories are scanned once after deployment and
+        managed_contains_executable answers from the resulting index instead of
+        calling contains_executable.
+        """
+        return None
+
+    def estimate_deployment_cost(self) -> Optional[float]:
+        """Overwrite this to return an estimate of the time (in seconds) that
+        deploying the environment would take on the current node, e.g. based on
+        the number of packages to download. None means unknown. This is used to
+        choose between the alternatives of a fallback chain (see
+        fallback.FallbackResolver) and may be called from a worker thread.
+        """
+        return None
+
     def managed_remove(self) -> None:
         """Remove the deployed environment, handling exceptions."""
+        with self._span("remove", hash=self.deployment_hash()):
+            try:
+                self._deployment_sidecar(".deployed").unlink(missing_ok=True)
+                self._deployment_sidecar(".manifest.jsonl").unlink(missing_ok=True)
+                self._remove_derived_sidecars()
+                self.remove()
+                self._deployment_sidecar(".deploying").unlink(missing_ok=True)
+            except Exception as e:
+                raise WorkflowError(f"Removal of {self.spec} failed: {e}") from e
+
+    async def managed_deploy(self, thorough: bool = False) -> None:
+        """Deploy the environment unless it has already been deployed
+        successfully (see verify_deployment). Concurrent deployments of the same
+        environment (also from other processes sharing the deployment prefix) are
+        serialized, such that only the first one actually deploys. Deployments
+        that are complete but have not been recorded (see
+        DeploymentState.UNKNOWN) are adopted instead of being deployed again.
+        """
+        with self._span("deploy", hash=self.deployment_hash()) as span:
+            # pick up migrations of the prefix by other processes right away
+            LayoutMarker.load(self._deployment_prefix, refresh=True)
+            if (
+                await asyncio.to_thread(self.verify_deployment, thorough)
+                == DeploymentState.VALID
+                and self._has_derived_sidecars()
+            ):
+                # Nothing to do, no need to wait for other processes holding the lock
+                # (e.g. while they are deploying in a staging directory).
+                record_usage(self._deployment_prefix, self.deployment_hash())
+                span.update(outcome="skipped")
+                return
+            async with FileLock(self._deployment_sidecar(".lock")):
+                state = await asyncio.to_thread(self.verify_deployment, thorough)
+                if state == DeploymentState.VALID:
+                    span.update(outcome="skipped")
+                elif state == DeploymentState.UNKNOWN and (
+                    self.deployment_path.exists() or self.deployment_path.is_symlink()
+                ):
+                    # Completely deployed without recording a manifest, adopt the
+                    # deployment instead of deploying again.
+                    span.update(
+                        outcome="adopted", bytes=await self._record_deployment()
+                    )
+                else:
+                    if state != DeploymentState.MISSING:
+                        # remove leftovers of an interrupted or broken deployment
+                        if self.deployment_path.exists():
+                            self.managed_remove()
+                        else:
+                            self._deployment_sidecar(".deployed").unlink(
+                                missing_ok=True
+                            )
+                    self._remove_staging_paths()
+                    self.deployment_path.parent.mkdir(parents=True, exist_ok=True)
+                    # tells an interrupted deployment apart from one that has
+                    # been completed without recording a manifest
+                    self._deployment_sidecar(".deploying").touch()
+                    try:
+                        if self.supports_staged_deployment():
+                            await self._deploy_staged()
+                        else:
+                            await self.deploy()
+                    except Exception as e:
+                        raise WorkflowError(
+                            f"Deployment of {self.spec} failed: {e}"
+                        ) from e
+                    span.update(bytes=await self._record_deployment())
+                if (
+                    self.is_activation_snapshottable()
+                    and not self._deployment_sidecar(".activation.json").exists()
+                ):
+                    await self._capture_activation_snapshot()
+                if not self._deployment_sidecar(".executables.json").exists():
+                    self._build_executable_index()
+            record_usage(self._deployment_prefix, self.deployment_hash())
+
+    async def _record_deployment(self) -> Optional[int]:
+        """Write the manifest and the marker of a complete deployment and return
+        the total size of the deployment. Has to be called while holding the lock
+        of the deployment.
+        """
+        self._remove_derived_sidecars()
+        manifest = DeploymentManifest(self._deployment_sidecar(".manifest.jsonl"))
+        _write_atomically(
+            manifest.path,
+            await asyncio.to_thread(
+                manifest.render,
+                self.deployment_path,
+                self.deployment_hash(),
+                self.is_deployment_path_portable(),
+            ),
+        )
+        self._deployment_sidecar(".deployed").touch()
+        self._deployment_sidecar(".deploying").unlink(missing_ok=True)
+        header = manifest.header()
+        return None if header is None else header["total_size"]
+
+    async def _deploy_staged(self) -> None:
+        """Run deploy() with self.deployment_path pointing to a hidden staging
+        path next to the final deployment path and rename the result into place
+        once deploy() has succeeded.
+        """
+        deployment_path = self.deployment_path
+        staging_path = deployment_path.with_name(
+            f".{deployment_path.name}{deployment_staging_infix}{uuid.uuid4().hex}"
+        )
+        self._staging_path = staging_path
         try:
-            self.remove()
-        except Exception as e:
-            raise WorkflowError(f"Removal of {self.spec} failed: {e}") from e
+            try:
+                await self.deploy()
+            finally:
+                self._staging_path = None
+            if staging_path.exists() or staging_path.is_symlink():
+                # atomic since staging path and deployment path share the
+                # same directory and hence the same file system
+                os.replace(staging_path, deployment_path)
+        finally:
+            # also if deploy() failed
+            _remove_path(staging_path)
+
+    def _remove_staging_paths(self) -> None:
+        """Remove staging paths left over by interrupted deployments. Has to be
+        called while holding the lock of the deployment.
+        """
+        deployment_path = self.deployment_path
+        for path in deployment_path.parent.glob(
+            f".{deployment_path.name}{deployment_staging_infix}*"
+        ):
+            _remove_path(path)
 
-    async def managed_deploy(self) -> None:
-        try:
-            await self.deploy()
-        except Exception as e:
-            raise WorkflowError(f"Deployment of {self.spec} failed: {e}") from e
+    def _has_derived_sidecars(self) -> bool:
+        if (
+            self.is_activation_snapshottable()
+            and not self._deployment_sidecar(".activation.json").exists()
+        ):
+            return False
+        return (
+            self.executable_dirs() is None
+            or self._deployment_sidecar(".executables.json").exists()
+        )
+
+    def lease(self) -> Lease:
+        """Return a lease (to be used as a context manager) that protects the
+        deployment from garbage collection while the environment is in use.
+        """
+        return Lease(self._deployment_prefix, self.deployment_hash())
+
+    def verify_deployment(self, thorough: bool = False) -> DeploymentState:
+        """Determine whether the deployment at self.deployment_path is complete
+        and intact.
+
+        By default, only the marker of a successful deployment and the header of
+        the manifest written upon deployment are checked. If thorough is True,
+        size and mtime of every deployed file are compared with the manifest.
+        """
+        marker = self._deployment_sidecar(".deployed")
+        deployment_path = self.deployment_path
+        if not marker.exists():
+            if deployment_path.exists() or deployment_path.is_symlink():
+                if self._deployment_sidecar(".deploying").exists():
+                    # e.g. crashed during deploy()
+                    return DeploymentState.INVALID
+                # deployed by a version of the interface that did not record
+                # deployments yet
+                return DeploymentState.UNKNOWN
+            return DeploymentState.MISSING
+        manifest = DeploymentManifest(self._deployment_sidecar(".manifest.jsonl"))
+        header = manifest.header()
+        if header is None:
+            return DeploymentState.UNKNOWN
+        if header["deployment_hash"] != self.deployment_hash() or (
+            header["exists"]
+            and not (deployment_path.exists() or deployment_path.is_symlink())
+        ):
+            return DeploymentState.INVALID
+        if thorough and not manifest.matches(deployment_path):
+            return DeploymentState.INVALID
+        return DeploymentState.VALID
+
+    def managed_contains_executable(self, executable: str) -> bool:
+        index = self._executable_index()
+        if index is None:
+            return super().managed_contains_executable(executable)
+        return executable in index
+
+    def _build_executable_index(self) -> None:
+        dirs = self.executable_dirs()
+        if dirs is None:
+            return
+        executables = set()
+        for directory in dirs:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        executables.add(entry.name)
+                except OSError:
+                    # e.g. broken symlink
+                    continue
+        _write_atomically(
+            self._deployment_sidecar(".executables.json"),
+            json.dumps(
+                {
+                    "deployment_hash": self.deployment_hash(),
+                    "executables": sorted(executables),
+                }
+            ),
+        )
+
+    def _executable_index(self) -> Optional[FrozenSet[str]]:
+        if self._executable_index_store is None:
+            try:
+                index = json.loads(
+                    self._deployment_sidecar(".executables.json").read_text()
+                )
+            except (OSError, ValueError):
+                return None
+            if index.get("deployment_hash") != self.deployment_hash():
+                return None
+            self._executable_index_store = frozenset(index["executables"])
+        return self._executable_index_store
+
+    def _remove_derived_sidecars(self) -> None:
+        """Remove information that has been derived from the deployment."""
+        for suffix in (".activation.json", ".executables.json"):
+            self._deployment_sidecar(suffix).unlink(missing_ok=True)
+        self._activation_exports_store = None
+        self._executable_index_store = None
+        self._shellcmd_template_store = None
+
+    def managed_decorate_shellcmd(self, cmd: str) -> str:
+        exports = self._activation_exports()
+        if exports is None:
+            return super().managed_decorate_shellcmd(cmd)
+        cmd = exports + cmd
+        if self.within is not None:
+            cmd = self.within.managed_decorate_shellcmd(cmd)
+        return cmd
+
+    async def _capture_activation_snapshot(self) -> None:
+        """Store the changes of environment variables caused by activating the
+        environment (within eventual parent environments) next to the
+        deployment.
+        """
+        before = await self.run_cmd_async("env -0")
+        after = await self.run_cmd_async(self.decorate_shellcmd("env -0"))
+        if before.returncode != 0 or after.returncode != 0:
+            # leave it to the regular activation
+            return
+        before_vars = _parse_env_output(before.stdout)
+        after_vars = _parse_env_output(after.stdout)
+        # Path lists are recorded as the entries added by the activation, such
+        # that they extend the value present when the command is run instead of
+        # replacing it with the one present during deployment.
+        delta: Dict[str, Union[None, str, Dict[str, List[str]]]] = {}
+        for name, value in after_vars.items():
+            previous = before_vars.get(name)
+            if previous == value:
+                continue
+            if _is_path_list_variable(name):
+                path_delta = _path_list_delta(previous or "", value)
+                if path_delta is not None:
+                    delta[name] = path_delta
+                    continue
+            delta[name] = value
+        delta.update({name: None for name in before_vars if name not in after_vars})
+        _write_atomically(
+            self._deployment_sidecar(".activation.json"),
+            json.dumps({"deployment_hash": self.deployment_hash(), "variables": delta}),
+        )
+
+    def _activation_exports(self) -> Optional[str]:
+        """Return shell statements that reproduce the captured activation of the
+        environment, or None if no snapshot is available.
+        """
+        if not self.is_activation_snapshottable():
+            return None
+        if self._activation_exports_store is None:
+            try:
+                snapshot = json.loads(
+                    self._deployment_sidecar(".activation.json").read_text()
+                )
+            except (OSError, ValueError):
+                return None
+            if snapshot.get("deployment_hash") != self.deployment_hash():
+                return None
+            self._activation_exports_store = "".join(
+                f"unset {name}; "
+                if value is None
+                else _path_list_export(name, value)
+                if isinstance(value, dict)
+                else f"export {name}={shlex.quote(value)}; "
+                for name, value in sorted(snapshot["variables"].items())
+            )
+        return self._activation_exports_store
+
+    def _deployment_sidecar(self, suffix: str) -> Path:
+        """Return path of a file that stores information about the deployment
+        next to the deployment path.
+        """
+        name = self.deployment_hash()
+        if suffix == ".lock":
+            # Always lock in the current layout, such that the lock is the same
+            # while the deployment is migrated from a previous layout.
+            layout = LayoutMarker.load(self._deployment_prefix).layout
+            return layout.entry_dir(self._deployment_prefix, name) / f"{name}{suffix}"
+        return self._deployment_dir() / f"{name}{suffix}"
+
+    def _deployment_dir(self) -> Path:
+        name = self.deployment_hash()
+        return LayoutMarker.load(self._deployment_prefix).entry_dir(
+            self._deployment_prefix, name, markers=(f"{name}.deployed",)
+        )
 
     def deployment_hash(self) -> str:
         return self._managed_generic_hash("deployment_hash")
 
     @property
     def deployment_path(self) -> Path:
+        if self._staging_path is not None:
+            # currently deploying (see supports_staged_deployment)
+            return self._staging_path
         assert self._deployment_prefix is not None
-        return self._deployment_prefix / self.deployment_hash()
+        return self._deployment_dir() / self.deployment_hash()
@@ -0,0 +1,145 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import errno
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+from snakemake_interface_software_deployment_plugins._locking import FileLock
+
+
+# ioctl request for cloning a file (reflink) on Linux (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+
+def link_or_copy(source: Path, target: Path) -> None:
+    """Atomically make target a hardlink, reflink, or (as a last resort) copy
+    of source.
+    """
+    fd, tmp = tempfile.mkstemp(
+        prefix=f".{target.name}.", suffix=".part", dir=target.parent
+    )
+    os.close(fd)
+    tmp_path = Path(tmp)
+    try:
+        tmp_path.unlink()
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            if not _reflink(source, tmp_path):
+                shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _reflink(source: Path, target: Path) -> bool:
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except OSError:
+        target.unlink(missing_ok=True)
+        return False
+    shutil.copystat(source, target)
+    return True
+
+
+class ContentAddressedStore:
+    """Store of files addressed by their sha256 digest.
+
+    Objects are exposed at arbitrary paths via link_or_copy. Each such usage
+    is registered as a reference (by the path and an owner, e.g. the hash of
+    an environment), and an object is deleted once its last reference has
+    been removed.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / digest
+
+    def has(self, digest: str) -> bool:
+        return self.object_path(digest).exists()
+
+    def lock(self, digest: str) -> FileLock:
+        return FileLock(self.root / "locks" / f"{digest}.lock")
+
+    def add(self, path: Path, digest: str) -> None:
+        """Move given file into the store, unless the store already contains
+        an object with the same digest (in which case the file is deleted).
+        Has to be called while holding the lock of the digest.
+        """
+        object_path = self.object_path(digest)
+        if object_path.exists():
+            path.unlink()
+            return
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(path, object_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # different file systems
+            shutil.move(path, object_path)
+
+    def add_ref(self, digest: str, path: Path, owner: str) -> None:
+        ref = self._ref_path(digest, path, owner)
+        ref.parent.mkdir(parents=True, exist_ok=True)
+        ref.write_text(str(path.absolute()))
+
+    def remove_ref(self, digest: str, path: Path, owner: str) -> bool:
+        """Remove the reference and delete the object if it was the last one.
+        Return whether path is still referenced by another owner.
+        Has to be called while holding the lock of the digest.
+        """
+        self._ref_path(digest, path, owner).unlink(missing_ok=True)
+        refs_dir = self.root / "refs" / digest
+        remaining = list(refs_dir.iterdir()) if refs_dir.exists() else []
+        if not remaining:
+            self.object_path(digest).unlink(missing_ok=True)
+            try:
+                refs_dir.rmdir()
+            except OSError:
+                pass
+            return False
+        path = path.absolute()
+        return any(Path(ref.read_text()) == path for ref in remaining)
+
+    def prune(self) -> None:
+        """Remove references to paths that do not exist anymore (e.g. because
+        they have been garbage collected) and objects without any reference.
+        """
+        objects_dir = self.root / "objects"
+        if not objects_dir.exists():
+            return
+        for object_path in list(objects_dir.glob("*/*")):
+            digest = object_path.name
+            lock = self.lock(digest)
+            if not lock.try_acquire():
+                continue
+            try:
+                refs_dir = self.root / "refs" / digest
+                if refs_dir.exists():
+                    for ref in refs_dir.iterdir():
+                        if not Path(ref.read_text()).exists():
+                            ref.unlink()
+                    if not any(refs_dir.iterdir()):
+                        refs_dir.rmdir()
+                if not refs_dir.exists():
+                    object_path.unlink()
+            finally:
+                lock.release()
+
+    def _ref_path(self, digest: str, path: Path, owner: str) -> Path:
+        key = hashlib.md5(
+            f"{path.absolute()}\0{owner}".encode(), usedforsecurity=False
+        ).hexdigest()
+        return self.root / "refs" / digest / key
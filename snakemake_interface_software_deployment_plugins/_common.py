@@ -3,8 +3,40 @@ __copyright__ = "Copyright 2024, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import functools
+import importlib.metadata
+from typing import Optional
+
 
 software_deployment_plugin_prefix = "snakemake-software-deployment-plugin-"
 software_deployment_plugin_module_prefix = software_deployment_plugin_prefix.replace(
     "-", "_"
 )
+
+# Files that are stored next to a deployment (<deployment_path><suffix>), a
+# cache asset (<asset><suffix>), or a pinfile (<pinfile><suffix>) and belong to
+# it.
+deployment_sidecar_suffixes = (
+    ".deployed",
+    ".deploying",
+    ".manifest.jsonl",
+    ".lock",
+    ".activation.json",
+    ".executables.json",
+)
+# Hidden paths that deployments are staged in (.<deployment_path><infix><uuid>).
+deployment_staging_infix = ".staging-"
+cache_asset_sidecar_suffixes = (".manifest.json", ".lock", ".part")
+pinfile_sidecar_suffixes = (".lock",)
+
+
+@functools.lru_cache(maxsize=None)
+def distribution_version(module: str) -> Optional[str]:
+    """Return the installed version of the distribution providing the given
+    top-level module (assuming the usual naming of plugin packages), or None if
+    it is not installed as a distribution.
+    """
+    try:
+        return importlib.metadata.version(module.replace("_", "-"))
+    except importlib.metadata.PackageNotFoundError:
+        return None
@@ -0,0 +1,60 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+from typing import Iterable, Optional
+
+
+# Increase when the way environment hashes are computed changes.
+INDEX_VERSION = 1
+
+
+class HashIndex:
+    """Persistent mapping from keys describing all inputs of a hash computation
+    to the resulting hash.
+
+    Each entry is stored in its own file, written atomically, such that the
+    index can be shared between concurrently running processes.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    @staticmethod
+    def key(parts: Iterable[str]) -> str:
+        hash_object = hashlib.md5(usedforsecurity=False)
+        hash_object.update(f"v{INDEX_VERSION}".encode())
+        for part in parts:
+            hash_object.update(b"\0")
+            hash_object.update(part.encode())
+        return hash_object.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self._path(key).read_text() or None
+        except OSError:
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".part")
+        except OSError:
+            # The index is just an optimization, hence we do not fail if it
+            # cannot be written (e.g. because of a read-only file system).
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError:
+            Path(tmp_path).unlink(missing_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
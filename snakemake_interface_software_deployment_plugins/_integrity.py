@@ -0,0 +1,165 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _walk_files(path: Path) -> Iterator[Path]:
+    """Yield all files below given directory in a deterministic order."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            yield Path(root) / name
+
+
+def digest(path: Path) -> str:
+    """Return sha256 hexdigest of given file or directory tree."""
+    hash_object = hashlib.sha256()
+    if path.is_dir():
+        for f in _walk_files(path):
+            hash_object.update(str(f.relative_to(path)).encode())
+            hash_object.update(b"\0")
+            _update_with_file(hash_object, f)
+    else:
+        _update_with_file(hash_object, path)
+    return hash_object.hexdigest()
+
+
+def _update_with_file(hash_object, path: Path) -> None:
+    with open(path, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            hash_object.update(chunk)
+
+
+def stat_summary(path: Path) -> Tuple[int, int]:
+    """Return total size and latest mtime (in ns) of given file or directory
+    tree, without reading any content.
+    """
+    if path.is_dir():
+        size = 0
+        mtime_ns = 0
+        for f in _walk_files(path):
+            stat = f.stat()
+            size += stat.st_size
+            mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+        return size, mtime_ns
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+@dataclass
+class AssetManifest:
+    size: int
+    mtime_ns: int
+    sha256: str
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["AssetManifest"]:
+        try:
+            return cls(**json.loads(path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def dumps(self) -> str:
+        return json.dumps(asdict(self))
+
+    def matches(self, path: Path, thorough: bool = False) -> bool:
+        """Check whether given asset matches the manifest. By default, only
+        size and mtime are compared. If thorough is True, the content is rehashed
+        as well.
+        """
+        try:
+            if stat_summary(path) != (self.size, self.mtime_ns):
+                return False
+            return not thorough or digest(path) == self.sha256
+        except OSError:
+            return False
+
+
+class DeploymentManifest:
+    """Listing of all files (with size and mtime) of a deployment, stored as
+    JSON lines. The first line is a header that allows for cheap checks
+    without reading the entire listing.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    @staticmethod
+    def scan(root: Path) -> Iterator[Tuple[str, int, int]]:
+        if not root.is_dir() or root.is_symlink():
+            stat = root.lstat()
+            yield "", stat.st_size, stat.st_mtime_ns
+            return
+        for dirpath, dirs, files in os.walk(root):
+            # symlinks to directories are listed in dirs but not followed
+            for name in files + [d for d in dirs if os.path.islink(Path(dirpath, d))]:
+                f = Path(dirpath) / name
+                stat = f.lstat()
+                yield str(f.relative_to(root)), stat.st_size, stat.st_mtime_ns
+
+    def render(self, root: Path, deployment_hash: str, portable: bool) -> str:
+        exists = root.exists() or root.is_symlink()
+        entries = list(self.scan(root)) if exists else []
+        header = {
+            "version": self.VERSION,
+            "deployment_hash": deployment_hash,
+            # whether the deployment may be moved (e.g. by layout migrations)
+            "portable": portable,
+            "exists": exists,
+            "file_count": len(entries),
+            "total_size": sum(size for _, size, _ in entries),
+        }
+        lines = [json.dumps(header)]
+        lines.extend(json.dumps(entry) for entry in entries)
+        return "\n".join(lines) + "\n"
+
+    def header(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                header = json.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(header, dict) or header.get("version") != self.VERSION:
+            return None
+        return header
+
+    def entries(self) -> Iterator[Tuple[str, int, int]]:
+        with open(self.path) as f:
+            f.readline()
+            for line in f:
+                relpath, size, mtime_ns = json.loads(line)
+                yield relpath, size, mtime_ns
+
+    def matches(self, root: Path, max_workers: int = 16) -> bool:
+        """Stat-compare all listed files with their recorded size and mtime
+        (in parallel, since this is latency bound on network file systems).
+        """
+
+        def check(entry: Tuple[str, int, int]) -> bool:
+            relpath, size, mtime_ns = entry
+            try:
+                stat = (root / relpath if relpath else root).lstat()
+            except OSError:
+                return False
+            return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+        try:
+            entries = list(self.entries())
+        except (OSError, ValueError):
+            return False
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return all(executor.map(check, entries))
@@ -0,0 +1,178 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional
+import uuid
+
+
+def process_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists but belongs to somebody else
+        return True
+    return True
+
+
+class FileLock:
+    """Asynchronous cross-process lock based on exclusive creation of a lock
+    file.
+
+    The lock file records the host and process id of the holder. A lock is
+    considered stale (and broken) if its holder runs on the same host but is
+    not alive anymore, or if the holder did not refresh the lock file for
+    stale_after seconds (which it does periodically while holding the lock).
+    Refreshing happens in a separate thread, such that it continues while the
+    event loop is blocked (e.g. by a deploy() that calls the synchronous
+    run_cmd). It stops as soon as the lock file is not the one created by the
+    holder anymore (i.e. the lock has been broken by another process).
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        stale_after: float = 300.0,
+        poll_interval: float = 0.2,
+    ) -> None:
+        self.path = path
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self._token = uuid.uuid4().hex
+        self._heartbeat: Optional[threading.Thread] = None
+        self._released = threading.Event()
+        # descriptor of the lock file while holding the lock
+        self._fd: Optional[int] = None
+
+    async def __aenter__(self) -> "FileLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self.release()
+
+    async def acquire(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while not self._try_acquire():
+            await asyncio.sleep(self.poll_interval)
+        self._released.clear()
+        self._heartbeat = threading.Thread(
+            target=self._refresh, name=f"lock-heartbeat-{self.path.name}", daemon=True
+        )
+        self._heartbeat.start()
+
+    def try_acquire(self) -> bool:
+        """Try to acquire the lock without waiting. Meant for short operations,
+        since the lock is not refreshed while being held.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return self._try_acquire()
+
+    def release(self) -> None:
+        if self._heartbeat is not None:
+            self._released.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self._fd is None:
+            return
+        if self.is_owned():
+            self.path.unlink(missing_ok=True)
+        os.close(self._fd)
+        self._fd = None
+
+    def is_owned(self) -> bool:
+        """Return whether the lock file is still the one created upon
+        acquiring the lock.
+        """
+        if self._fd is None:
+            return False
+        try:
+            current = self.path.stat()
+        except FileNotFoundError:
+            return False
+        own = os.fstat(self._fd)
+        return (current.st_dev, current.st_ino) == (own.st_dev, own.st_ino)
+
+    def _try_acquire(self) -> bool:
+        info = {
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "token": self._token,
+        }
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self._break_if_stale()
+            return False
+        os.write(fd, json.dumps(info).encode())
+        self._fd = fd
+        return True
+
+    def _is_stale(self, holder: Optional[Dict[str, Any]], mtime: float) -> bool:
+        if holder is None:
+            # Not yet written or unreadable, give the holder the chance to
+            # write it before considering the lock stale.
+            return time.time() - mtime > self.stale_after
+        if holder.get("host") == socket.gethostname():
+            return not process_is_alive(holder.get("pid", -1))
+        return time.time() - mtime > self.stale_after
+
+    def _break_if_stale(self) -> None:
+        try:
+            observed = self.path.stat()
+        except FileNotFoundError:
+            return
+        holder = self._read_holder(self.path)
+        if not self._is_stale(holder, observed.st_mtime):
+            return
+        # Atomically move the lock out of the way and check that the moved file
+        # is still the observed stale one (same inode, not refreshed since),
+        # such that we never break a lock that has been acquired or refreshed
+        # by somebody else in the meantime.
+        broken = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(self.path, broken)
+        except FileNotFoundError:
+            return
+        moved = broken.stat()
+        if (moved.st_dev, moved.st_ino, moved.st_mtime_ns) != (
+            observed.st_dev,
+            observed.st_ino,
+            observed.st_mtime_ns,
+        ):
+            # Give it back. If yet another process has acquired the lock in
+            # the meantime, the holder of the moved lock notices the loss of
+            # ownership and stops refreshing.
+            try:
+                os.link(broken, self.path)
+            except FileExistsError:
+                pass
+        broken.unlink(missing_ok=True)
+
+    def _refresh(self) -> None:
+        while not self._released.wait(self.stale_after / 4):
+            if not self.is_owned():
+                # broken by another process, never touch the lock of others
+                return
+            # refresh via the descriptor, such that only the own lock file is
+            # touched
+            assert self._fd is not None
+            os.utime(self._fd)
+
+    @staticmethod
+    def _read_holder(path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,276 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+from collections import OrderedDict
+import functools
+import inspect
+import threading
+import time
+import weakref
+from typing import (
+    Any,
+    Callable,
+    Concatenate,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    ParamSpec,
+    Tuple,
+    TypeVar,
+    cast,
+    overload,
+)
+
+
+# instance, parameters (without the instance), and return type of memoized
+# methods, such that decorated methods keep their signature
+T = TypeVar("T")
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def default_key(instance, *args, **kwargs) -> Hashable:
+    return (instance, args, tuple(sorted(kwargs.items())))
+
+
+class _Pending:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.thread = threading.get_ident()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class Memoized(Generic[T, P, R]):
+    """Memoizing wrapper for (sync or async) methods.
+
+    Results are stored per key, which by default consists of the instance and
+    all arguments. Instances are referred to by their id in default keys, such
+    that the cache does not keep them alive, and their entries are dropped once
+    they are garbage collected. Concurrent calls with the same key (from different threads
+    or different coroutines) share a single computation. Entries are evicted in
+    least recently used order once there are more than maxsize of them, and
+    expire after ttl seconds if given.
+    """
+
+    def __init__(
+        self,
+        func: Callable[Concatenate[T, P], R],
+        maxsize: Optional[int] = 128,
+        ttl: Optional[float] = None,
+        key: Callable[..., Hashable] = default_key,
+    ) -> None:
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.is_async = inspect.iscoroutinefunction(func)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Optional[float]]]" = (
+            OrderedDict()
+        )
+        self._pending: Dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+        # finalizers of instances referred to by id in default keys, and ids of
+        # instances that have been garbage collected since the last purge
+        self._finalizers: Dict[int, weakref.finalize] = {}
+        self._dead: List[int] = []
+
+    @overload
+    def __get__(self, instance: None, owner: Any = None) -> "Memoized[T, P, R]": ...
+
+    @overload
+    def __get__(self, instance: T, owner: Any = None) -> "_BoundMemoized[P, R]": ...
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return _BoundMemoized(self, instance)
+
+    def __call__(self, instance: T, *args: P.args, **kwargs: P.kwargs) -> R:
+        if self.is_async:
+            return cast(R, self._call_async(instance, *args, **kwargs))
+        return self._call_sync(instance, *args, **kwargs)
+
+    def invalidate(self, instance: T, *args: Any, **kwargs: Any) -> None:
+        """Remove the entry for given instance and arguments."""
+        key = self._make_key(instance, args, kwargs)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _make_key(self, instance: Any, args: Any, kwargs: Any) -> Hashable:
+        if self.key is not default_key:
+            return self.key(instance, *args, **kwargs)
+        instance_id = id(instance)
+        with self._lock:
+            if self._dead:
+                # the id might be the one of a collected instance
+                self._purge()
+            if instance_id not in self._finalizers:
+                try:
+                    finalizer = weakref.finalize(instance, self._forget, instance_id)
+                except TypeError:
+                    # not weakly referenceable, hold the instance itself
+                    return default_key(instance, *args, **kwargs)
+                finalizer.atexit = False
+                self._finalizers[instance_id] = finalizer
+        return (instance_id, args, tuple(sorted(kwargs.items())))
+
+    def _forget(self, instance_id: int) -> None:
+        # Called upon garbage collection of an instance, possibly while this
+        # thread holds the lock. Then, entries are purged when the next key is
+        # computed, which is before the id can be reused by another instance.
+        self._dead.append(instance_id)
+        if self._lock.acquire(blocking=False):
+            try:
+                self._purge()
+            finally:
+                self._lock.release()
+
+    def _purge(self) -> None:
+        # has to be called with self._lock being held
+        while self._dead:
+            instance_id = self._dead.pop()
+            self._finalizers.pop(instance_id, None)
+            for key in [
+                key
+                for key in self._entries
+                if isinstance(key, tuple)
+                and type(key[0]) is int
+                and key[0] == instance_id
+            ]:
+                del self._entries[key]
+
+    def cache_clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        # has to be called with self._lock being held
+        if self._dead:
+            self._purge()
+        try:
+            value, expires = self._entries[key]
+        except KeyError:
+            return False, None
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        # has to be called with self._lock being held
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _call_sync(self, instance, *args, **kwargs) -> R:
+        key = self._make_key(instance, args, kwargs)
+        with self._lock:
+            hit, value = self._lookup(key)
+            if hit:
+                return value
+            pending = self._pending.get(key)
+            if pending is None or pending.thread == threading.get_ident():
+                # Either nobody is computing this yet, or we are in a
+                # recursive call from the thread that does.
+                pending = _Pending()
+                self._pending[key] = pending
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value = self.func(instance, *args, **kwargs)
+        except BaseException as e:
+            pending.error = e
+            raise
+        else:
+            pending.value = value
+            with self._lock:
+                self._store(key, value)
+            return value
+        finally:
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+            pending.event.set()
+
+    async def _call_async(self, instance, *args, **kwargs):
+        key = self._make_key(instance, args, kwargs)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                hit, value = self._lookup(key)
+                if hit:
+                    return value
+                pending = self._pending.get(key)
+                if pending is None or pending.get_loop() is not loop:
+                    pending = loop.create_future()
+                    # avoid warnings about never retrieved exceptions
+                    pending.add_done_callback(
+                        lambda fut: fut.cancelled() or fut.exception()
+                    )
+                    self._pending[key] = pending
+                    owner = True
+                else:
+                    owner = False
+
+            if not owner:
+                try:
+                    return await asyncio.shield(pending)
+                except asyncio.CancelledError:
+                    if pending.cancelled():
+                        # the computing coroutine was cancelled, retry
+                        continue
+                    raise
+
+            try:
+                value = await cast(Any, self.func(instance, *args, **kwargs))
+            except asyncio.CancelledError:
+                pending.cancel()
+                raise
+            except BaseException as e:
+                pending.set_exception(e)
+                raise
+            else:
+                with self._lock:
+                    self._store(key, value)
+                pending.set_result(value)
+                return value
+            finally:
+                with self._lock:
+                    if self._pending.get(key) is pending:
+                        del self._pending[key]
+
+
+class _BoundMemoized(Generic[P, R]):
+    def __init__(self, memoized: Memoized[Any, P, R], instance: Any) -> None:
+        self._memoized = memoized
+        self._instance = instance
+        functools.update_wrapper(self, memoized.func)
+
+    def __call__(self, *args: P.args, **kwargs: P.kwargs) -> R:
+        return self._memoized(self._instance, *args, **kwargs)
+
+    def invalidate(self, *args: Any, **kwargs: Any) -> None:
+        self._memoized.invalidate(self._instance, *args, **kwargs)
+
+    def cache_clear(self) -> None:
+        self._memoized.cache_clear()
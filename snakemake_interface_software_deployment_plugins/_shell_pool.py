@@ -0,0 +1,173 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import os
+from pathlib import Path
+import queue
+import shlex
+import shutil
+import signal
+import subprocess as sp
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+import uuid
+import weakref
+
+
+class ShellWorker:
+    """A long-lived shell process that executes commands sent via its stdin.
+
+    Each command runs in a subshell, such that changes to the environment, the
+    working directory, or shell options do not leak into subsequent commands.
+    Stdout and stderr of the command are redirected into files and the exit code
+    is reported via a sentinel line on the stdout of the shell.
+    This requires a POSIX compatible shell (e.g. bash, zsh, or sh).
+    """
+
+    def __init__(self, shell_cmd: List[str]) -> None:
+        self._sentinel = f"__snakemake_shell_worker_{uuid.uuid4().hex}__"
+        self._tmpdir = Path(tempfile.mkdtemp(prefix="snakemake-shell-worker-"))
+        self._process = sp.Popen(
+            shell_cmd,
+            stdin=sp.PIPE,
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            start_new_session=True,
+        )
+        self._broken = False
+        # terminate the shell and remove the tmpdir also if the worker is never
+        # closed explicitly (upon garbage collection or interpreter exit)
+        self._finalizer = weakref.finalize(self, _cleanup, self._process, self._tmpdir)
+
+    @property
+    def is_alive(self) -> bool:
+        return not self._broken and self._process.poll() is None
+
+    def run(
+        self, cmd: str, timeout: Optional[float] = None
+    ) -> Tuple[int, bytes, bytes]:
+        assert self._process.stdin is not None and self._process.stdout is not None
+        stdout_path = self._tmpdir / "stdout"
+        stderr_path = self._tmpdir / "stderr"
+        script = (
+            f"(cd {shlex.quote(os.getcwd())} && eval {shlex.quote(cmd)}) "
+            f"</dev/null >{shlex.quote(str(stdout_path))} "
+            f"2>{shlex.quote(str(stderr_path))}; "
+            f"printf '%s %d\\n' {self._sentinel} $?\n"
+        )
+        self._process.stdin.write(script.encode())
+        self._process.stdin.flush()
+
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            self.kill()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, on_timeout)
+            timer.start()
+        try:
+            while True:
+                line = self._process.stdout.readline()
+                if not line:
+                    self._broken = True
+                    if timeout is not None and timed_out.is_set():
+                        raise sp.TimeoutExpired(cmd, timeout)
+                    raise sp.SubprocessError(
+                        f"Shell worker terminated unexpectedly while running {cmd}"
+                    )
+                if line.startswith(self._sentinel.encode()):
+                    returncode = int(line.split()[1])
+                    break
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return returncode, stdout_path.read_bytes(), stderr_path.read_bytes()
+
+    def kill(self) -> None:
+        self._broken = True
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def close(self) -> None:
+        self._broken = True
+        self._finalizer()
+
+
+def _cleanup(process: sp.Popen, tmpdir: Path) -> None:
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.wait()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class ShellWorkerPool:
+    """Thread-safe pool of at most size shell workers, started on demand."""
+
+    def __init__(self, shell_cmd: List[str], size: int) -> None:
+        if size < 1:
+            raise ValueError("Shell worker pool size must be at least 1.")
+        self.shell_cmd = shell_cmd
+        self.size = size
+        self._idle: "queue.Queue[ShellWorker]" = queue.Queue()
+        self._workers: List[ShellWorker] = []
+        self._lock = threading.Lock()
+
+    def run(
+        self, cmd: str, timeout: Optional[float] = None
+    ) -> Tuple[int, bytes, bytes]:
+        worker = self._checkout()
+        try:
+            return worker.run(cmd, timeout=timeout)
+        finally:
+            self._checkin(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers.clear()
+            # never hand out closed workers
+            while True:
+                try:
+                    self._idle.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _checkout(self) -> ShellWorker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._workers) < self.size:
+                worker = ShellWorker(self.shell_cmd)
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+    def _checkin(self, worker: ShellWorker) -> None:
+        with self._lock:
+            if worker not in self._workers:
+                # the pool has been closed in the meantime
+                worker.close()
+                return
+        if not worker.is_alive:
+            # replace dead (e.g. killed because of a timeout) worker
+            worker.close()
+            replacement = ShellWorker(self.shell_cmd)
+            with self._lock:
+                self._workers.remove(worker)
+                self._workers.append(replacement)
+            worker = replacement
+        self._idle.put(worker)
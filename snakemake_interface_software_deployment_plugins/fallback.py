@@ -0,0 +1,212 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import json
+from pathlib import Path
+import socket
+from typing import Callable, Iterable, List, Optional
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_interface_software_deployment_plugins import (
+    DeployableEnvBase,
+    DeploymentState,
+    EnvBase,
+    EnvSpecBase,
+    _write_atomically,
+)
+from snakemake_interface_software_deployment_plugins._memoize import Memoized
+
+
+@dataclass
+class ProbeResult:
+    env: EnvBase
+    available: bool
+    # None if the environment is not deployable
+    deployment_state: Optional[DeploymentState] = None
+    # estimated deployment time in seconds, None if unknown or already deployed
+    deployment_cost: Optional[float] = None
+    error: Optional[Exception] = None
+
+    @property
+    def is_deployed(self) -> bool:
+        return self.deployment_state in (None, DeploymentState.VALID)
+
+
+@dataclass
+class Resolution:
+    env: EnvBase
+    # position of the chosen alternative in the fallback chain
+    index: int
+    # probe results of all alternatives, None if the decision has been loaded
+    # from the decision directory
+    probes: Optional[List[ProbeResult]] = None
+
+
+def iter_alternatives(spec: EnvSpecBase) -> Iterable[EnvSpecBase]:
+    """Yield the given spec and all specs of its fallback chain, in order of
+    preference.
+    """
+    alternative: Optional[EnvSpecBase] = spec
+    while alternative is not None:
+        yield alternative
+        alternative = alternative.fallback
+
+
+class FallbackResolver:
+    """Choose the alternative of a fallback chain (see EnvSpecBase.__or__)
+    that shall be used on the current node.
+
+    All alternatives of a chain are probed concurrently: whether they are
+    available (see EnvBase.is_available, including their within environments),
+    whether they are deployed already (see DeployableEnvBase.verify_deployment)
+    and what deploying them would cost (see
+    DeployableEnvBase.estimate_deployment_cost). The first alternative that is
+    available and either deployed or estimated to be deployable within
+    max_deployment_cost seconds is chosen.
+
+    Decisions are memoized per node and per spec (i.e. by its hash, which
+    covers the entire chain), such that each distinct chain is probed only
+    once, no matter how many jobs use it. If decision_dir is given, decisions
+    are additionally stored there per node and reused by other processes.
+    env_factory has to return the environment (including its within
+    environment) for a given spec.
+    """
+
+    def __init__(
+        self,
+        env_factory: Callable[[EnvSpecBase], EnvBase],
+        max_deployment_cost: Optional[float] = None,
+        decision_dir: Optional[Path] = None,
+        hostname: Optional[str] = None,
+    ) -> None:
+        self.env_factory = env_factory
+        self.max_deployment_cost = max_deployment_cost
+        self.decision_dir = decision_dir
+        self.hostname = hostname if hostname is not None else socket.gethostname()
+        # concurrent resolutions of the same chain share one probing
+        self._resolve = Memoized(
+            self._resolve_uncached,
+            maxsize=None,
+            key=lambda spec: (self.hostname, spec),
+        )
+
+    async def resolve(self, spec: EnvSpecBase) -> Resolution:
+        """Return the alternative of the given spec's fallback chain that shall
+        be used on this node. Raise a WorkflowError if none is usable.
+        """
+        return await self._resolve(spec)
+
+    async def resolve_all(self, specs: Iterable[EnvSpecBase]) -> List[Resolution]:
+        """Resolve the given specs concurrently, returning one resolution per
+        given spec (in the same order).
+        """
+        return list(await asyncio.gather(*(self._resolve(spec) for spec in specs)))
+
+    def invalidate(self, spec: EnvSpecBase) -> None:
+        """Forget the decision for the given spec, e.g. after a deployment has
+        been removed.
+        """
+        self._resolve.invalidate(spec)
+        if self.decision_dir is not None:
+            envs = [
+                self.env_factory(alternative) for alternative in iter_alternatives(spec)
+            ]
+            self._decision_path(envs).unlink(missing_ok=True)
+
+    async def _resolve_uncached(self, spec: EnvSpecBase) -> Resolution:
+        envs = [
+            self.env_factory(alternative) for alternative in iter_alternatives(spec)
+        ]
+        if self.decision_dir is not None:
+            resolution = self._load_decision(envs)
+            if resolution is not None:
+                return resolution
+
+        probes = await asyncio.gather(
+            *(asyncio.to_thread(self._probe, env) for env in envs)
+        )
+        for index, probe in enumerate(probes):
+            if self._is_usable(probe):
+                resolution = Resolution(env=probe.env, index=index, probes=probes)
+                if self.decision_dir is not None:
+                    self._store_decision(envs, index)
+                return resolution
+        details = "\n".join(
+            f"    {probe.env.spec}: {self._describe(probe)}" for probe in probes
+        )
+        raise WorkflowError(
+            f"None of the alternatives of {spec} is usable on {self.hostname}:\n"
+            f"{details}"
+        )
+
+    def _probe(self, env: EnvBase) -> ProbeResult:
+        try:
+            current: Optional[EnvBase] = env
+            while current is not None:
+                if not current.is_available():
+                    return ProbeResult(env=env, available=False)
+                current = current.within
+            if not isinstance(env, DeployableEnvBase):
+                return ProbeResult(env=env, available=True)
+            state = env.verify_deployment()
+            cost = None
+            if state != DeploymentState.VALID:
+                cost = env.estimate_deployment_cost()
+            return ProbeResult(
+                env=env, available=True, deployment_state=state, deployment_cost=cost
+            )
+        except Exception as e:
+            return ProbeResult(env=env, available=False, error=e)
+
+    def _is_usable(self, probe: ProbeResult) -> bool:
+        if not probe.available:
+            return False
+        if probe.is_deployed or self.max_deployment_cost is None:
+            return True
+        return (
+            probe.deployment_cost is None
+            or probe.deployment_cost <= self.max_deployment_cost
+        )
+
+    def _describe(self, probe: ProbeResult) -> str:
+        if probe.error is not None:
+            return f"probing failed ({probe.error!r})"
+        if not probe.available:
+            return "not available"
+        return (
+            f"estimated deployment time of {probe.deployment_cost}s exceeds "
+            f"{self.max_deployment_cost}s"
+        )
+
+    def _decision_path(self, envs: List[EnvBase]) -> Path:
+        assert self.decision_dir is not None
+        key = hashlib.sha256(
+            "\0".join(
+                f"{env.__class__.__module__}:{env.hash()}" for env in envs
+            ).encode()
+        ).hexdigest()
+        return self.decision_dir / self.hostname / f"{key}.json"
+
+    def _load_decision(self, envs: List[EnvBase]) -> Optional[Resolution]:
+        try:
+            index = json.loads(self._decision_path(envs).read_text())["index"]
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(index, int) or not 0 <= index < len(envs):
+            return None
+        return Resolution(env=envs[index], index=index)
+
+    def _store_decision(self, envs: List[EnvBase], index: int) -> None:
+        path = self._decision_path(envs)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _write_atomically(path, json.dumps({"index": index}))
+        except OSError:
+            # best effort, the decision is memoized in memory anyway
+            pass
@@ -0,0 +1,471 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import shutil
+import socket
+import time
+from typing import Dict, List, Optional, Sequence
+
+from snakemake_interface_common.exceptions import WorkflowError
+import uuid
+
+from snakemake_interface_software_deployment_plugins._cas import (
+    ContentAddressedStore,
+)
+from snakemake_interface_software_deployment_plugins._integrity import (
+    DeploymentManifest,
+)
+from snakemake_interface_software_deployment_plugins._locking import (
+    FileLock,
+    process_is_alive,
+)
+from snakemake_interface_software_deployment_plugins.layout import (
+    LayoutMarker,
+    PrefixLayout,
+)
+import snakemake_interface_software_deployment_plugins._common as common
+
+
+_USAGE_DIR = ".usage"
+_LEASES_DIR = ".leases"
+
+
+def record_usage(prefix: Path, name: str) -> None:
+    """Record that the entry with given name (e.g. a deployment hash or a cache
+    asset) in given prefix has been used just now.
+    """
+    path = prefix / _USAGE_DIR / name
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    except OSError:
+        # recording usage is best effort (e.g. read-only file systems)
+        pass
+
+
+class Lease:
+    """Protect the entry with given name in given prefix from garbage
+    collection while the lease is held (as a context manager).
+
+    A lease is considered expired if its holder on the same host is not alive
+    anymore, or if it has not been renewed (see renew()) for stale_after seconds.
+    """
+
+    def __init__(self, prefix: Path, name: str, stale_after: float = 86400.0):
+        self.prefix = prefix
+        self.name = name
+        self.stale_after = stale_after
+        self.path = prefix / _LEASES_DIR / name / uuid.uuid4().hex
+
+    def __enter__(self) -> "Lease":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(
+            json.dumps(
+                {
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "stale_after": self.stale_after,
+                }
+            )
+        )
+        record_usage(self.prefix, self.name)
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.path.unlink(missing_ok=True)
+        record_usage(self.prefix, self.name)
+
+    def renew(self) -> None:
+        os.utime(self.path)
+
+
+@dataclass
+class GarbageCollectionEntry:
+    name: str
+    paths: List[Path]
+    size: int
+    last_used: float
+    protected: bool = field(default=False, repr=False)
+
+
+class GarbageCollector:
+    """Evict unused entries (deployments, cache assets, or pinfiles) from a
+    prefix.
+
+    Entries are evicted if they have not been used for more than max_age
+    seconds, and then in least recently used order until the total size of the
+    prefix is below quota (in bytes). Entries that are protected by a lease or
+    a lock are never evicted. Staging paths left behind by interrupted
+    deployments are removed regardless of max_age and quota.
+    """
+
+    def __init__(
+        self,
+        prefix: Path,
+        sidecar_suffixes: Sequence[str] = (),
+        quota: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ) -> None:
+        self.prefix = prefix
+        self.sidecar_suffixes = sidecar_suffixes
+        self.quota = quota
+        self.max_age = max_age
+
+    @classmethod
+    def for_deployments(cls, deployment_prefix: Path, **kwargs) -> "GarbageCollector":
+        return cls(
+            deployment_prefix,
+            sidecar_suffixes=common.deployment_sidecar_suffixes,
+            **kwargs,
+        )
+
+    @classmethod
+    def for_cache(cls, cache_prefix: Path, **kwargs) -> "GarbageCollector":
+        return cls(
+            cache_prefix, sidecar_suffixes=common.cache_asset_sidecar_suffixes, **kwargs
+        )
+
+    @classmethod
+    def for_pinfiles(cls, pinfile_prefix: Path, **kwargs) -> "GarbageCollector":
+        return cls(
+            pinfile_prefix, sidecar_suffixes=common.pinfile_sidecar_suffixes, **kwargs
+        )
+
+    def entries(self) -> List[GarbageCollectionEntry]:
+        entries = []
+        for name, paths in self._groups().items():
+            last_used = max(self._mtime(path) for path in paths)
+            usage = self._mtime(self.prefix / _USAGE_DIR / name)
+            entries.append(
+                GarbageCollectionEntry(
+                    name=name,
+                    paths=paths,
+                    size=sum(_disk_usage(path) for path in paths),
+                    last_used=max(last_used, usage),
+                    protected=self._is_locked(name) or self._is_leased(name),
+                )
+            )
+        return entries
+
+    def collect(self, dry_run: bool = False) -> List[GarbageCollectionEntry]:
+        """Evict entries according to max_age and quota and return them. If
+        dry_run is True, only return the entries that would be evicted.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry.last_used)
+        total = sum(entry.size for entry in entries)
+        now = time.time()
+        evicted = []
+        for entry in entries:
+            if entry.protected:
+                continue
+            too_old = self.max_age is not None and now - entry.last_used > self.max_age
+            over_quota = self.quota is not None and total > self.quota
+            if not (too_old or over_quota):
+                if not dry_run:
+                    self._remove_staging_leftovers(entry)
+                continue
+            if not dry_run and not self._evict(entry):
+                continue
+            evicted.append(entry)
+            total -= entry.size
+        if not dry_run:
+            store = self.prefix / ".cas"
+            if store.exists():
+                ContentAddressedStore(store).prune()
+        return evicted
+
+    def _groups(self) -> Dict[str, List[Path]]:
+        """Return the paths of all entries (including their sidecars) by entry
+        name, considering all layouts of the prefix (see layout.LayoutMarker).
+        """
+        groups: Dict[str, List[Path]] = {}
+        marker = LayoutMarker.load(self.prefix, refresh=True)
+        for path in marker.iter_entry_paths(self.prefix, hidden=True):
+            if path.name.startswith("."):
+                name = _staged_entry_name(path.name)
+                if name is None:
+                    # e.g. usage records, leases, or temporary files
+                    continue
+            elif path.name.endswith(".stale"):
+                # transient files
+                continue
+            else:
+                name = self._entry_name(path.name)
+            groups.setdefault(name, []).append(path)
+        return groups
+
+    def _lock(self, name: str) -> FileLock:
+        layout = LayoutMarker.load(self.prefix).layout
+        return FileLock(layout.entry_dir(self.prefix, name) / f"{name}.lock")
+
+    def _entry_name(self, filename: str) -> str:
+        for suffix in self.sidecar_suffixes:
+            if filename.endswith(suffix) and len(filename) > len(suffix):
+                return filename[: -len(suffix)]
+        return filename
+
+    def _remove_staging_leftovers(self, entry: GarbageCollectionEntry) -> None:
+        # Staging paths of an entry that is not locked have been left behind by
+        # an interrupted deployment, since deployments hold the lock while staging.
+        leftovers = [
+            path for path in entry.paths if _staged_entry_name(path.name) is not None
+        ]
+        if not leftovers:
+            return
+        lock = self._lock(entry.name)
+        if not lock.try_acquire():
+            return
+        try:
+            for path in leftovers:
+                _remove(path)
+        finally:
+            lock.release()
+
+    def _is_locked(self, name: str) -> bool:
+        # currently being deployed, cached, or migrated
+        return any(
+            (directory / f"{name}.lock").exists()
+            for directory in LayoutMarker.load(self.prefix).entry_dirs(
+                self.prefix, name
+            )
+        )
+
+    def _is_leased(self, name: str) -> bool:
+        leases = self.prefix / _LEASES_DIR / name
+        if not leases.exists():
+            return False
+        now = time.time()
+        for lease in leases.iterdir():
+            try:
+                holder = json.loads(lease.read_text())
+                mtime = lease.stat().st_mtime
+            except (OSError, ValueError):
+                continue
+            if holder.get("host") == socket.gethostname():
+                if process_is_alive(holder.get("pid", -1)):
+                    return True
+            elif now - mtime <= holder.get("stale_after", 0):
+                return True
+        return False
+
+    def _evict(self, entry: GarbageCollectionEntry) -> bool:
+        # Take the lock of the entry, such that no deployment or caching of it
+        # can start while we remove it.
+        lock = self._lock(entry.name)
+        if not lock.try_acquire():
+            return False
+        try:
+            if self._is_leased(entry.name):
+                return False
+            # Remove sidecars (e.g. markers of completeness) first, such that
+            # partially removed entries are never considered valid.
+            for path in sorted(entry.paths, key=lambda path: path.name == entry.name):
+                _remove(path)
+            shutil.rmtree(self.prefix / _LEASES_DIR / entry.name, ignore_errors=True)
+            (self.prefix / _USAGE_DIR / entry.name).unlink(missing_ok=True)
+            return True
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _mtime(path: Path) -> float:
+        try:
+            return path.lstat().st_mtime
+        except OSError:
+            return 0.0
+
+
+@dataclass
+class LayoutMigrationReport:
+    moved: List[str] = field(default_factory=list)
+    # entries that are in use and have to be moved by a later run
+    skipped: List[str] = field(default_factory=list)
+    # whether all entries are in the new layout
+    complete: bool = False
+    # deployments that cannot be moved since they are not portable
+    removed: List[str] = field(default_factory=list)
+
+
+class LayoutMigration:
+    """Move the entries of a prefix (deployments or pinfiles) to another
+    layout (see layout.PrefixLayout), while the prefix is in use.
+
+    First, the layout marker of the prefix is switched to the new layout,
+    recording the current one as previous. From then on, new entries are placed
+    according to the new layout, while existing ones are still found in the
+    previous one. Then, entries are moved one by one while holding their lock,
+    skipping those that are locked or leased. Once no entry is left in the
+    previous layout, the marker is finalized. Hence, run() can be repeated
+    until the returned report is complete.
+
+    Deployments of environments that are not portable (see
+    DeployableEnvBase.is_deployment_path_portable) are not usable from another
+    path. Hence, they are removed instead of being moved (as are deployments
+    that do not record whether they are portable). Their deployment hash
+    reflects a sharded layout, such that they are deployed again in the new
+    layout.
+    """
+
+    def __init__(
+        self,
+        collector: GarbageCollector,
+        layout: PrefixLayout,
+        check_portability: bool = False,
+    ) -> None:
+        self.collector = collector
+        self.layout = layout
+        self.check_portability = check_portability
+
+    @classmethod
+    def for_deployments(
+        cls, deployment_prefix: Path, layout: PrefixLayout
+    ) -> "LayoutMigration":
+        return cls(
+            GarbageCollector.for_deployments(deployment_prefix),
+            layout,
+            check_portability=True,
+        )
+
+    @classmethod
+    def for_pinfiles(
+        cls, pinfile_prefix: Path, layout: PrefixLayout
+    ) -> "LayoutMigration":
+        return cls(GarbageCollector.for_pinfiles(pinfile_prefix), layout)
+
+    def run(self) -> LayoutMigrationReport:
+        prefix = self.collector.prefix
+        marker = LayoutMarker.load(prefix, refresh=True)
+        if marker.layout != self.layout:
+            if marker.is_migrating:
+                raise WorkflowError(
+                    f"{prefix} is still being migrated to layout "
+                    f"{marker.layout.describe()}, finish that migration first."
+                )
+            marker = LayoutMarker(layout=self.layout, previous=marker.layout)
+            marker.save(prefix)
+        report = LayoutMigrationReport()
+        if marker.previous is None:
+            report.complete = True
+            return report
+
+        for name, paths in self.collector._groups().items():
+            previous_dir = marker.previous.entry_dir(prefix, name)
+            previous_paths = [path for path in paths if path.parent == previous_dir]
+            if not previous_paths:
+                continue
+            outcome = self._move(
+                name, previous_paths, self.layout.entry_dir(prefix, name)
+            )
+            if outcome is None:
+                report.skipped.append(name)
+            elif outcome:
+                report.moved.append(name)
+            else:
+                report.removed.append(name)
+        if not report.skipped:
+            LayoutMarker(layout=self.layout).save(prefix)
+            report.complete = True
+        return report
+
+    def _move(self, name: str, paths: List[Path], target_dir: Path) -> Optional[bool]:
+        """Move the entry with given name to the target directory and return
+        True, or remove it and return False if it cannot be moved. Return None
+        if the entry is in use.
+        """
+        lock = self.collector._lock(name)
+        if not lock.try_acquire():
+            return None
+        try:
+            if self.collector._is_leased(name) or any(
+                path.name == f"{name}.lock" for path in paths
+            ):
+                return None
+            if self.check_portability and not self._is_portable(name, paths):
+                # markers of completeness first, see GarbageCollector._evict
+                for path in sorted(paths, key=lambda path: path.name == name):
+                    _remove(path)
+                (self.collector.prefix / _USAGE_DIR / name).unlink(missing_ok=True)
+                _remove_empty_dirs(paths[0].parent, self.collector.prefix)
+                return False
+            target_dir.mkdir(parents=True, exist_ok=True)
+            # Move sidecars first, markers of completeness (e.g. .deployed) in
+            # front, such that a partially moved entry is never considered valid
+            # in the previous layout.
+            suffixes = list(self.collector.sidecar_suffixes)
+
+            def order(path: Path) -> int:
+                for i, suffix in enumerate(suffixes):
+                    if path.name == f"{name}{suffix}":
+                        return i
+                return len(suffixes)
+
+            for path in sorted(paths, key=order):
+                target = target_dir / path.name
+                if _staged_entry_name(path.name) is not None:
+                    # left behind by an interrupted deployment
+                    _remove(path)
+                elif os.path.lexists(target):
+                    # the entry has been recreated in the new layout meanwhile
+                    _remove(path)
+                else:
+                    os.replace(path, target)
+            _remove_empty_dirs(paths[0].parent, self.collector.prefix)
+            return True
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _is_portable(name: str, paths: List[Path]) -> bool:
+        for path in paths:
+            if path.name == f"{name}.manifest.jsonl":
+                header = DeploymentManifest(path).header()
+                return header is not None and header.get("portable") is True
+        # no deployment (e.g. only leftovers of an interrupted one)
+        return not any(path.name == name for path in paths)
+
+
+def _staged_entry_name(filename: str) -> Optional[str]:
+    # name of the entry that is staged in the given hidden path, if any
+    if not filename.startswith("."):
+        return None
+    name, infix, _ = filename[1:].partition(common.deployment_staging_infix)
+    return name if infix and name else None
+
+
+def _remove_empty_dirs(path: Path, prefix: Path) -> None:
+    # remove emptied shard directories of the previous layout
+    while path != prefix and prefix in path.parents:
+        try:
+            path.rmdir()
+        except OSError:
+            return
+        path = path.parent
+
+
+def _disk_usage(path: Path) -> int:
+    try:
+        if not path.is_dir() or path.is_symlink():
+            return path.lstat().st_size
+    except OSError:
+        return 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
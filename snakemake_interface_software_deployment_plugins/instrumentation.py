@@ -0,0 +1,231 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+import itertools
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+@dataclass
+class Span:
+    """A timed operation (e.g. "deploy", "pin", "cache_asset", "hash",
+    "deployment_hash", "run_cmd", or "remove") on an environment.
+
+    The outcome is "success" or "failed", or an operation specific value like
+    "skipped" if there was nothing to do.
+    """
+
+    operation: str
+    kind: Optional[str]
+    spec: str
+    hash: Optional[str] = None
+    start: float = 0.0
+    duration: float = 0.0
+    outcome: str = "success"
+    # number of bytes transferred or written, if applicable
+    bytes: Optional[int] = None
+    error: Optional[str] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    id: int = 0
+    # id of the span this one has been started within
+    parent_id: Optional[int] = None
+
+    def update(
+        self,
+        outcome: Optional[str] = None,
+        bytes: Optional[int] = None,
+        hash: Optional[str] = None,
+        **attributes: Any,
+    ) -> None:
+        if outcome is not None:
+            self.outcome = outcome
+        if bytes is not None:
+            self.bytes = bytes
+        if hash is not None:
+            self.hash = hash
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class _NullSpan:
+    """Stand-in used if nobody is subscribed, doing as little as possible."""
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+# replaced (not modified) upon (un)subscription, such that emitting does not
+# need to take a lock
+_subscribers: Tuple[Callable[[Span], None], ...] = ()
+_subscribers_lock = threading.Lock()
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+def subscribe(callback: Callable[[Span], None]) -> Callable[[], None]:
+    """Call given callback with every finished span. Return a function that
+    removes the subscription again.
+
+    Callbacks may be called from multiple threads concurrently and should
+    return quickly.
+    """
+    global _subscribers
+    with _subscribers_lock:
+        _subscribers = _subscribers + (callback,)
+
+    def unsubscribe() -> None:
+        global _subscribers
+        with _subscribers_lock:
+            _subscribers = tuple(sub for sub in _subscribers if sub is not callback)
+
+    return unsubscribe
+
+
+def is_enabled() -> bool:
+    return bool(_subscribers)
+
+
+class _SpanContext:
+    def __init__(self, span: Span) -> None:
+        self.span = span
+        self._token = None
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        if parent is not None:
+            self.span.parent_id = parent.id
+        self._token = _current_span.set(self.span)
+        self.span.start = time.time()
+        self._perf_start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.span.duration = time.perf_counter() - self._perf_start
+        if self._token is not None:
+            _current_span.reset(self._token)
+        if exc is not None:
+            self.span.outcome = "failed"
+            self.span.error = str(exc)
+        _emit(self.span)
+
+
+def span(
+    operation: str,
+    kind: Optional[str],
+    spec: Any,
+    hash: Optional[str] = None,
+    **attributes: Any,
+):
+    """Return a context manager that measures the enclosed operation and
+    emits it as a span to all subscribers. The span can be updated (see
+    Span.update) within the context.
+    """
+    if not _subscribers:
+        return _NULL_SPAN
+    return _SpanContext(
+        Span(
+            operation=operation,
+            kind=kind,
+            spec=str(spec),
+            hash=hash,
+            attributes=attributes,
+            id=next(_span_ids),
+        )
+    )
+
+
+def _emit(span: Span) -> None:
+    for callback in _subscribers:
+        callback(span)
+
+
+class JsonLinesExporter:
+    """Subscriber that appends every span as a JSON line to the given file."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __call__(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "a")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@dataclass
+class PhaseSummary:
+    operation: str
+    count: int = 0
+    failed: int = 0
+    total_duration: float = 0.0
+    max_duration: float = 0.0
+    bytes: int = 0
+    # spec of the environment with the longest duration
+    slowest: Optional[str] = None
+    outcomes: Dict[str, int] = field(default_factory=dict)
+
+
+class SpanAggregator:
+    """Subscriber that keeps all spans in memory and summarizes them per
+    operation.
+    """
+
+    def __init__(self) -> None:
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> Dict[str, PhaseSummary]:
+        summaries: Dict[str, PhaseSummary] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            summary = summaries.setdefault(
+                span.operation, PhaseSummary(operation=span.operation)
+            )
+            summary.count += 1
+            summary.total_duration += span.duration
+            if span.outcome == "failed":
+                summary.failed += 1
+            summary.outcomes[span.outcome] = summary.outcomes.get(span.outcome, 0) + 1
+            if span.bytes is not None:
+                summary.bytes += span.bytes
+            if summary.slowest is None or span.duration > summary.max_duration:
+                summary.max_duration = span.duration
+                summary.slowest = span.spec
+        return summaries
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
@@ -0,0 +1,259 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import ClassVar, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+
+LAYOUT_MARKER = ".layout.json"
+# Seconds for which a loaded layout marker is used without checking the marker
+# file for changes (see LayoutMarker.load).
+MARKER_CHECK_INTERVAL = 1.0
+
+
+@dataclass(frozen=True)
+class PrefixLayout:
+    """Placement of the entries (e.g. deployments or pinfiles, named by their
+    hash) in a prefix.
+
+    By default, all entries are placed directly in the prefix. With
+    shard_levels > 0, they are placed in nested directories named by the
+    leading characters of their name instead (e.g. ab/cd/abcd0123... for two
+    levels of width two), which keeps single directories small on file systems
+    where listing or looking up entries in large directories is slow (e.g.
+    Lustre or GPFS).
+    """
+
+    shard_levels: int = 0
+    shard_width: int = 2
+
+    def __post_init__(self) -> None:
+        if self.shard_levels < 0 or self.shard_width < 1:
+            raise ValueError(
+                "shard_levels must not be negative and shard_width must be at least 1."
+            )
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.shard_levels > 0
+
+    def entry_dir(self, prefix: Path, name: str) -> Path:
+        """Return the directory that holds the entry with given name (and its
+        sidecars).
+        """
+        width = self.shard_width
+        return prefix.joinpath(
+            *(
+                name[level * width : (level + 1) * width]
+                for level in range(self.shard_levels)
+            )
+        )
+
+    def dirs(self, prefix: Path) -> Iterator[Path]:
+        """Yield all existing directories of the prefix that hold entries."""
+        level = [prefix]
+        for _ in range(self.shard_levels):
+            level = [
+                child
+                for parent in level
+                for child in _subdirs(parent)
+                if self.is_shard_dir(child.name)
+            ]
+        yield from level
+
+    def is_shard_dir(self, name: str) -> bool:
+        return (
+            self.is_sharded
+            and len(name) == self.shard_width
+            and not name.startswith(".")
+        )
+
+    def describe(self) -> str:
+        if not self.is_sharded:
+            return "flat"
+        return f"sharded:{self.shard_levels}x{self.shard_width}"
+
+
+@dataclass(frozen=True)
+class LayoutMarker:
+    """Versioned description of the layout of a prefix, stored in the file
+    .layout.json within the prefix. Prefixes without such a file are flat.
+
+    While a prefix is migrated to another layout (see
+    garbage_collection.LayoutMigration), previous is the layout that is
+    migrated from. In the meantime, entries are looked up in both layouts,
+    preferring the new one, and new entries are always placed according to the
+    new layout.
+    """
+
+    VERSION: ClassVar[int] = 1
+
+    layout: PrefixLayout = PrefixLayout()
+    previous: Optional[PrefixLayout] = None
+
+    @property
+    def is_migrating(self) -> bool:
+        return self.previous is not None
+
+    @classmethod
+    def load(cls, prefix: Path, refresh: bool = False) -> "LayoutMarker":
+        """Return the layout marker of the given prefix. Markers only change
+        upon migrations (possibly by another process), hence the marker file is
+        checked for changes (by a single stat call) at most every
+        MARKER_CHECK_INTERVAL seconds, or right away if refresh is True. It is
+        read again only if it has changed.
+        """
+        path = prefix / LAYOUT_MARKER
+        now = time.monotonic()
+        with _markers_lock:
+            cached = _markers.get(prefix)
+        if (
+            cached is not None
+            and not refresh
+            and now - cached[2] < MARKER_CHECK_INTERVAL
+        ):
+            return cached[1]
+        signature = _signature(path)
+        if cached is not None and cached[0] == signature:
+            with _markers_lock:
+                _markers[prefix] = (signature, cached[1], now)
+            return cached[1]
+        try:
+            content = json.loads(path.read_text())
+        except FileNotFoundError:
+            marker = cls()
+        except (OSError, ValueError) as e:
+            raise WorkflowError(f"Unable to read layout marker {path}: {e}") from e
+        else:
+            if not isinstance(content, dict) or content.get("version") != cls.VERSION:
+                raise WorkflowError(
+                    f"Unsupported layout marker {path}, it has probably been "
+                    "written by a newer version of "
+                    "snakemake-interface-software-deployment-plugins."
+                )
+            try:
+                previous = content.get("previous")
+                marker = cls(
+                    layout=PrefixLayout(**content["layout"]),
+                    previous=PrefixLayout(**previous) if previous is not None else None,
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                raise WorkflowError(f"Invalid layout marker {path}: {e}") from e
+        with _markers_lock:
+            # the file might have been replaced while reading it, in which case
+            # the signature does not match anymore and it is read again
+            _markers[prefix] = (signature, marker, now)
+        return marker
+
+    def save(self, prefix: Path) -> None:
+        content = json.dumps(
+            {
+                "version": self.VERSION,
+                "layout": asdict(self.layout),
+                "previous": asdict(self.previous) if self.previous else None,
+            }
+        )
+        prefix.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f"{LAYOUT_MARKER}.", suffix=".part", dir=prefix
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, prefix / LAYOUT_MARKER)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        with _markers_lock:
+            _markers[prefix] = (
+                _signature(prefix / LAYOUT_MARKER),
+                self,
+                time.monotonic(),
+            )
+
+    def layouts(self) -> List[PrefixLayout]:
+        """Return the layouts entries may currently be found in, the one new
+        entries are placed in first.
+        """
+        if self.previous is None or self.previous == self.layout:
+            return [self.layout]
+        return [self.layout, self.previous]
+
+    def entry_dir(self, prefix: Path, name: str, markers: Iterable[str] = ()) -> Path:
+        """Return the directory that holds the entry with given name. While
+        migrating, this is the directory of the previous layout if the entry
+        (i.e. a file with its name or one of the given marker names) exists
+        only there.
+        """
+        target = self.layout.entry_dir(prefix, name)
+        if self.previous is None:
+            return target
+        names = [name, *markers]
+        if any(os.path.lexists(target / item) for item in names):
+            return target
+        previous = self.previous.entry_dir(prefix, name)
+        if any(os.path.lexists(previous / item) for item in names):
+            return previous
+        return target
+
+    def entry_dirs(self, prefix: Path, name: str) -> List[Path]:
+        """Return the directories the entry with given name may be found in,
+        the one of the current layout first.
+        """
+        return [layout.entry_dir(prefix, name) for layout in self.layouts()]
+
+    def iter_entry_paths(self, prefix: Path, hidden: bool = False) -> Iterator[Path]:
+        """Yield all paths (entries and their sidecars) in the directories of
+        all layouts, excluding hidden ones unless hidden is True.
+        """
+        layouts = self.layouts()
+        seen = set()
+        for layout in layouts:
+            for directory in layout.dirs(prefix):
+                if directory in seen:
+                    continue
+                seen.add(directory)
+                try:
+                    children = list(directory.iterdir())
+                except FileNotFoundError:
+                    continue
+                for path in children:
+                    if path.name.startswith(".") and not hidden:
+                        continue
+                    if directory == prefix and any(
+                        other.is_shard_dir(path.name) and path.is_dir()
+                        for other in layouts
+                    ):
+                        continue
+                    yield path
+
+
+# signature of the marker file (None if it does not exist), the marker, and the
+# time (as of time.monotonic) the signature has been checked last
+_markers: Dict[Path, Tuple[Optional[Tuple[int, int, int]], LayoutMarker, float]] = {}
+_markers_lock = threading.Lock()
+
+
+def _signature(path: Path) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _subdirs(path: Path) -> List[Path]:
+    try:
+        return [child for child in path.iterdir() if child.is_dir()]
+    except FileNotFoundError:
+        return []
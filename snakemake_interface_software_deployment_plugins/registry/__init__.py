@@ -3,8 +3,11 @@ __copyright__ = "Copyright 2024, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import importlib
+from pathlib import Path
+import pkgutil
 import types
-from typing import Mapping
+from typing import Collection, Dict, List, Mapping, Optional, Type
 from snakemake_interface_software_deployment_plugins.settings import (
     CommonSettings,
     SoftwareDeploymentSettingsBase,
@@ -15,7 +18,20 @@ from snakemake_interface_common.plugin_registry.attribute_types import (
     AttributeMode,
     AttributeType,
 )
-from snakemake_interface_software_deployment_plugins.registry.plugin import Plugin
+from snakemake_interface_software_deployment_plugins.registry.descriptor import (
+    DescriptorCache,
+    PluginDescriptor,
+    default_descriptor_cache_path,
+    plugin_fingerprint,
+)
+from snakemake_interface_software_deployment_plugins.registry.plugin import (
+    LazyPlugin,
+    Plugin,
+)
+from snakemake_interface_common.exceptions import (
+    InvalidPluginException,
+    WorkflowError,
+)
 from snakemake_interface_common.plugin_registry import PluginRegistryBase
 from snakemake_interface_software_deployment_plugins import (
     EnvBase,
@@ -27,10 +43,153 @@ from snakemake_interface_software_deployment_plugins import (
 class SoftwareDeploymentPluginRegistry(PluginRegistryBase):
     """This class is a singleton that holds all registered executor plugins."""
 
+    _kind_index: Optional[Dict[str, List[Plugin]]] = None
+    _env_cls_index: Optional[Dict[Type[EnvSpecBase], Type[EnvBase]]] = None
+
     @property
     def module_prefix(self) -> str:
         return common.software_deployment_plugin_module_prefix
 
+    def register_plugin(self, name: str, plugin: types.ModuleType) -> None:
+        super().register_plugin(name, plugin)
+        self._kind_index = None
+
+    def get_plugins_by_kind(self, kind: str) -> List[Plugin]:
+        """Return all plugins that provide the given kind of environment."""
+        return self._get_kind_index().get(kind, [])
+
+    def get_by_kind(
+        self, kind: str, active: Optional[Collection[str]] = None
+    ) -> Plugin:
+        """Return the plugin that provides the given kind of environment. If
+        active is given, only plugins with these names are considered.
+        Raises a WorkflowError if there is no or more than one such plugin.
+        """
+        plugins = self._filter_active(self.get_plugins_by_kind(kind), active)
+        if not plugins:
+            raise WorkflowError(
+                f"No software deployment plugin providing {kind} environments "
+                "is installed or activated."
+            )
+        if len(plugins) > 1:
+            raise WorkflowError(self._conflict_message(kind, plugins))
+        return plugins[0]
+
+    def check_kind_conflicts(self, active: Optional[Collection[str]] = None) -> None:
+        """Raise a WorkflowError if more than one of the (active) plugins
+        provides the same kind of environment.
+        """
+        conflicts = []
+        for kind, plugins in sorted(self._get_kind_index().items()):
+            plugins = self._filter_active(plugins, active)
+            if len(plugins) > 1:
+                conflicts.append(self._conflict_message(kind, plugins))
+        if conflicts:
+            raise WorkflowError(*conflicts)
+
+    def get_env_cls(self, env_spec_cls: Type[EnvSpecBase]) -> Type[EnvBase]:
+        """Return the Env class that belongs to the given EnvSpec class,
+        using the already loaded plugin instead of inspecting modules.
+        """
+        if self._env_cls_index is None:
+            self._env_cls_index = {}
+        env_cls = self._env_cls_index.get(env_spec_cls)
+        if env_cls is None:
+            plugin_module = env_spec_cls.__module__.split(".", 1)[0]
+            plugin = self.plugins.get(self._plugin_name(plugin_module))
+            if plugin is None or plugin.env_spec_cls is not env_spec_cls:
+                # e.g. a plugin that is not installed as a package
+                env_cls = env_spec_cls.env_cls()
+            else:
+                env_cls = plugin.env_cls
+            self._env_cls_index[env_spec_cls] = env_cls
+        return env_cls
+
+    def _get_kind_index(self) -> Dict[str, List[Plugin]]:
+        if self._kind_index is None:
+            index: Dict[str, List[Plugin]] = {}
+            for plugin in self.plugins.values():
+                index.setdefault(plugin.common_settings.provides, []).append(plugin)
+            self._kind_index = index
+        return self._kind_index
+
+    @staticmethod
+    def _filter_active(
+        plugins: List[Plugin], active: Optional[Collection[str]]
+    ) -> List[Plugin]:
+        if active is None:
+            return plugins
+        return [plugin for plugin in plugins if plugin.name in active]
+
+    def _conflict_message(self, kind: str, plugins: List[Plugin]) -> str:
+        names = ", ".join(sorted(plugin.name for plugin in plugins))
+        return (
+            f"Multiple software deployment plugins provide {kind} environments "
+            f"({names}). Only one of them may be activated."
+        )
+
+    def collect_plugins(self) -> None:
+        """Collect plugins. Plugins that are known from the descriptor cache are
+        registered without importing them (see LazyPlugin). Others are imported
+        right away and added to the cache, such that subsequent runs do not
+        have to import them anymore.
+        """
+        self.plugins = dict()
+        self._kind_index = None
+        self._env_cls_index = None
+        cache = DescriptorCache(default_descriptor_cache_path())
+        for moduleinfo in pkgutil.iter_modules():
+            if not moduleinfo.ispkg or not moduleinfo.name.startswith(
+                self.module_prefix
+            ):
+                continue
+            fingerprint = plugin_fingerprint(
+                moduleinfo.name, _package_origin(moduleinfo)
+            )
+            descriptor = cache.get(moduleinfo.name, fingerprint)
+            if descriptor is not None:
+                self.register_lazy_plugin(descriptor)
+                continue
+            module = importlib.import_module(moduleinfo.name)
+            self.register_plugin(moduleinfo.name, module)
+            plugin = self.plugins[self._plugin_name(moduleinfo.name)]
+            cache.put(
+                PluginDescriptor(
+                    module=moduleinfo.name,
+                    provides=plugin.common_settings.provides,
+                    has_settings=plugin.settings_cls is not None,
+                    fingerprint=fingerprint,
+                )
+            )
+        cache.save()
+
+    def register_lazy_plugin(self, descriptor: PluginDescriptor) -> None:
+        """Register a plugin by its descriptor, deferring import and validation
+        of its module until its classes are needed.
+        """
+        plugin_name = self._plugin_name(descriptor.module)
+        if plugin_name in self.plugins:
+            return
+
+        def load() -> Plugin:
+            module = importlib.import_module(descriptor.module)
+            self.validate_plugin(descriptor.module, module)
+            plugin = self.load_plugin(plugin_name, module)
+            if plugin.common_settings.provides != descriptor.provides:
+                raise InvalidPluginException(
+                    plugin_name,
+                    "plugin provides a different kind than recorded in the plugin "
+                    f"descriptor cache ({descriptor.provides}). Remove "
+                    f"{default_descriptor_cache_path()} and try again.",
+                )
+            return plugin
+
+        self.plugins[plugin_name] = LazyPlugin(plugin_name, descriptor, load)
+        self._kind_index = None
+
+    def _plugin_name(self, module_name: str) -> str:
+        return module_name.removeprefix(self.module_prefix).replace("_", "-")
+
     def load_plugin(self, name: str, module: types.ModuleType) -> Plugin:
         """Load a plugin by name."""
         return Plugin(
@@ -64,3 +223,10 @@ class SoftwareDeploymentPluginRegistry(PluginRegistryBase):
                 kind=AttributeKind.CLASS,
             ),
         }
+
+
+def _package_origin(moduleinfo: pkgutil.ModuleInfo) -> Optional[Path]:
+    finder_path = getattr(moduleinfo.module_finder, "path", None)
+    if finder_path is None:
+        return None
+    return Path(finder_path) / moduleinfo.name / "__init__.py"
@@ -0,0 +1,133 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+from dataclasses import asdict, dataclass
+import importlib.metadata
+import json
+import os
+from pathlib import Path
+import tempfile
+from typing import Dict, Optional
+
+from snakemake_interface_software_deployment_plugins._common import (
+    distribution_version,
+)
+
+
+@dataclass
+class PluginDescriptor:
+    """Everything the registry needs to know about a plugin without importing
+    it.
+    """
+
+    # name of the plugin module
+    module: str
+    provides: str
+    has_settings: bool
+    # fingerprint of the installed plugin (see plugin_fingerprint), the
+    # descriptor is only valid as long as it does not change
+    fingerprint: str
+
+
+def default_descriptor_cache_path() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "snakemake" / "software-deployment-plugins.json"
+
+
+def plugin_fingerprint(module: str, origin: Optional[Path]) -> str:
+    """Return a string that changes whenever the given plugin module is
+    upgraded, downgraded, or (in case of editable installs) modified.
+    """
+    version = distribution_version(module)
+    mtime_ns = None
+    if origin is not None:
+        try:
+            mtime_ns = origin.stat().st_mtime_ns
+        except OSError:
+            pass
+    return f"{version}:{origin}:{mtime_ns}"
+
+
+class DescriptorCache:
+    """Persistent cache of plugin descriptors, stored as a single JSON file.
+
+    Single descriptors are invalidated by the fingerprint of their plugin, the
+    entire cache by the installed version of this interface package.
+    Writing is best effort, such that a read-only or missing cache directory
+    only means that plugins have to be imported for discovery.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Optional[Path]) -> None:
+        self.path = path
+        self._descriptors: Optional[Dict[str, PluginDescriptor]] = None
+        self._dirty = False
+
+    def get(self, module: str, fingerprint: str) -> Optional[PluginDescriptor]:
+        descriptor = self._load().get(module)
+        if descriptor is None or descriptor.fingerprint != fingerprint:
+            return None
+        return descriptor
+
+    def put(self, descriptor: PluginDescriptor) -> None:
+        descriptors = self._load()
+        if descriptors.get(descriptor.module) != descriptor:
+            descriptors[descriptor.module] = descriptor
+            self._dirty = True
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+        content = json.dumps(
+            {
+                "version": self.VERSION,
+                "interface_version": _interface_version(),
+                "descriptors": [
+                    asdict(descriptor) for descriptor in self._load().values()
+                ],
+            }
+        )
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=f".{self.path.name}.", suffix=".part", dir=self.path.parent
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+        except OSError:
+            return
+        self._dirty = False
+
+    def _load(self) -> Dict[str, PluginDescriptor]:
+        if self._descriptors is None:
+            self._descriptors = {}
+            if self.path is not None:
+                try:
+                    content = json.loads(self.path.read_text())
+                    if (
+                        content.get("version") == self.VERSION
+                        and content.get("interface_version") == _interface_version()
+                    ):
+                        for item in content["descriptors"]:
+                            descriptor = PluginDescriptor(**item)
+                            self._descriptors[descriptor.module] = descriptor
+                except (OSError, ValueError, TypeError, KeyError, AttributeError):
+                    self._descriptors = {}
+        return self._descriptors
+
+
+def _interface_version() -> Optional[str]:
+    try:
+        return importlib.metadata.version(
+            "snakemake-interface-software-deployment-plugins"
+        )
+    except importlib.metadata.PackageNotFoundError:
+        return None
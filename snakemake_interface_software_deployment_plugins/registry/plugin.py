@@ -4,8 +4,11 @@ __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
 from dataclasses import dataclass
-from typing import Optional, Type
+from typing import Callable, Optional, Type
 from snakemake_interface_software_deployment_plugins import EnvBase, EnvSpecBase
+from snakemake_interface_software_deployment_plugins.registry.descriptor import (
+    PluginDescriptor,
+)
 from snakemake_interface_software_deployment_plugins.settings import (
     CommonSettings,
     SoftwareDeploymentSettingsBase,
@@ -46,3 +49,61 @@ class Plugin(PluginBase):
     @property
     def env_spec_cls(self):
         return self._env_spec_cls
+
+
+class LazyPlugin(Plugin):
+    """Plugin that is known from its descriptor only, and whose module is
+    imported (and validated) not before its classes are needed.
+
+    The fields of the Plugin dataclass are not set, hence equality, hashing and
+    representation are based on name and descriptor instead.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        descriptor: PluginDescriptor,
+        load: Callable[[], Plugin],
+    ) -> None:
+        self._name = name
+        self.descriptor = descriptor
+        self.common_settings = CommonSettings(provides=descriptor.provides)
+        self._load = load
+        self._loaded: Optional[Plugin] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded is not None
+
+    def load(self) -> Plugin:
+        if self._loaded is None:
+            self._loaded = self._load()
+        return self._loaded
+
+    @property
+    def settings_cls(self):
+        if not self.descriptor.has_settings:
+            return None
+        return self.load().settings_cls
+
+    @property
+    def env_cls(self):
+        return self.load().env_cls
+
+    @property
+    def env_spec_cls(self):
+        return self.load().env_spec_cls
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, LazyPlugin):
+            return NotImplemented
+        return self._name == other._name and self.descriptor == other.descriptor
+
+    def __hash__(self) -> int:
+        return hash((self._name, self.descriptor.module, self.descriptor.fingerprint))
+
+    def __repr__(self) -> str:
+        return (
+            f"LazyPlugin(name={self._name!r}, provides={self.descriptor.provides!r}, "
+            f"loaded={self.is_loaded})"
+        )
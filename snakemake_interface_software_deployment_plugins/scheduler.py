@@ -0,0 +1,174 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+from dataclasses import dataclass
+from enum import Enum
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from snakemake_interface_software_deployment_plugins import (
+    DeployableEnvBase,
+    EnvBase,
+    PinnableEnvBase,
+)
+
+
+class EnvOutcomeStatus(Enum):
+    SUCCESS = "success"
+    FAILED = "failed"
+    # not attempted because an environment it runs within failed
+    SKIPPED = "skipped"
+
+
+@dataclass
+class EnvOutcome:
+    env: EnvBase
+    status: EnvOutcomeStatus
+    error: Optional[Exception] = None
+
+    @property
+    def success(self) -> bool:
+        return self.status == EnvOutcomeStatus.SUCCESS
+
+
+class EnvScheduler:
+    """Run operations on many environments concurrently.
+
+    Environments are deduplicated (by their deployment hash when deploying and
+    by their hash when pinning), and an environment is only deployed once the
+    environment it runs within (if that is part of the given environments as
+    well) has been deployed successfully.
+    Independent environments are processed concurrently, with at most
+    max_jobs operations running at the same time. Failures are reported per
+    environment and do not abort unrelated operations.
+    """
+
+    def __init__(self, max_jobs: int = 8) -> None:
+        if max_jobs < 1:
+            raise ValueError("max_jobs must be at least 1.")
+        self.max_jobs = max_jobs
+
+    async def deploy(self, envs: Iterable[DeployableEnvBase]) -> List[EnvOutcome]:
+        """Deploy given environments, returning one outcome per given
+        environment (in the same order).
+        """
+        return await self._run(
+            envs,
+            self._deployment_key,
+            lambda env: env.managed_deploy(),
+            respect_within=True,
+        )
+
+    async def pin(
+        self, envs: Iterable[PinnableEnvBase], force: bool = False
+    ) -> List[EnvOutcome]:
+        """Pin given environments, returning one outcome per given environment
+        (in the same order). Environments with the same hash are pinned only
+        once, and existing pinfiles are reused unless force is True.
+        """
+        return await self._run(
+            envs,
+            self._pinning_key,
+            lambda env: env.managed_pin(force=force),
+            respect_within=False,
+        )
+
+    async def _run(
+        self,
+        envs: Iterable[Any],
+        key: Callable[[Any], Hashable],
+        operation: Callable[[Any], Awaitable[None]],
+        respect_within: bool,
+    ) -> List[EnvOutcome]:
+        envs = list(envs)
+        unique: Dict[Hashable, EnvBase] = {}
+        # key of each given environment, or the error raised when computing it
+        # (e.g. because a source file is missing)
+        keys: List[Tuple[Optional[Hashable], Optional[Exception]]] = []
+        for env in envs:
+            try:
+                env_key = key(env)
+            except Exception as e:
+                keys.append((None, e))
+                continue
+            keys.append((env_key, None))
+            unique.setdefault(env_key, env)
+
+        semaphore = asyncio.Semaphore(self.max_jobs)
+        tasks: Dict[Hashable, asyncio.Task] = {}
+
+        async def run_one(env: EnvBase) -> EnvOutcome:
+            try:
+                dependency = (
+                    self._scheduled_within(env, unique, key) if respect_within else None
+                )
+            except Exception as e:
+                return EnvOutcome(env=env, status=EnvOutcomeStatus.FAILED, error=e)
+            if dependency is not None:
+                outcome = await tasks[key(dependency)]
+                if not outcome.success:
+                    return EnvOutcome(
+                        env=env,
+                        status=EnvOutcomeStatus.SKIPPED,
+                        error=outcome.error,
+                    )
+            async with semaphore:
+                try:
+                    await operation(env)
+                except Exception as e:
+                    return EnvOutcome(env=env, status=EnvOutcomeStatus.FAILED, error=e)
+            return EnvOutcome(env=env, status=EnvOutcomeStatus.SUCCESS)
+
+        for env_key, env in unique.items():
+            tasks[env_key] = asyncio.create_task(run_one(env))
+        await asyncio.gather(*tasks.values())
+
+        outcomes = []
+        for env, (env_key, error) in zip(envs, keys):
+            if error is not None:
+                outcomes.append(
+                    EnvOutcome(env=env, status=EnvOutcomeStatus.FAILED, error=error)
+                )
+                continue
+            outcome = tasks[env_key].result()
+            outcomes.append(
+                EnvOutcome(env=env, status=outcome.status, error=outcome.error)
+            )
+        return outcomes
+
+    @staticmethod
+    def _deployment_key(env: DeployableEnvBase) -> Tuple[Type, str]:
+        return (env.__class__, env.deployment_hash())
+
+    @staticmethod
+    def _pinning_key(env: PinnableEnvBase) -> Tuple[Type, str]:
+        return (env.__class__, env.hash())
+
+    def _scheduled_within(
+        self,
+        env: EnvBase,
+        scheduled: Dict[Hashable, EnvBase],
+        key: Callable[[Any], Hashable],
+    ) -> Optional[EnvBase]:
+        # Walk up the within chain until an environment is found that is
+        # scheduled as well. Environments in between that are not scheduled
+        # are considered to be available already.
+        within = env.within
+        while within is not None:
+            if isinstance(within, DeployableEnvBase) and key(within) in scheduled:
+                return within
+            within = within.within
+        return None
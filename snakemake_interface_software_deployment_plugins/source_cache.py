@@ -0,0 +1,203 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2024, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path, PurePosixPath
+import tempfile
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+from snakemake_interface_software_deployment_plugins import (
+    EnvSpecBase,
+    EnvSpecSourceFile,
+    _write_atomically,
+    instrumentation,
+)
+from snakemake_interface_software_deployment_plugins._locking import FileLock
+
+
+_CHUNK_SIZE = 1024 * 1024
+_REMOTE_SCHEMES = ("http", "https")
+
+
+def iter_source_files(specs: Iterable[EnvSpecBase]) -> Iterator[EnvSpecSourceFile]:
+    """Yield all source files of given specs, including those of their within
+    and fallback specs.
+    """
+    stack = list(specs)
+    seen = set()
+    while stack:
+        spec = stack.pop()
+        if id(spec) in seen:
+            continue
+        seen.add(id(spec))
+        for attr in spec.source_path_attributes():
+            source_file = getattr(spec, attr, None)
+            if source_file is not None:
+                yield source_file
+        for attr in ("within", "fallback"):
+            chained = getattr(spec, attr, None)
+            if chained is not None:
+                stack.append(chained)
+
+
+class SourceFileCache:
+    """Local cache of the source files of env specs (see
+    EnvSpecBase.source_path_attributes).
+
+    Remote files (http or https URIs) are downloaded into cache_dir, stored
+    by their URI (after applying the suffix replacement). If a file has been
+    downloaded before, it is revalidated via ETag and Last-Modified instead of
+    downloading it again. If revalidation is impossible (e.g. when being
+    offline), the local copy is used. Local files are used in place.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_jobs: int = 8,
+        timeout: float = 60.0,
+        revalidate: bool = True,
+    ) -> None:
+        if max_jobs < 1:
+            raise ValueError("max_jobs must be at least 1.")
+        self.cache_dir = cache_dir
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.revalidate = revalidate
+
+    async def fetch_specs(self, specs: Iterable[EnvSpecBase]) -> None:
+        """Fetch the source files of all given specs concurrently and set
+        their cached attribute to the local copy. Each distinct URI is fetched
+        only once.
+        """
+        await self.fetch_all(iter_source_files(specs))
+
+    async def fetch_all(self, source_files: Iterable[EnvSpecSourceFile]) -> None:
+        source_files = list(source_files)
+        semaphore = asyncio.Semaphore(self.max_jobs)
+
+        async def fetch(uri: str) -> Path:
+            async with semaphore:
+                return await self._fetch_uri(uri)
+
+        tasks: Dict[str, asyncio.Task] = {}
+        uris: List[str] = []
+        for source_file in source_files:
+            uri = source_file.replaced_path_or_uri()
+            uris.append(uri)
+            if uri not in tasks:
+                tasks[uri] = asyncio.create_task(fetch(uri))
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        for source_file, uri in zip(source_files, uris):
+            task = tasks[uri]
+            if task.exception() is None:
+                source_file.cached = task.result()
+        errors = [
+            task.exception() for task in tasks.values() if task.exception() is not None
+        ]
+        if errors:
+            raise WorkflowError(
+                f"Fetching of {len(errors)} source files failed.", *errors
+            )
+
+    async def fetch(self, source_file: EnvSpecSourceFile) -> Path:
+        """Fetch the given source file, set its cached attribute to the local
+        copy and return it.
+        """
+        source_file.cached = await self._fetch_uri(source_file.replaced_path_or_uri())
+        return source_file.cached
+
+    def local_path(self, uri: str) -> Path:
+        """Return the path under which the given remote URI is cached."""
+        key = hashlib.sha256(uri.encode()).hexdigest()
+        name = PurePosixPath(urllib.parse.urlparse(uri).path).name or "source"
+        return self.cache_dir / key / name
+
+    async def _fetch_uri(self, uri: str) -> Path:
+        parsed = urllib.parse.urlparse(uri)
+        if parsed.scheme == "file":
+            return Path(urllib.parse.unquote(parsed.path))
+        if parsed.scheme not in _REMOTE_SCHEMES:
+            return Path(uri)
+        path = self.local_path(uri)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with instrumentation.span("fetch_source", None, uri) as span:
+            async with FileLock(path.parent / ".lock"):
+                outcome, size = await asyncio.to_thread(self._download, uri, path)
+            span.update(outcome=outcome, bytes=size)
+        return path
+
+    def _download(self, uri: str, path: Path) -> Tuple[str, int]:
+        meta_path = path.parent / ".meta.json"
+        meta = _load_meta(meta_path) if path.exists() else None
+        if meta is not None and not self.revalidate:
+            return "skipped", 0
+        request = urllib.request.Request(uri)
+        if meta is not None:
+            if meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                request.add_header("If-Modified-Since", meta["last_modified"])
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                size = self._write_response(response, path)
+                _write_atomically(
+                    meta_path,
+                    json.dumps(
+                        {
+                            "uri": uri,
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                        }
+                    ),
+                )
+                return "success", size
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta is not None:
+                return "revalidated", 0
+            raise WorkflowError(f"Failed to fetch {uri}: {e}") from e
+        except OSError as e:
+            if meta is not None:
+                # e.g. offline, use the local copy
+                return "stale", 0
+            raise WorkflowError(f"Failed to fetch {uri}: {e}") from e
+
+    @staticmethod
+    def _write_response(response: Any, path: Path) -> int:
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f".{path.name}.", suffix=".part", dir=path.parent
+        )
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                while chunk := response.read(_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            expected = response.headers.get("Content-Length")
+            if expected is not None and int(expected) != size:
+                raise IOError(
+                    f"Incomplete response (expected {expected} bytes, got {size})."
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return size
+
+
+def _load_meta(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
@@ -1,4 +1,3 @@
-from typing import Union
 from typing import List
 from pathlib import Path
 from abc import ABC, abstractmethod
@@ -113,11 +112,7 @@ class TestSoftwareDeploymentBase(ABC):
 
         assert isinstance(env, CacheableEnvBase)
 
-        async def cache_assets(env):
-            for asset in await env.get_cache_assets():
-                await env.managed_cache_asset(asset)
-
-        asyncio.run(cache_assets(env))
+        asyncio.run(env.managed_cache_assets())
 
         self._deploy(env, tmp_path)
 
@@ -130,7 +125,7 @@ class TestSoftwareDeploymentBase(ABC):
 
         assert isinstance(env, PinnableEnvBase)
 
-        asyncio.run(env.pin())
+        asyncio.run(env.managed_pin())
         assert env.pinfile.exists()
         print("Pinfile content:", env.pinfile.read_text(), sep="\n")
         self._deploy(env, tmp_path)
@@ -167,11 +162,7 @@ class TestSoftwareDeploymentBase(ABC):
             source_file = getattr(spec, attr)
             if source_file is not None:
                 if source_file.suffix_replacement is not None:
-                    source_file.path_or_uri = _replace_suffix(
-                        source_file.path_or_uri,
-                        source_file.suffix_replacement.old_suffixes,
-                        source_file.suffix_replacement.new_suffix,
-                    )
+                    source_file.path_or_uri = source_file.replaced_path_or_uri()
                     source_file.suffix_replacement = None
                 source_file.cached = Path(source_file.path_or_uri)
         return spec
@@ -245,11 +236,3 @@ class TestSoftwareDeploymentBase(ABC):
         assert isinstance(env, DeployableEnvBase)
         asyncio.run(env.deploy())
         assert any((tmp_path / env.spec.module().__name__ / "deployments").iterdir())
-
-
-def _replace_suffix(path: Union[Path, str], suffix: List[str], replacement: str) -> str:
-    path = str(path)
-    for suff in suffix:
-        if path.endswith(suff):
-            return path[: -len(suff)] + replacement
-    raise ValueError(f"Path {path} does not end with any of the suffixes {suffix}")
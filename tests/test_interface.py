@@ -1,17 +1,482 @@
-from snakemake_interface_software_deployment_plugins import EnvSpecSourceFile
+import asyncio
+import gc
+import hashlib
+import importlib.metadata
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+import pickle
+import shlex
+import shutil
+import socket
+import subprocess as sp
+import sys
+import threading
+import time
+import urllib.request
+import weakref
+
+import pytest
+
+from snakemake_interface_software_deployment_plugins import (
+    CacheableEnvBase,
+    CacheAssetStatus,
+    DeployableEnvBase,
+    DeploymentState,
+    EnvBase,
+    EnvSpecBase,
+    EnvSpecSourceFile,
+    PinnableEnvBase,
+    ShellExecutable,
+)
 from pathlib import Path
-from typing import List
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    overload,
+)
+from snakemake_interface_software_deployment_plugins.garbage_collection import (
+    GarbageCollector,
+    LayoutMigration,
+)
+from snakemake_interface_software_deployment_plugins import instrumentation
+from snakemake_interface_software_deployment_plugins._common import (
+    distribution_version,
+)
+from snakemake_interface_software_deployment_plugins._hash_index import HashIndex
+from snakemake_interface_software_deployment_plugins._locking import FileLock
+from snakemake_interface_software_deployment_plugins.fallback import FallbackResolver
+from snakemake_interface_software_deployment_plugins.layout import (
+    LayoutMarker,
+    PrefixLayout,
+    _signature,
+)
 from snakemake_interface_software_deployment_plugins.registry import (
     SoftwareDeploymentPluginRegistry,
 )
+from snakemake_interface_software_deployment_plugins.registry.plugin import (
+    LazyPlugin,
+    Plugin,
+)
+from snakemake_interface_software_deployment_plugins.source_cache import (
+    SourceFileCache,
+)
+from snakemake_interface_software_deployment_plugins.scheduler import (
+    EnvOutcomeStatus,
+    EnvScheduler,
+)
+from snakemake_interface_software_deployment_plugins.settings import CommonSettings
 from snakemake_interface_common.plugin_registry.tests import TestRegistryBase
 from snakemake_interface_common.plugin_registry.plugin import PluginBase, SettingsBase
 from snakemake_interface_common.plugin_registry import PluginRegistryBase
+from snakemake_interface_common.exceptions import WorkflowError
+
+# This module acts as a minimal software deployment plugin for testing the
+# functionality provided by the interface itself.
+common_settings = CommonSettings(provides="dummy")
+
+
+class EnvSpec(EnvSpecBase):
+    def __init__(
+        self,
+        name: str,
+        fail: bool = False,
+        envfile: Optional[EnvSpecSourceFile] = None,
+    ):
+        super().__init__()
+        self.name = name
+        self.fail = fail
+        self.envfile = envfile
+
+    @classmethod
+    def identity_attributes(cls) -> Iterable[str]:
+        yield "name"
+        yield "envfile"
+
+    @classmethod
+    def source_path_attributes(cls) -> Iterable[str]:
+        yield "envfile"
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class Env(DeployableEnvBase):
+    spec: EnvSpec
+
+    def __post_init__(self):
+        self.events: List[str] = []
+        self.deploy_delay = 0.0
+        self.snapshottable = False
+
+    def is_activation_snapshottable(self) -> bool:
+        return self.snapshottable
+
+    def decorate_shellcmd(self, cmd: str) -> str:
+        return f"DUMMY_ENV={self.spec.name} {cmd}"
+
+    def contains_executable(self, executable: str) -> bool:
+        return False
+
+    def record_hash(self, hash_object) -> None:
+        hash_object.update(self.spec.name.encode())
+        if self.spec.envfile is not None:
+            self.events.append("read envfile")
+            hash_object.update(Path(self.spec.envfile.path_or_uri).read_bytes())
+
+    def report_software(self):
+        return ()
+
+    def is_deployment_path_portable(self) -> bool:
+        return True
+
+    async def deploy(self) -> None:
+        self.events.append(f"start {self.spec.name}")
+        await asyncio.sleep(self.deploy_delay)
+        if self.spec.fail:
+            raise ValueError(f"deployment of {self.spec.name} failed")
+        (self.deployment_path / "bin").mkdir(parents=True)
+        (self.deployment_path / "bin" / "tool").touch(mode=0o755)
+        with open(self._deployment_prefix.parent / "deploy.log", "a") as log:
+            print(self.spec.name, file=log)
+        self.events.append(f"end {self.spec.name}")
+
+    def remove(self) -> None:
+        shutil.rmtree(self.deployment_path)
+
+    def executable_dirs(self) -> Optional[Iterable[Path]]:
+        return [self.deployment_path / "bin"]
+
+    @EnvBase.memoize(maxsize=2)
+    def probe(self, value: int) -> int:
+        self.events.append(f"probe {value}")
+        return value
+
+    @EnvBase.memoize
+    async def async_probe(self) -> str:
+        self.events.append("async probe")
+        await asyncio.sleep(0.05)
+        return self.spec.name
+
+
+class CacheableEnv(Env, CacheableEnvBase):
+    url: str
+
+    async def get_cache_assets(self) -> Iterable[str]:
+        return ["a.bin", "b.bin"]
+
+    def supports_cache_asset_resume(self) -> bool:
+        return True
+
+    async def cache_asset(self, asset: str, to_path: Path) -> None:
+        def download():
+            offset = to_path.stat().st_size
+            request = urllib.request.Request(
+                f"{self.url}/{asset}", headers={"Range": f"bytes={offset}-"}
+            )
+            with urllib.request.urlopen(request) as response, open(to_path, "ab") as f:
+                remaining = int(response.headers["Content-Length"])
+                while chunk := response.read(1024):
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining:
+                raise IOError(f"Download of {asset} interrupted.")
+
+        await asyncio.to_thread(download)
+
+
+class DedupCacheableEnv(CacheableEnv):
+    """Caches assets with identical content under different names."""
+
+    digest: Optional[str] = None
+
+    async def get_cache_assets(self) -> Iterable[str]:
+        return [f"{self.spec.name}.bin"]
+
+    def is_cache_content_addressable(self) -> bool:
+        return True
+
+    async def cache_asset_digest(self, asset: str) -> Optional[str]:
+        return self.digest
+
+    async def cache_asset(self, asset: str, to_path: Path) -> None:
+        self.events.append(f"cache {asset}")
+        to_path.write_bytes(b"shared content")
+
+
+class PinnableEnv(Env, PinnableEnvBase):
+    running = 0
+    max_running = 0
+
+    @classmethod
+    def pinfile_extension(cls) -> str:
+        return ".pin"
+
+    async def pin(self) -> None:
+        self.events.append(f"pin {self.spec.name}")
+        PinnableEnv.running += 1
+        PinnableEnv.max_running = max(PinnableEnv.max_running, PinnableEnv.running)
+        try:
+            await asyncio.sleep(0.05)
+            if self.spec.fail:
+                raise ValueError(f"pinning of {self.spec.name} failed")
+            self.pinfile.write_text(f"{self.spec.name}==1.0\n")
+        finally:
+            PinnableEnv.running -= 1
+
+
+class AssetServer(ThreadingHTTPServer):
+    """Local stand-in for a remote server that hosts cache assets."""
+
+    def __init__(self, assets: Dict[str, bytes]):
+        self.assets = assets
+        self.requests: List[Tuple[str, Optional[str]]] = []
+        # paths for which the next response is interrupted halfway
+        self.interrupt: Set[str] = set()
+        # number of conditional requests answered with 304 Not Modified
+        self.not_modified = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                server = handler.server
+                assert isinstance(server, AssetServer)
+                range_header = handler.headers.get("Range")
+                server.requests.append((handler.path, range_header))
+                content = server.assets[handler.path.lstrip("/")]
+                etag = f'"{hashlib.md5(content).hexdigest()}"'
+                if handler.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    handler.send_response(304)
+                    handler.end_headers()
+                    return
+                offset = 0
+                if range_header is not None:
+                    offset = int(range_header.removeprefix("bytes=").rstrip("-"))
+                handler.send_response(206 if offset else 200)
+                handler.send_header("Content-Length", str(len(content) - offset))
+                handler.send_header("ETag", etag)
+                handler.send_header("Last-Modified", "Mon, 05 Oct 2026 12:00:00 GMT")
+                handler.end_headers()
+                if handler.path in server.interrupt:
+                    server.interrupt.remove(handler.path)
+                    handler.wfile.write(content[offset : len(content) // 2])
+                    handler.close_connection = True
+                    return
+                handler.wfile.write(content[offset:])
+
+            def log_message(handler, format: str, *args: Any) -> None:
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+E = TypeVar("E", bound=Env)
+
+
+@overload
+def make_env(
+    tmp_path: Path,
+    name: str,
+    within: Optional[Env] = None,
+    fail: bool = False,
+    envfile: Optional[Path] = None,
+) -> Env: ...
+
+
+@overload
+def make_env(
+    tmp_path: Path,
+    name: str,
+    within: Optional[Env] = None,
+    fail: bool = False,
+    envfile: Optional[Path] = None,
+    *,
+    env_cls: Type[E],
+) -> E: ...
+
+
+def make_env(
+    tmp_path: Path,
+    name: str,
+    within: Optional[Env] = None,
+    fail: bool = False,
+    envfile: Optional[Path] = None,
+    env_cls: Type[Env] = Env,
+) -> Env:
+    spec = EnvSpec(
+        name,
+        fail=fail,
+        envfile=EnvSpecSourceFile(envfile) if envfile is not None else None,
+    )
+    spec.technical_init()
+    (tmp_path / "cache").mkdir(exist_ok=True)
+    return env_cls(
+        spec=spec,
+        within=within,
+        settings=None,
+        shell_executable=ShellExecutable("bash", command_arg="-c"),
+        mountpoints=[],
+        tempdir=tmp_path / "temp",
+        cache_prefix=tmp_path / "cache",
+        deployment_prefix=tmp_path / "deployments",
+        pinfile_prefix=tmp_path / "pinfiles",
+    )
+
+
+# minimal plugin package for testing discovery
+PLUGIN_SOURCE = """
+from snakemake_interface_software_deployment_plugins import EnvBase, EnvSpecBase
+from snakemake_interface_software_deployment_plugins.settings import CommonSettings
+
+common_settings = CommonSettings(provides="{kind}")
+
+
+class EnvSpec(EnvSpecBase):
+    @classmethod
+    def identity_attributes(cls):
+        return ()
+
+    @classmethod
+    def source_path_attributes(cls):
+        return ()
+
+    def __str__(self):
+        return "{kind}"
+
+
+class Env(EnvBase):
+    def decorate_shellcmd(self, cmd):
+        return cmd
+
+    def contains_executable(self, executable):
+        return False
+
+    def record_hash(self, hash_object):
+        pass
+
+    def report_software(self):
+        return ()
+"""
+
+
+@pytest.fixture
+def plugin_packages(tmp_path, monkeypatch):
+    """Return a function that installs a synthetic plugin package and a
+    function that rediscovers plugins with a fresh registry.
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache-home"))
+    plugin_dir = tmp_path / "plugins"
+    plugin_dir.mkdir()
+    monkeypatch.syspath_prepend(str(plugin_dir))
+    modules = []
+
+    def install(name: str, provides: Optional[str] = None) -> Path:
+        module = f"snakemake_software_deployment_plugin_{name}"
+        modules.append(module)
+        init = plugin_dir / module / "__init__.py"
+        init.parent.mkdir(exist_ok=True)
+        init.write_text(PLUGIN_SOURCE.format(kind=provides or name))
+        return init
+
+    def discover() -> SoftwareDeploymentPluginRegistry:
+        for module in modules:
+            sys.modules.pop(module, None)
+        SoftwareDeploymentPluginRegistry._instance = None
+        registry = SoftwareDeploymentPluginRegistry()
+        assert isinstance(registry, SoftwareDeploymentPluginRegistry)
+        return registry
+
+    yield install, discover
+    for module in modules:
+        sys.modules.pop(module, None)
+    SoftwareDeploymentPluginRegistry._instance = None
+
+
+def test_lazy_plugin_discovery(plugin_packages):
+    install, discover = plugin_packages
+    init = install("lazytest")
+    module = "snakemake_software_deployment_plugin_lazytest"
+
+    # unknown plugins are imported and recorded in the descriptor cache
+    plugin = discover().get_plugin("lazytest")
+    assert not isinstance(plugin, LazyPlugin)
+    assert module in sys.modules
+
+    plugin = discover().get_plugin("lazytest")
+    assert isinstance(plugin, LazyPlugin)
+    assert plugin.common_settings.provides == "lazytest"
+    assert not plugin.has_settings_cls()
+    assert module not in sys.modules
+    assert plugin.env_cls.__name__ == "Env"
+    assert plugin.is_loaded and module in sys.modules
+    assert plugin == plugin and hash(plugin) == hash(plugin)
+    again = discover().get_plugin("lazytest")
+    assert again == plugin and again is not plugin
+    assert repr(plugin) == (
+        "LazyPlugin(name='lazytest', provides='lazytest', loaded=True)"
+    )
+
+    # modified plugins are imported again
+    stat = init.stat()
+    os.utime(init, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not isinstance(discover().get_plugin("lazytest"), LazyPlugin)
+
+
+def test_plugin_lookup_by_kind(plugin_packages):
+    install, discover = plugin_packages
+    install("kindtest")
+    install("kindtest_a", provides="conflicting")
+    install("kindtest_b", provides="conflicting")
+    discover()
+    # second discovery is served from the descriptor cache
+    registry = discover()
+
+    plugin = registry.get_by_kind("kindtest")
+    assert plugin.name == "kindtest" and isinstance(plugin, LazyPlugin)
+    with pytest.raises(WorkflowError, match="kindtest-a, kindtest-b"):
+        registry.get_by_kind("conflicting")
+    with pytest.raises(WorkflowError, match="conflicting"):
+        registry.check_kind_conflicts()
+    active = ["kindtest", "kindtest-b"]
+    registry.check_kind_conflicts(active=active)
+    assert registry.get_by_kind("conflicting", active=active).name == "kindtest-b"
+    with pytest.raises(WorkflowError, match="No software deployment plugin"):
+        registry.get_by_kind("unknown")
+
+    assert not plugin.is_loaded
+    env_spec_cls = plugin.env_spec_cls
+    assert registry.get_env_cls(env_spec_cls) is plugin.env_cls
+    assert registry.get_env_cls(EnvSpec) is Env
 
 
 class TestRegistry(TestRegistryBase):
     __test__ = True
 
+    @pytest.fixture(autouse=True)
+    def cache_home(self, tmp_path, monkeypatch):
+        # do not touch the descriptor cache of the user
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache-home"))
+
     def get_registry(self) -> PluginRegistryBase:
         # ensure that the singleton is reset
         SoftwareDeploymentPluginRegistry._instance = None
@@ -21,9 +486,10 @@ class TestRegistry(TestRegistryBase):
         return "envmodules"
 
     def validate_plugin(self, plugin: PluginBase):
+        assert isinstance(plugin, Plugin)
         assert plugin.settings_cls is None
-        assert plugin.env_cls is not None  # pyrefly: ignore[missing-attribute]
-        assert plugin.env_spec_cls is not None  # pyrefly: ignore[missing-attribute]
+        assert plugin.env_cls is not None
+        assert plugin.env_spec_cls is not None
 
     def validate_settings(self, settings: SettingsBase, plugin: PluginBase):
         # assert isinstance(settings, plugin.settings_cls)
@@ -35,3 +501,1030 @@ class TestRegistry(TestRegistryBase):
 
 def test_env_spec_source_file():
     EnvSpecSourceFile(path_or_uri="test.yaml", cached=Path("test.yaml"))
+
+
+def _spec(name: str, envfile: Optional[str] = None) -> EnvSpec:
+    spec = EnvSpec(name, envfile=EnvSpecSourceFile(envfile) if envfile else None)
+    spec.technical_init()
+    return spec
+
+
+def test_env_spec_hash():
+    spec = _spec("a", "a.yaml")
+    spec.within = _spec("outer")
+    same = _spec("a", "a.yaml")
+    same.within = _spec("outer")
+    assert hash(spec) == hash(same) and spec == same
+    assert spec._obj_hash is not None
+
+    # modifications of the spec itself and of its within spec are reflected
+    spec.name = "b"
+    assert spec._obj_hash is None
+    assert spec != same
+    spec.name = "a"
+    assert hash(spec) == hash(same)
+    spec.within.name = "other"
+    assert hash(spec) != hash(same) and spec != same
+    spec.within.name = "outer"
+
+    with_fallback = spec | _spec("fallback")
+    assert hash(with_fallback) != hash(spec) and with_fallback != spec
+    assert hash(spec) == hash(same)
+
+    modified = spec.modify_source_paths(
+        lambda source_file: EnvSpecSourceFile(f"workflow/{source_file.path_or_uri}")
+    )
+    assert modified.envfile is not None
+    assert modified.envfile.path_or_uri == "workflow/a.yaml"
+    assert hash(modified) != hash(spec) and modified != spec
+    assert hash(spec) == hash(same) and spec == same
+
+    # copies (e.g. by |) and unpickled specs chain to the same or copied specs
+    fallback = _spec("fallback")
+    with_fallback = spec | fallback
+    loaded = pickle.loads(pickle.dumps(with_fallback))
+    before = hash(with_fallback)
+    assert hash(loaded) == before
+    fallback.name = "other"
+    assert hash(with_fallback) != before
+    assert with_fallback.fallback is not None
+    assert loaded.fallback is not None
+    loaded.fallback.name = "other"
+    assert hash(loaded) == hash(with_fallback)
+
+    # modifications only invalidate the cached hashes of affected specs
+    assert "_chain_hash" in same.__dict__
+    assert same.within is not None and "_chain_hash" in same.within.__dict__
+    spec.within.name = "changed"
+    assert "_chain_hash" in same.__dict__ and "_chain_hash" not in spec.__dict__
+    del with_fallback, loaded
+    gc.collect()
+    assert not fallback.__dict__.get("_chaining_specs")
+
+
+def test_env_spec_pickling():
+    spec = _spec("a", "a.yaml")
+    spec.within = _spec("outer")
+    # populate the cached hashes and the canonical status
+    spec = spec.interned()
+    hash(spec)
+
+    loaded = pickle.loads(pickle.dumps(spec))
+    assert "_chain_hash" not in loaded.__dict__
+    assert not loaded.__dict__.get("_interned")
+    assert loaded == spec and hash(loaded) == hash(spec)
+
+    # the spec is equal to an identical one constructed in another process
+    script = (
+        "import pickle, sys\n"
+        "from test_interface import _spec\n"
+        "loaded = pickle.loads(sys.stdin.buffer.read())\n"
+        "expected = _spec('a', 'a.yaml')\n"
+        "expected.within = _spec('outer')\n"
+        "assert loaded == expected and hash(loaded) == hash(expected)\n"
+        "assert {expected: True}[loaded]\n"
+    )
+    sp.run(
+        [sys.executable, "-c", script],
+        input=pickle.dumps(spec),
+        cwd=Path(__file__).parent,
+        check=True,
+    )
+
+
+def test_env_spec_interning():
+    def make():
+        spec = _spec("a", "a.yaml")
+        spec.within = _spec("outer", "outer.yaml")
+        return spec
+
+    first, second = make(), make()
+    # source files are canonicalized upon technical_init already
+    assert first.envfile is second.envfile
+    canonical = first.interned()
+    assert canonical is first
+    assert second.interned() is canonical
+    assert second.within is canonical.within
+    assert _spec("b").interned() is not canonical
+
+    def relocate(source_file):
+        return EnvSpecSourceFile(f"workflow/{source_file.path_or_uri}")
+
+    # modified copies are private unless interned explicitly
+    private = first.modify_source_paths(relocate)
+    other = second.modify_source_paths(relocate)
+    assert private is not other and private == other
+    private.name = "changed"
+    assert other.name == "a"
+    relocated = first.modify_source_paths(relocate).interned()
+    assert relocated is second.modify_source_paths(relocate).interned()
+    within = relocated.within
+    assert isinstance(within, EnvSpec) and within.envfile is not None
+    assert within.envfile.path_or_uri == "workflow/outer.yaml"
+
+    # modified specs lose their canonical status
+    first.name = "changed"
+    assert first.interned() is first
+    assert make().interned() is not first
+
+    # canonical instances are only weakly referenced
+    ref = weakref.ref(relocated)
+    del relocated
+    gc.collect()
+    assert ref() is None
+
+
+def test_scheduler_deploy(tmp_path):
+    outer = make_env(tmp_path, "outer")
+    outer.deploy_delay = 0.05
+    inner = make_env(tmp_path, "inner", within=outer)
+    duplicate = make_env(tmp_path, "inner", within=outer)
+    failing = make_env(tmp_path, "failing", fail=True)
+    dependent = make_env(tmp_path, "dependent", within=failing)
+    events: List[str] = []
+    for env in (outer, inner, duplicate, failing, dependent):
+        env.events = events
+
+    outcomes = asyncio.run(
+        EnvScheduler(max_jobs=2).deploy([inner, duplicate, outer, failing, dependent])
+    )
+
+    assert [outcome.status for outcome in outcomes] == [
+        EnvOutcomeStatus.SUCCESS,
+        EnvOutcomeStatus.SUCCESS,
+        EnvOutcomeStatus.SUCCESS,
+        EnvOutcomeStatus.FAILED,
+        EnvOutcomeStatus.SKIPPED,
+    ]
+    # within environment is deployed before, duplicates only once
+    assert events.index("end outer") < events.index("start inner")
+    assert events.count("start inner") == 1
+    assert "start dependent" not in events
+    assert inner.deployment_path.exists()
+
+    # failing hash computation (here because of a missing envfile) only affects
+    # the environment itself
+    broken = make_env(tmp_path, "broken", envfile=tmp_path / "missing.yaml")
+    good = make_env(tmp_path, "good")
+    outcomes = asyncio.run(EnvScheduler().deploy([broken, good]))
+    assert outcomes[0].status == EnvOutcomeStatus.FAILED
+    assert isinstance(outcomes[0].error, FileNotFoundError)
+    assert outcomes[1].success and good.deployment_path.exists()
+
+
+def _deploy_in_subprocess(tmp_path: Path) -> None:
+    env = make_env(tmp_path, "shared")
+    env.deploy_delay = 0.2
+    asyncio.run(env.managed_deploy())
+
+
+def test_managed_deploy_single_flight(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    processes = [
+        ctx.Process(target=_deploy_in_subprocess, args=(tmp_path,)) for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    log = (tmp_path / "deploy.log").read_text().splitlines()
+    assert log == ["shared"]
+
+
+def test_managed_deploy_breaks_stale_lock(tmp_path):
+    env = make_env(tmp_path, "stale")
+    lock = env.deployment_path.with_suffix(".lock")
+    lock.parent.mkdir(parents=True)
+    # a holder that has crashed
+    process = multiprocessing.get_context("fork").Process(target=os.getpid)
+    process.start()
+    process.join()
+    lock.write_text(json.dumps({"host": socket.gethostname(), "pid": process.pid}))
+    asyncio.run(asyncio.wait_for(env.managed_deploy(), timeout=5))
+    assert env.deployment_path.exists()
+    assert not lock.exists()
+
+
+def test_lock_heartbeat_with_blocked_event_loop(tmp_path):
+    async def hold() -> float:
+        async with FileLock(tmp_path / "x.lock", stale_after=0.2) as lock:
+            os.utime(lock.path, (0, 0))
+            # e.g. a deploy() that runs a blocking command
+            time.sleep(0.3)
+            return lock.path.stat().st_mtime
+
+    # the lock has been refreshed although the event loop was blocked
+    assert asyncio.run(hold()) > 0
+    assert not (tmp_path / "x.lock").exists()
+
+
+def test_lock_heartbeat_stops_after_takeover(tmp_path):
+    async def hold() -> None:
+        async with FileLock(tmp_path / "x.lock", stale_after=0.2) as lock:
+            # another process has broken the lock and acquired it
+            lock.path.rename(tmp_path / "x.lock.broken")
+            lock.path.write_text("{}")
+            os.utime(lock.path, (0, 0))
+            await asyncio.sleep(0.3)
+            assert not lock.is_owned()
+            assert lock.path.stat().st_mtime == 0
+
+    asyncio.run(hold())
+    # the lock of the other process is left alone
+    assert (tmp_path / "x.lock").read_text() == "{}"
+
+
+def test_lock_break_rechecks_moved_file(tmp_path, monkeypatch):
+    path = tmp_path / "x.lock"
+    path.write_text("{}")
+    os.utime(path, (0, 0))
+    lock = FileLock(path, stale_after=0.2)
+    is_stale = lock._is_stale
+
+    def acquired_in_between(holder, mtime) -> bool:
+        stale = is_stale(holder, mtime)
+        # another process breaks the stale lock and acquires it
+        path.unlink()
+        path.write_text('{"token": "other"}')
+        return stale
+
+    monkeypatch.setattr(lock, "_is_stale", acquired_in_between)
+    assert not lock.try_acquire()
+    assert json.loads(path.read_text()) == {"token": "other"}
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_memoize(tmp_path):
+    env = make_env(tmp_path, "memoize")
+    assert [env.probe(1), env.probe(2), env.probe(1)] == [1, 2, 1]
+    assert env.events == ["probe 1", "probe 2"]
+    # least recently used entry (2) is evicted
+    env.probe(3)
+    env.probe(2)
+    assert env.events[-2:] == ["probe 3", "probe 2"]
+    env.probe.invalidate(2)
+    env.probe(2)
+    assert env.events[-1] == "probe 2"
+
+
+def test_memoize_releases_instances(tmp_path):
+    env = make_env(tmp_path, "released")
+    env.probe(1)
+    ref = weakref.ref(env)
+    del env
+    gc.collect()
+    assert ref() is None
+    assert not Env.probe._entries
+
+
+def test_memoize_async(tmp_path):
+    env = make_env(tmp_path, "memoize")
+
+    async def probe_concurrently():
+        return await asyncio.gather(*(env.async_probe() for _ in range(3)))
+
+    assert asyncio.run(probe_concurrently()) == ["memoize"] * 3
+    assert asyncio.run(env.async_probe()) == "memoize"
+    assert env.events == ["async probe"]
+
+
+class IndexedEnv(Env):
+    def is_hash_indexable(self) -> bool:
+        return True
+
+
+def test_hash_index(tmp_path, monkeypatch):
+    envfile = tmp_path / "env.yaml"
+    envfile.write_text("dependencies: [a]")
+    os.utime(envfile, (0, 0))
+
+    # plugins have to opt into the index
+    for _ in range(2):
+        env = make_env(tmp_path, "unindexed", envfile=envfile)
+        env.hash()
+        assert env.events == ["read envfile"]
+
+    env = make_env(tmp_path, "indexed", envfile=envfile, env_cls=IndexedEnv)
+    first = env.hash()
+    assert env.events == ["read envfile"]
+
+    env = make_env(tmp_path, "indexed", envfile=envfile, env_cls=IndexedEnv)
+    assert env.hash() == first
+    assert env.events == []
+
+    envfile.write_text("dependencies: [b]")
+    os.utime(envfile, (10, 10))
+    env = make_env(tmp_path, "indexed", envfile=envfile, env_cls=IndexedEnv)
+    assert env.hash() != first
+    assert env.events == ["read envfile"]
+
+    # upgrading the plugin invalidates the index
+    second = env.hash()
+    monkeypatch.setattr(importlib.metadata, "version", lambda name: "2.0")
+    distribution_version.cache_clear()
+    try:
+        env = make_env(tmp_path, "indexed", envfile=envfile, env_cls=IndexedEnv)
+        assert env.hash() == second
+        assert env.events == ["read envfile"]
+    finally:
+        distribution_version.cache_clear()
+
+    # failed writes leave no temporary files behind
+    def fail(*args):
+        raise OSError("read-only file system")
+
+    index = HashIndex(tmp_path / "index")
+    monkeypatch.setattr(os, "replace", fail)
+    index.put(HashIndex.key(["failing"]), "value")
+    assert [path.name for path in (tmp_path / "index").glob("*/*")] == []
+
+
+def test_run_cmd_pooled(tmp_path):
+    env = make_env(tmp_path, "pooled")
+    res = env.run_cmd("export FOO=bar; echo $FOO; echo err >&2; exit 3", pooled=True)
+    assert (res.returncode, res.stdout, res.stderr) == (3, b"bar\n", b"err\n")
+    # the environment is reset between commands
+    res = env.run_cmd("echo ${FOO:-unset}", pooled=True, text=True)
+    assert res.stdout == "unset\n"
+    with pytest.raises(sp.TimeoutExpired):
+        env.run_cmd("sleep 10", pooled=True, timeout=0.2)
+    assert env.run_cmd("true", pooled=True, check=True).returncode == 0
+
+
+def test_shell_pool_cleanup():
+    executable = ShellExecutable("bash", command_arg="-c", pool_size=2)
+    assert executable.run_pooled("true").returncode == 0
+    pool = executable._pool
+    assert pool is not None
+    tmpdirs = [worker._tmpdir for worker in pool._workers]
+    assert tmpdirs and all(tmpdir.exists() for tmpdir in tmpdirs)
+    # closed pools do not hand out closed workers
+    pool.close()
+    assert not any(tmpdir.exists() for tmpdir in tmpdirs)
+    assert executable.run_pooled("true").returncode == 0
+    tmpdirs = [worker._tmpdir for worker in pool._workers]
+    del executable, pool
+    gc.collect()
+    assert not any(tmpdir.exists() for tmpdir in tmpdirs)
+
+    # the pool size is a tuning parameter, not part of the identity
+    assert ShellExecutable("bash", command_arg="-c", pool_size=1) == ShellExecutable(
+        "bash", command_arg="-c"
+    )
+
+
+def test_run_cmd_async(tmp_path):
+    env = make_env(tmp_path, "async", within=make_env(tmp_path, "outer"))
+    chunks: List[bytes] = []
+    res = asyncio.run(
+        env.run_cmd_async("printenv DUMMY_ENV", stdout_callback=chunks.append)
+    )
+    assert res.returncode == 0
+    assert res.stdout == b"outer\n" == b"".join(chunks)
+
+    pidfile = tmp_path / "child.pid"
+    with pytest.raises(sp.TimeoutExpired):
+        asyncio.run(
+            env.run_cmd_async(f"sleep 10 & echo $! > {pidfile}; wait", timeout=0.5)
+        )
+    # the child process has been killed as well (give init time to reap it)
+    pid = int(pidfile.read_text())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("child process is still alive")
+
+    # cancellation kills and reaps the process before propagating
+    async def cancel() -> None:
+        task = asyncio.create_task(env.run_cmd_async(f"echo $$ > {pidfile}; sleep 10"))
+        while not pidfile.exists() or not pidfile.read_text().strip():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # reaped: the pid does not even exist as a zombie anymore
+        with pytest.raises(ProcessLookupError):
+            os.kill(int(pidfile.read_text()), 0)
+
+    pidfile.unlink()
+    asyncio.run(cancel())
+
+
+def test_activation_snapshot(tmp_path):
+    env = make_env(tmp_path, "snapshot")
+    env.snapshottable = True
+    asyncio.run(env.managed_deploy())
+    snapshot = env.deployment_path.with_suffix(".activation.json")
+    assert json.loads(snapshot.read_text())["variables"] == {"DUMMY_ENV": "snapshot"}
+
+    decorated = env.managed_decorate_shellcmd("printenv DUMMY_ENV")
+    assert decorated == "export DUMMY_ENV=snapshot; printenv DUMMY_ENV"
+    assert env.shell_executable.run(decorated, capture_output=True).stdout == (
+        b"snapshot\n"
+    )
+
+    env.managed_remove()
+    assert not snapshot.exists()
+
+
+class PathListEnv(Env):
+    def decorate_shellcmd(self, cmd: str) -> str:
+        return (
+            "export PATH=/opt/dummy/bin:$PATH; "
+            'export DUMMY_LIBPATH="${DUMMY_LIBPATH:+$DUMMY_LIBPATH:}/opt/dummy/lib"; '
+            f"{cmd}"
+        )
+
+
+def test_activation_snapshot_path_lists(tmp_path, monkeypatch):
+    env = make_env(tmp_path, "pathlist", env_cls=PathListEnv)
+    env.snapshottable = True
+    path = os.environ["PATH"]
+    monkeypatch.setenv("PATH", f"/deploy/bin:{path}")
+    monkeypatch.setenv("DUMMY_LIBPATH", "/deploy/lib")
+    asyncio.run(env.managed_deploy())
+    snapshot = env.deployment_path.with_suffix(".activation.json")
+    assert json.loads(snapshot.read_text())["variables"] == {
+        "PATH": {"prepend": ["/opt/dummy/bin"], "append": []},
+        "DUMMY_LIBPATH": {"prepend": [], "append": ["/opt/dummy/lib"]},
+    }
+
+    # the job runs with an environment that differs from the deployment time
+    monkeypatch.setenv("PATH", f"/job/bin:{path}")
+    monkeypatch.delenv("DUMMY_LIBPATH")
+    decorated = env.managed_decorate_shellcmd('echo "$PATH"; echo "$DUMMY_LIBPATH"')
+    assert env.shell_executable.run(decorated, capture_output=True).stdout == (
+        f"/opt/dummy/bin:/job/bin:{path}\n/opt/dummy/lib\n".encode()
+    )
+
+
+def test_executable_index(tmp_path):
+    env = make_env(tmp_path, "executables")
+    asyncio.run(env.managed_deploy())
+    assert env.managed_contains_executable("tool")
+    assert not env.managed_contains_executable("other")
+    # the dummy plugin itself does not know about any executable
+    assert not env.contains_executable("tool")
+
+
+def test_managed_cache_assets_resume(tmp_path):
+    assets = {"a.bin": os.urandom(100000), "b.bin": os.urandom(5000)}
+    env = make_env(tmp_path, "cacheable", env_cls=CacheableEnv)
+    assert isinstance(env, CacheableEnv)
+    with AssetServer(assets) as server:
+        env.url = server.url
+        server.interrupt.add("/a.bin")
+        with pytest.raises(WorkflowError):
+            asyncio.run(env.managed_cache_assets())
+        assert (env.cache_path / "b.bin").read_bytes() == assets["b.bin"]
+        assert (env.cache_path / "a.bin.part").exists()
+
+        progress = []
+        asyncio.run(env.managed_cache_assets(progress=progress.append))
+        assert (env.cache_path / "a.bin").read_bytes() == assets["a.bin"]
+        assert not (env.cache_path / "a.bin.part").exists()
+        statuses = {(event.asset, event.status) for event in progress}
+        assert statuses == {
+            ("a.bin", CacheAssetStatus.RESUMED),
+            ("a.bin", CacheAssetStatus.DONE),
+            ("b.bin", CacheAssetStatus.SKIPPED),
+        }
+        assert server.requests[-1] == ("/a.bin", f"bytes={len(assets['a.bin']) // 2}-")
+
+
+def test_cache_asset_verification(tmp_path):
+    assets = {"a.bin": os.urandom(1000), "b.bin": os.urandom(1000)}
+    env = make_env(tmp_path, "cacheable", env_cls=CacheableEnv)
+    assert isinstance(env, CacheableEnv)
+    with AssetServer(assets) as server:
+        env.url = server.url
+        asyncio.run(env.managed_cache_assets())
+        assert env.verify_cache_asset("a.bin", thorough=True)
+
+        # corrupt an asset without changing size and mtime
+        asset = env.cache_path / "a.bin"
+        stat = asset.stat()
+        asset.write_bytes(bytes(1000))
+        os.utime(asset, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert env.verify_cache_asset("a.bin")
+        assert not env.verify_cache_asset("a.bin", thorough=True)
+
+        server.requests.clear()
+        asyncio.run(env.managed_cache_assets(thorough=True))
+        assert asset.read_bytes() == assets["a.bin"]
+        assert server.requests == [("/a.bin", "bytes=0-")]
+
+
+def test_content_addressed_cache(tmp_path):
+    envs = [make_env(tmp_path, name, env_cls=DedupCacheableEnv) for name in ("x", "y")]
+    for env in envs:
+        assert isinstance(env, DedupCacheableEnv)
+        env.digest = hashlib.sha256(b"shared content").hexdigest()
+        asyncio.run(env.managed_cache_assets())
+    x, y = envs
+    assert isinstance(x, DedupCacheableEnv) and isinstance(y, DedupCacheableEnv)
+    # only retrieved once, the second env links the stored object
+    assert x.events == ["cache x.bin"] and y.events == []
+    x_path, y_path = x.cache_path / "x.bin", y.cache_path / "y.bin"
+    assert y_path.read_bytes() == b"shared content"
+    assert os.path.samefile(x_path, y_path)
+
+    asyncio.run(x.remove_cache())
+    assert not x_path.exists() and y_path.exists()
+    asyncio.run(y.remove_cache())
+    assert not y_path.exists()
+    assert not any((tmp_path / "cache" / ".cas" / "objects").glob("*/*"))
+
+
+def test_garbage_collection(tmp_path):
+    envs = [make_env(tmp_path, name) for name in ("old", "leased", "recent")]
+    for i, env in enumerate(envs):
+        asyncio.run(env.managed_deploy())
+        usage = tmp_path / "deployments" / ".usage" / env.deployment_hash()
+        os.utime(usage, (i * 1000, i * 1000))
+    old, leased, recent = envs
+    for env in envs:
+        for path in env.deployment_path.parent.glob(f"{env.deployment_hash()}*"):
+            os.utime(path, (0, 0), follow_symlinks=False)
+
+    collector = GarbageCollector.for_deployments(tmp_path / "deployments", quota=0)
+    with leased.lease():
+        planned = collector.collect(dry_run=True)
+        assert [entry.name for entry in planned] == [
+            old.deployment_hash(),
+            recent.deployment_hash(),
+        ]
+        assert old.deployment_path.exists()
+        collector.collect()
+    assert not old.deployment_path.exists()
+    assert not old.deployment_path.with_suffix(".deployed").exists()
+    assert not recent.deployment_path.exists()
+    assert leased.deployment_path.exists()
+
+
+def test_verify_deployment(tmp_path):
+    env = make_env(tmp_path, "verified")
+    assert env.verify_deployment() == DeploymentState.MISSING
+    asyncio.run(env.managed_deploy())
+    assert env.verify_deployment(thorough=True) == DeploymentState.VALID
+
+    tool = env.deployment_path / "bin" / "tool"
+    tool.write_text("modified")
+    assert env.verify_deployment() == DeploymentState.VALID
+    assert env.verify_deployment(thorough=True) == DeploymentState.INVALID
+    asyncio.run(env.managed_deploy(thorough=True))
+    assert tool.read_text() == ""
+
+    # deployment interrupted before completion
+    env.deployment_path.with_suffix(".deployed").unlink()
+    env.deployment_path.with_suffix(".deploying").touch()
+    assert env.verify_deployment() == DeploymentState.INVALID
+    asyncio.run(env.managed_deploy())
+    assert env.verify_deployment() == DeploymentState.VALID
+    assert not env.deployment_path.with_suffix(".deploying").exists()
+    assert env.events.count("end verified") == 3
+
+    # deployed by a version of the interface without markers and manifests
+    for suffix in (".deployed", ".manifest.jsonl", ".executables.json"):
+        env.deployment_path.with_suffix(suffix).unlink()
+    assert env.verify_deployment() == DeploymentState.UNKNOWN
+    asyncio.run(env.managed_deploy())
+    assert env.verify_deployment(thorough=True) == DeploymentState.VALID
+    assert env.events.count("end verified") == 3
+
+
+def test_staged_deployment(tmp_path):
+    env = make_env(tmp_path, "staged")
+    final_path = env.deployment_path
+    observed = []
+
+    class StagedEnv(Env):
+        async def deploy(self) -> None:
+            observed.append((self.deployment_path, final_path.exists()))
+            await super().deploy()
+
+    env = make_env(tmp_path, "staged", env_cls=StagedEnv)
+    # leftover of an interrupted deployment
+    leftover = final_path.with_name(f".{final_path.name}.staging-interrupted")
+    leftover.mkdir(parents=True)
+    asyncio.run(env.managed_deploy())
+    ((staging_path, existed),) = observed
+    assert staging_path.parent == final_path.parent
+    assert staging_path.name.startswith(f".{final_path.name}.staging-")
+    assert not existed
+    assert (final_path / "bin" / "tool").exists()
+    assert env.deployment_path == final_path
+    assert env.verify_deployment(thorough=True) == DeploymentState.VALID
+    assert list(final_path.parent.glob(".*.staging-*")) == []
+
+    failing = make_env(tmp_path, "failing", fail=True)
+    with pytest.raises(WorkflowError):
+        asyncio.run(failing.managed_deploy())
+    assert failing.verify_deployment() == DeploymentState.MISSING
+    assert list(final_path.parent.glob(".*.staging-*")) == []
+
+    class FailingStagedEnv(StagedEnv):
+        async def deploy(self) -> None:
+            self.deployment_path.mkdir()
+            raise ValueError("deployment failed halfway")
+
+    failing = make_env(tmp_path, "failing-staged", env_cls=FailingStagedEnv)
+    with pytest.raises(WorkflowError):
+        asyncio.run(failing.managed_deploy())
+    assert list(final_path.parent.glob(".*.staging-*")) == []
+
+    # leftovers of crashed deployments are garbage collected, unless the
+    # deployment is still in progress (i.e. locked)
+    crashed = final_path.with_name(f".{failing.deployment_hash()}.staging-crashed")
+    crashed.mkdir()
+    leftover.mkdir()
+    collector = GarbageCollector.for_deployments(tmp_path / "deployments")
+    lock = FileLock(env._deployment_sidecar(".lock"))
+    assert lock.try_acquire()
+    try:
+        assert collector.collect() == []
+    finally:
+        lock.release()
+    assert not crashed.exists()
+    assert leftover.exists()
+    collector.collect()
+    assert not leftover.exists()
+    assert env.verify_deployment() == DeploymentState.VALID
+
+
+def test_deploy_skips_lock_if_deployed(tmp_path):
+    class DefaultExecutableDirsEnv(Env):
+        def executable_dirs(self) -> Optional[Iterable[Path]]:
+            # the default of the interface, i.e. no executable index
+            return DeployableEnvBase.executable_dirs(self)
+
+    env = make_env(tmp_path, "lockfree", env_cls=DefaultExecutableDirsEnv)
+    asyncio.run(env.managed_deploy())
+    assert not env.deployment_path.with_suffix(".executables.json").exists()
+
+    # another process holds the lock, e.g. while deploying something else
+    lock = FileLock(env.deployment_path.with_suffix(".lock"))
+    assert lock.try_acquire()
+    try:
+        asyncio.run(asyncio.wait_for(env.managed_deploy(), timeout=5))
+    finally:
+        lock.release()
+    assert env.events.count(f"start {env.spec.name}") == 1
+
+
+def test_scheduler_pin(tmp_path):
+    envs = [
+        make_env(tmp_path, name, fail=name == "failing", env_cls=PinnableEnv)
+        for name in ["a", "b", "a", "c", "failing"]
+    ]
+    events: List[str] = []
+    for env in envs:
+        env.events = events
+    outcomes = asyncio.run(EnvScheduler(max_jobs=2).pin(envs))
+    assert [outcome.status for outcome in outcomes] == [
+        EnvOutcomeStatus.SUCCESS
+    ] * 4 + [EnvOutcomeStatus.FAILED]
+    assert sorted(events) == ["pin a", "pin b", "pin c", "pin failing"]
+    assert PinnableEnv.max_running == 2
+    assert envs[0].pinfile.read_text() == "a==1.0\n"
+    assert not envs[4].has_pinfile()
+    # no leftovers of failed pinning
+    assert {path.name for path in envs[0].pinfile.parent.iterdir()} == {
+        env.pinfile.name for env in envs[:4]
+    } | {".usage"}
+
+    # existing pinfiles are reused
+    events.clear()
+    outcomes = asyncio.run(EnvScheduler().pin(envs[:4]))
+    assert all(outcome.success for outcome in outcomes)
+    assert events == []
+    asyncio.run(EnvScheduler().pin(envs[:1], force=True))
+    assert events == ["pin a"]
+
+
+def test_instrumentation(tmp_path):
+    env = make_env(tmp_path, "instrumented", env_cls=PinnableEnv)
+    env.snapshottable = True
+    assert not instrumentation.is_enabled()
+    aggregator = instrumentation.SpanAggregator()
+    exporter = instrumentation.JsonLinesExporter(tmp_path / "spans.jsonl")
+    unsubscribe_aggregator = instrumentation.subscribe(aggregator)
+    unsubscribe_exporter = instrumentation.subscribe(exporter)
+    try:
+        asyncio.run(env.managed_deploy())
+        asyncio.run(env.managed_deploy())
+        asyncio.run(env.managed_pin())
+        env.run_cmd("exit 3")
+        failing = make_env(tmp_path, "failing", fail=True)
+        with pytest.raises(WorkflowError):
+            asyncio.run(failing.managed_deploy())
+    finally:
+        unsubscribe_aggregator()
+        unsubscribe_exporter()
+        exporter.close()
+    assert not instrumentation.is_enabled()
+
+    summary = aggregator.summary()
+    assert summary["deploy"].count == 3
+    assert summary["deploy"].outcomes == {"success": 1, "skipped": 1, "failed": 1}
+    assert summary["deploy"].bytes == 0
+    assert summary["pin"].bytes == len("instrumented==1.0\n")
+    assert summary["deployment_hash"].count == 2
+    assert summary["run_cmd"].failed == 1
+    deploy = next(span for span in aggregator.spans if span.operation == "deploy")
+    assert deploy.kind == "dummy"
+    assert deploy.spec == "instrumented"
+    assert deploy.hash == env.deployment_hash()
+    # activation snapshot is captured while deploying
+    snapshot_cmds = [
+        span
+        for span in aggregator.spans
+        if span.operation == "run_cmd" and span.parent_id == deploy.id
+    ]
+    assert len(snapshot_cmds) == 2
+    lines = (tmp_path / "spans.jsonl").read_text().splitlines()
+    assert len(lines) == len(aggregator.spans)
+    assert json.loads(lines[-1])["error"].startswith("Deployment of failing failed")
+
+
+def _cached_envfile(spec: Optional[EnvSpecBase]) -> Path:
+    assert isinstance(spec, EnvSpec) and spec.envfile is not None
+    assert spec.envfile.cached is not None
+    return spec.envfile.cached
+
+
+def test_source_file_cache(tmp_path):
+    assets = {"env.yaml": b"name: env\n", "outer.post-deploy.sh": b"echo outer\n"}
+    local = tmp_path / "local.yaml"
+    local.write_text("name: local\n")
+    with AssetServer(assets) as server:
+
+        def make_specs():
+            spec = _spec("a", f"{server.url}/env.yaml")
+            spec.within = EnvSpec(
+                "outer",
+                envfile=EnvSpecSourceFile(f"{server.url}/outer.yaml").replace_suffix(
+                    [".yaml"], ".post-deploy.sh"
+                ),
+            )
+            spec.fallback = _spec("local", str(local))
+            duplicate = _spec("b", f"{server.url}/env.yaml")
+            return [spec, duplicate]
+
+        cache = SourceFileCache(tmp_path / "sources")
+        specs = make_specs()
+        asyncio.run(cache.fetch_specs(specs))
+        spec, duplicate = specs
+        assert _cached_envfile(spec).read_bytes() == assets["env.yaml"]
+        assert _cached_envfile(duplicate) == _cached_envfile(spec)
+        assert _cached_envfile(spec.within).read_bytes() == b"echo outer\n"
+        assert _cached_envfile(spec.fallback) == local
+        # each URI is fetched once
+        assert sorted(path for path, _ in server.requests) == [
+            "/env.yaml",
+            "/outer.post-deploy.sh",
+        ]
+
+        # later runs revalidate instead of downloading again
+        asyncio.run(SourceFileCache(tmp_path / "sources").fetch_specs(make_specs()))
+        assert server.not_modified == 2
+        assets["env.yaml"] = b"name: changed\n"
+        specs = make_specs()
+        asyncio.run(SourceFileCache(tmp_path / "sources").fetch_specs(specs))
+        assert server.not_modified == 3
+        assert _cached_envfile(specs[0]).read_bytes() == b"name: changed\n"
+
+    # offline, the local copies are used
+    specs = make_specs()
+    asyncio.run(SourceFileCache(tmp_path / "sources").fetch_specs(specs))
+    assert _cached_envfile(specs[0]).read_bytes() == b"name: changed\n"
+    with pytest.raises(WorkflowError):
+        asyncio.run(
+            SourceFileCache(tmp_path / "other").fetch(
+                EnvSpecSourceFile(f"{server.url}/env.yaml")
+            )
+        )
+
+
+class ProbedEnv(Env):
+    # names of the specs that are unavailable on the current node
+    unavailable: Set[str] = set()
+    barrier: Optional[threading.Barrier] = None
+    probed: List[str] = []
+
+    def is_available(self) -> bool:
+        self.probed.append(self.spec.name)
+        if self.barrier is not None:
+            # all alternatives of a chain are probed at the same time
+            self.barrier.wait(timeout=5)
+        return self.spec.name not in self.unavailable
+
+    def estimate_deployment_cost(self) -> Optional[float]:
+        return 100.0 if self.spec.name == "slow" else 1.0
+
+
+def test_fallback_resolver(tmp_path, monkeypatch):
+    monkeypatch.setattr(ProbedEnv, "unavailable", {"conda"})
+    monkeypatch.setattr(ProbedEnv, "barrier", threading.Barrier(3))
+    monkeypatch.setattr(ProbedEnv, "probed", [])
+
+    def env_factory(spec: EnvSpecBase) -> Env:
+        return ProbedEnv(
+            spec=spec,
+            within=None,
+            settings=None,
+            shell_executable=ShellExecutable("bash", command_arg="-c"),
+            mountpoints=[],
+            tempdir=tmp_path / "temp",
+            cache_prefix=tmp_path / "cache",
+            deployment_prefix=tmp_path / "deployments",
+            pinfile_prefix=tmp_path / "pinfiles",
+        )
+
+    (tmp_path / "cache").mkdir()
+    resolver = FallbackResolver(
+        env_factory, max_deployment_cost=10.0, decision_dir=tmp_path / "decisions"
+    )
+    chains = [_spec("conda") | _spec("slow") | _spec("container") for _ in range(50)]
+    resolutions = asyncio.run(resolver.resolve_all(chains))
+    assert {resolution.env.spec.name for resolution in resolutions} == {"container"}
+    assert resolutions[0].index == 2
+    assert sorted(ProbedEnv.probed) == ["conda", "container", "slow"]
+    probes = resolutions[0].probes
+    assert probes is not None and probes[1].deployment_cost == 100.0
+
+    # once deployed, the slow alternative is preferred
+    monkeypatch.setattr(ProbedEnv, "barrier", None)
+    slow = probes[1].env
+    assert isinstance(slow, ProbedEnv)
+    asyncio.run(slow.managed_deploy())
+    assert asyncio.run(resolver.resolve(chains[0])).index == 2
+    resolver.invalidate(chains[0])
+    assert asyncio.run(resolver.resolve(chains[0])).index == 1
+
+    # decisions are shared per node with other processes
+    ProbedEnv.probed.clear()
+    other = FallbackResolver(env_factory, decision_dir=tmp_path / "decisions")
+    resolution = asyncio.run(other.resolve(chains[1]))
+    assert resolution.index == 1 and resolution.probes is None
+    assert not ProbedEnv.probed
+    other_node = FallbackResolver(
+        env_factory, decision_dir=tmp_path / "decisions", hostname="other"
+    )
+    assert asyncio.run(other_node.resolve(chains[1])).probes is not None
+
+    ProbedEnv.unavailable = {"conda", "slow", "container"}
+    with pytest.raises(WorkflowError, match="not available"):
+        asyncio.run(resolver.resolve(_spec("conda") | _spec("container")))
+
+
+class NonPortableEnv(Env):
+    def is_deployment_path_portable(self) -> bool:
+        return False
+
+
+def test_sharded_layout_migration(tmp_path):
+    prefix = tmp_path / "deployments"
+    moved, leased = (make_env(tmp_path, name) for name in ("moved", "leased"))
+    for env in (moved, leased):
+        asyncio.run(env.managed_deploy())
+    pinned = make_env(tmp_path, "pinned", env_cls=PinnableEnv)
+    asyncio.run(pinned.managed_pin())
+    conda = make_env(tmp_path, "conda", env_cls=NonPortableEnv)
+    asyncio.run(conda.managed_deploy())
+    flat_hash = conda.deployment_hash()
+
+    layout = PrefixLayout(shard_levels=2)
+    with leased.lease():
+        report = LayoutMigration.for_deployments(prefix, layout).run()
+    assert report.moved == [moved.deployment_hash()]
+    assert report.skipped == [leased.deployment_hash()]
+    # non-portable deployments would be broken at another path
+    assert report.removed == [flat_hash]
+    assert list(prefix.glob(f"**/{flat_hash}*")) == []
+    assert LayoutMarker.load(prefix).is_migrating
+
+    # during the migration, entries are found in both layouts
+    name = moved.deployment_hash()
+    assert moved.deployment_path == prefix / name[:2] / name[2:4] / name
+    assert moved.verify_deployment(thorough=True) == DeploymentState.VALID
+    assert leased.deployment_path == prefix / leased.deployment_hash()
+    assert leased.verify_deployment() == DeploymentState.VALID
+    added = make_env(tmp_path, "added")
+    asyncio.run(added.managed_deploy())
+    assert added.deployment_path.parent.parent.parent == prefix
+    # non-portable environments cannot be moved and are deployed again
+    assert (
+        make_env(tmp_path, "conda", env_cls=NonPortableEnv).deployment_hash()
+        != flat_hash
+    )
+
+    report = LayoutMigration.for_deployments(prefix, layout).run()
+    assert report.moved == [leased.deployment_hash()] and report.complete
+    assert not LayoutMarker.load(prefix).is_migrating
+    assert leased.verify_deployment(thorough=True) == DeploymentState.VALID
+    assert sorted(
+        entry.name for entry in GarbageCollector.for_deployments(prefix).entries()
+    ) == sorted(env.deployment_hash() for env in (moved, leased, added))
+
+    report = LayoutMigration.for_pinfiles(tmp_path / "pinfiles", layout).run()
+    assert report.complete
+    assert pinned.has_pinfile()
+    assert pinned.pinfile.parent.parent.parent == tmp_path / "pinfiles"
+
+
+def _migrate_in_subprocess(prefix: Path) -> None:
+    report = LayoutMigration.for_deployments(prefix, PrefixLayout(shard_levels=1)).run()
+    assert report.complete
+
+
+def test_layout_migration_by_other_process(tmp_path, monkeypatch):
+    env = make_env(tmp_path, "running")
+    asyncio.run(env.managed_deploy())
+    flat_path = env.deployment_path
+    assert not LayoutMarker.load(tmp_path / "deployments").layout.is_sharded
+
+    # the marker file is not checked on every lookup
+    checks = []
+    monkeypatch.setattr(
+        "snakemake_interface_software_deployment_plugins.layout._signature",
+        lambda path: checks.append(path) or _signature(path),
+    )
+    for _ in range(10):
+        assert env.deployment_path == flat_path
+    assert len(checks) <= 1
+    monkeypatch.undo()
+
+    # another process migrates the prefix while this one keeps running
+    process = multiprocessing.get_context("fork").Process(
+        target=_migrate_in_subprocess, args=(tmp_path / "deployments",)
+    )
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    # the marker is checked for changes once deploying
+    asyncio.run(env.managed_deploy())
+    assert env.events.count(f"start {env.spec.name}") == 1
+    assert env.deployment_path != flat_path
+    assert env.deployment_path.parent.parent == tmp_path / "deployments"
+
+
+class QuotingEnv(Env):
+    def decorate_shellcmd(self, cmd: str) -> str:
+        return f"env DUMMY_OUTER={self.spec.name} bash -c {shlex.quote(cmd)}"
+
+
+class InspectingEnv(Env):
+    def decorate_shellcmd(self, cmd: str) -> str:
+        return cmd if cmd.startswith("exec ") else f"exec {cmd}"
+
+    def supports_shellcmd_template(self) -> bool:
+        return False
+
+
+class CountingEnv(Env):
+    def decorate_shellcmd(self, cmd: str) -> str:
+        return f"echo {len(cmd)} && {cmd}"
+
+
+def test_compile_shellcmd(tmp_path):
+    outer = make_env(tmp_path, "outer", env_cls=QuotingEnv)
+    middle = make_env(tmp_path, "middle", within=outer, env_cls=QuotingEnv)
+    env = make_env(tmp_path, "inner", within=middle)
+    template = env.compile_shellcmd()
+    assert template.is_compiled and template.quoting == 2
+    assert env.compile_shellcmd() is template
+
+    cmds = [
+        "printenv DUMMY_ENV DUMMY_OUTER",
+        "echo 'single' \"double\" $DUMMY_OUTER `echo sub` \\\\",
+        "",
+    ]
+    assert env.managed_decorate_shellcmds(cmds) == [
+        env.managed_decorate_shellcmd(cmd) for cmd in cmds
+    ]
+
+    def run(cmd: str) -> bytes:
+        return env.shell_executable.run(cmd, capture_output=True).stdout
+
+    assert run(template.render(cmds[0])) == b"inner\nmiddle\n"
+    assert run(template.render(cmds[1])) == b"single double middle sub \\\n"
+    # commands that are left as they are by shlex.quote are quoted anyways
+    assert run(template.render("echo")) == run(env.managed_decorate_shellcmd("echo"))
+
+    # decorations that depend on the command are not compiled
+    counting = make_env(tmp_path, "counting", env_cls=CountingEnv)
+    assert not counting.compile_shellcmd().is_compiled
+    assert counting.managed_decorate_shellcmds(["true"]) == ["echo 4 && true"]
+    inspecting = make_env(tmp_path, "inspecting", env_cls=InspectingEnv)
+    assert not inspecting.compile_shellcmd().is_compiled
+    assert inspecting.managed_decorate_shellcmds(["exec true", "true"]) == [
+        "exec true",
+        "exec true",
+    ]